@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class CustomCodeConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "custom_code"
+
+    def ready(self):
+        # connects the signal receivers invalidating the taxonomy cache
+        from . import taxonomy  # noqa: F401
+        # connects the receiver rebuilding the values of packed spectra
+        from tidestom.tides_utils import spectrum_storage  # noqa: F401
@@ -1,5 +1,6 @@
 from django import forms
-from .models import TidesTarget, TidesClass, TidesClassSubClass
+from .models import TidesTarget, TidesClassSubClass
+from .taxonomy import get_taxonomy
 
 class TidesTargetForm(forms.ModelForm):
     class Meta:
@@ -10,24 +11,15 @@ class TidesTargetForm(forms.ModelForm):
         super().__init__(*args, **kwargs)
         self.fields['tidesclass_subclass'].queryset = TidesClassSubClass.objects.none()
 
+        # class names are resolved from the cached taxonomy, without queries
+        main_class_name = None
         if 'tidesclass' in self.data:
-            try:
-                main_class_name = self.data.get('tidesclass')
-                print(f"Trying to get TidesClass with name: {main_class_name}")
-                main_class = TidesClass.objects.get(name=main_class_name)
-                self.fields['tidesclass_subclass'].queryset = TidesClassSubClass.objects.filter(main_class=main_class)
-            except (ValueError, TypeError, TidesClass.DoesNotExist):
-                print(f"TidesClass with name {main_class_name} does not exist.")
-                pass  # invalid input from the client; ignore and fallback to empty queryset
+            main_class_name = self.data.get('tidesclass')  # invalid input from the client falls back to the empty queryset
         elif self.instance.pk:
-            try:
-                main_class_name = self.instance.tidesclass
-                print(f"Trying to get TidesClass with name: {main_class_name}")
-                main_class = TidesClass.objects.get(name=main_class_name)
-                self.fields['tidesclass_subclass'].queryset = TidesClassSubClass.objects.filter(main_class=main_class)
-            except TidesClass.DoesNotExist:
-                print(f"TidesClass with name {main_class_name} does not exist.")
-                pass  # handle the case where the main class does not exist
+            main_class_name = self.instance.tidesclass
+        subclass_ids = [subclass.pk for subclass in get_taxonomy().subclasses_of(main_class_name)]
+        if subclass_ids:
+            self.fields['tidesclass_subclass'].queryset = TidesClassSubClass.objects.filter(pk__in=subclass_ids)
     
     def clean(self):
         cleaned_data = super().clean()
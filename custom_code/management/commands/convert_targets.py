@@ -1,9 +1,16 @@
 from django.core.management.base import BaseCommand
+from django.contrib.auth.models import Permission
+from django.db import transaction
 
+from guardian.ctypes import get_content_type
 from guardian.models import GroupObjectPermission, UserObjectPermission
 
 from tom_targets.base_models import BaseTarget
 from tom_targets.models import Target
+from tidestom.tides_utils.target_utils import bulk_insert_child_rows, run_target_save_hooks
+
+# Object permissions given by BaseTarget.give_user_access
+ACCESS_PERMISSIONS = ['view_target', 'change_target', 'delete_target']
 
 
 class Command(BaseCommand):
@@ -14,27 +21,58 @@ class Command(BaseCommand):
 
     help = 'A helper command to convert existing BaseTargets to TidesTargets.'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Number of targets converted per transaction'
+        )
+
     def handle(self, *args, **options):
         # Make sure Target is a subclass of BaseTarget
         if Target != BaseTarget and issubclass(Target, BaseTarget):
             self.stdout.write(f'{Target} is a subclass of BaseTarget, updating existing Targets.')
-            base_targets = BaseTarget.objects.all()
-            targets = Target.objects.all()
-            for base_target in base_targets:
-                # If the base_target is not already in the new target model, update it
-                # Note: subclassed models share a PK with their parent
-                if not targets.filter(pk=base_target.pk).exists():
-                    self.stdout.write(f'Updating {base_target}...')
-                    target = Target(basetarget_ptr_id=base_target.pk)  # Create a new target with the base_target PK
-                    target.__dict__.update(base_target.__dict__)  # add base_target fields to target dictionary
-                    target.save()
-                    # re-add permissions for existing users and groups
-                    group_set = set(gop.group for gop in GroupObjectPermission.objects.filter(object_pk=target.pk))
-                    user_set = set(uop.user for uop in UserObjectPermission.objects.filter(object_pk=target.pk))
-                    for group in group_set:
-                        target.give_user_access(group)
-                    for user in user_set:
-                        target.give_user_access(user)
+            # Anti-join: BaseTargets without a row in the new target model
+            # Note: subclassed models share a PK with their parent
+            parent_link = Target._meta.get_ancestor_link(BaseTarget)
+            unconverted = BaseTarget.objects.filter(
+                **{f'{parent_link.related_query_name()}__isnull': True}
+            ).order_by('pk').values_list('pk', flat=True)
+            total = unconverted.count()
+
+            self.target_ctypes = [get_content_type(BaseTarget), get_content_type(Target)]
+            self.access_permissions = list(Permission.objects.filter(
+                content_type=get_content_type(Target), codename__in=ACCESS_PERMISSIONS
+            ))
+
+            converted = 0
+            batch_size = options['batch_size']
+            while converted < total:
+                # converted targets drop out of the anti-join
+                pks = list(unconverted[:batch_size])
+                if not pks:
+                    break
+                with transaction.atomic():
+                    bulk_insert_child_rows(Target(**{parent_link.attname: pk}) for pk in pks)
+                    self.copy_access(pks)
+                    # as Target.save() did for the existing (not created) targets
+                    run_target_save_hooks(pks, created=False)
+                converted += len(pks)
+                self.stdout.write(f'Updated {converted}/{total} targets...')
             self.stdout.write(f'{Target.objects.count()} Targets updated.')
 
-        return
\ No newline at end of file
+        return
+
+    def copy_access(self, pks):
+        # re-add permissions for existing users and groups, in bulk
+        object_pks = [str(pk) for pk in pks]
+        target_ctype = get_content_type(Target)
+        for model, holder in ((UserObjectPermission, 'user_id'), (GroupObjectPermission, 'group_id')):
+            holders = model.objects.filter(
+                content_type__in=self.target_ctypes, object_pk__in=object_pks
+            ).values_list(holder, 'object_pk').distinct()
+            model.objects.bulk_create([
+                model(**{holder: holder_id}, permission=permission,
+                      content_type=target_ctype, object_pk=object_pk)
+                for holder_id, object_pk in holders
+                for permission in self.access_permissions
+            ], ignore_conflicts=True)
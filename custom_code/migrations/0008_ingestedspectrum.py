@@ -0,0 +1,33 @@
+# Generated by Django 4.2.30 on 2026-10-16 23:14
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_targets', '0030_alter_basetarget_slope'),
+        ('tom_dataproducts', '0014_alter_reduceddatum_timestamp'),
+        ('custom_code', '0007_humantidesclasssubmission'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestedSpectrum',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source_path', models.CharField(max_length=500, verbose_name='Source Path')),
+                ('size', models.BigIntegerField(verbose_name='File Size')),
+                ('mtime', models.FloatField(verbose_name='File Modification Time')),
+                ('content_hash', models.CharField(blank=True, default='', max_length=64, verbose_name='Content Hash')),
+                ('ingested', models.DateTimeField(auto_now=True, verbose_name='Ingestion Time')),
+                ('data_product', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='ingested_files', to='tom_dataproducts.dataproduct')),
+                ('target', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='ingested_files', to='tom_targets.basetarget')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='ingestedspectrum',
+            constraint=models.UniqueConstraint(fields=('source_path', 'target'), name='unique_ingested_spectrum_target'),
+        ),
+    ]
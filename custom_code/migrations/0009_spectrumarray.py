@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-16 23:24
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_dataproducts', '0014_alter_reduceddatum_timestamp'),
+        ('custom_code', '0008_ingestedspectrum'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SpectrumArray',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('codec', models.CharField(max_length=50, verbose_name='Codec')),
+                ('wavelength', models.BinaryField(verbose_name='Wavelength')),
+                ('flux', models.BinaryField(verbose_name='Flux')),
+                ('error', models.BinaryField(blank=True, null=True, verbose_name='Flux Error')),
+                ('flux_units', models.CharField(blank=True, default='', max_length=100, verbose_name='Flux Units')),
+                ('wavelength_units', models.CharField(blank=True, default='', max_length=100, verbose_name='Wavelength Units')),
+                ('reduced_datum', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='spectrum_array', to='tom_dataproducts.reduceddatum')),
+            ],
+        ),
+    ]
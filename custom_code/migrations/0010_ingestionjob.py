@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-16 23:27
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('custom_code', '0009_spectrumarray'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IngestionJob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('spectrum_file', models.CharField(db_index=True, max_length=500, verbose_name='Spectrum File')),
+                ('row', models.JSONField(verbose_name='Ingestion Row')),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('running', 'Running'), ('done', 'Done'), ('failed', 'Failed')], db_index=True, default='pending', max_length=20, verbose_name='Status')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='Attempts')),
+                ('max_attempts', models.PositiveIntegerField(default=3, verbose_name='Maximum Attempts')),
+                ('worker', models.CharField(blank=True, default='', max_length=100, verbose_name='Worker')),
+                ('claim', models.CharField(blank=True, db_index=True, default='', max_length=32, verbose_name='Claim Token')),
+                ('error', models.TextField(blank=True, default='', verbose_name='Last Error')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Queued')),
+                ('started', models.DateTimeField(blank=True, null=True, verbose_name='Started')),
+                ('finished', models.DateTimeField(blank=True, null=True, verbose_name='Finished')),
+                ('available_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='Available At')),
+            ],
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.30 on 2026-10-16 23:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('tom_dataproducts', '0014_alter_reduceddatum_timestamp'),
+        ('custom_code', '0010_ingestionjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TemplateMatch',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('fitter', models.CharField(choices=[('snid', 'SNID'), ('ngsf', 'NGSF')], max_length=10, verbose_name='Fitter')),
+                ('rank', models.PositiveSmallIntegerField(verbose_name='Rank')),
+                ('name', models.CharField(max_length=100, verbose_name='Template Name')),
+                ('sn_type', models.CharField(max_length=50, verbose_name='Template Type')),
+                ('phase', models.FloatField(blank=True, null=True, verbose_name='Phase')),
+                ('redshift', models.FloatField(blank=True, null=True, verbose_name='Redshift')),
+                ('extra', models.JSONField(blank=True, default=dict, verbose_name='Fit Details')),
+                ('codec', models.CharField(max_length=50, verbose_name='Codec')),
+                ('flux', models.BinaryField(verbose_name='Flux on the Observed Grid')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='Matched')),
+                ('reduced_datum', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='template_matches', to='tom_dataproducts.reduceddatum')),
+            ],
+            options={
+                'ordering': ['fitter', 'rank'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='templatematch',
+            constraint=models.UniqueConstraint(fields=('reduced_datum', 'fitter', 'rank'), name='unique_template_match_rank'),
+        ),
+    ]
@@ -88,3 +88,105 @@ class HumanTidesClassSubmission(models.Model):
 
     def __str__(self):
         return f"{self.user.username} - {self.target.name} - {self.tidesclass}"
+
+
+class IngestedSpectrum(models.Model):
+    """
+    Ledger of the spectrum files already ingested, so that unchanged files can be skipped on reruns. Joined files hold the spectra of several targets, so there is one entry per file and target.
+    """
+    source_path = models.CharField(max_length=500, verbose_name='Source Path')
+    target = models.ForeignKey('tom_targets.BaseTarget', on_delete=models.CASCADE, null=True, blank=True, related_name='ingested_files')
+    size = models.BigIntegerField(verbose_name='File Size')
+    mtime = models.FloatField(verbose_name='File Modification Time')
+    content_hash = models.CharField(max_length=64, blank=True, default='', verbose_name='Content Hash')
+    data_product = models.ForeignKey('tom_dataproducts.DataProduct', on_delete=models.CASCADE, null=True, blank=True, related_name='ingested_files')
+    ingested = models.DateTimeField(auto_now=True, verbose_name='Ingestion Time')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['source_path', 'target'], name='unique_ingested_spectrum_target'),
+        ]
+
+    def __str__(self):
+        return self.source_path
+
+
+class SpectrumArray(models.Model):
+    """
+    Compact storage of a spectroscopy ReducedDatum: float32 arrays, byte-shuffled and compressed, and their units. The datum's value then only keeps a small stub, which is rebuilt into the full spectrum when the datum is loaded.
+    """
+    reduced_datum = models.OneToOneField('tom_dataproducts.ReducedDatum', on_delete=models.CASCADE, related_name='spectrum_array')
+    codec = models.CharField(max_length=50, verbose_name='Codec')
+    wavelength = models.BinaryField(verbose_name='Wavelength')
+    flux = models.BinaryField(verbose_name='Flux')
+    error = models.BinaryField(null=True, blank=True, verbose_name='Flux Error')
+    flux_units = models.CharField(max_length=100, blank=True, default='', verbose_name='Flux Units')
+    wavelength_units = models.CharField(max_length=100, blank=True, default='', verbose_name='Wavelength Units')
+
+    def __str__(self):
+        return f"Arrays of ReducedDatum {self.reduced_datum_id}"
+
+
+class IngestionJob(models.Model):
+    """
+    A spectrum waiting to be ingested. Jobs are claimed by `ingest_worker` processes, on any node sharing the database.
+    """
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = [
+        (PENDING, 'Pending'),
+        (RUNNING, 'Running'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    ]
+
+    spectrum_file = models.CharField(max_length=500, db_index=True, verbose_name='Spectrum File')
+    row = models.JSONField(verbose_name='Ingestion Row')
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=PENDING, db_index=True, verbose_name='Status')
+    attempts = models.PositiveIntegerField(default=0, verbose_name='Attempts')
+    max_attempts = models.PositiveIntegerField(default=3, verbose_name='Maximum Attempts')
+    worker = models.CharField(max_length=100, blank=True, default='', verbose_name='Worker')
+    claim = models.CharField(max_length=32, blank=True, default='', db_index=True, verbose_name='Claim Token')
+    error = models.TextField(blank=True, default='', verbose_name='Last Error')
+    available_at = models.DateTimeField(default=now, db_index=True, verbose_name='Available At')
+    created = models.DateTimeField(auto_now_add=True, verbose_name='Queued')
+    started = models.DateTimeField(null=True, blank=True, verbose_name='Started')
+    finished = models.DateTimeField(null=True, blank=True, verbose_name='Finished')
+
+    def __str__(self):
+        return f"{self.spectrum_file} ({self.status})"
+
+
+class TemplateMatch(models.Model):
+    """
+    A best-matching SNID or NGSF template of a spectroscopy ReducedDatum, with its flux already resampled onto the datum's wavelength grid (compressed as in SpectrumArray), so that target pages only read fit results.
+    """
+    SNID = 'snid'
+    NGSF = 'ngsf'
+    FITTER_CHOICES = [
+        (SNID, 'SNID'),
+        (NGSF, 'NGSF'),
+    ]
+
+    reduced_datum = models.ForeignKey('tom_dataproducts.ReducedDatum', on_delete=models.CASCADE, related_name='template_matches')
+    fitter = models.CharField(max_length=10, choices=FITTER_CHOICES, verbose_name='Fitter')
+    rank = models.PositiveSmallIntegerField(verbose_name='Rank')
+    name = models.CharField(max_length=100, verbose_name='Template Name')
+    sn_type = models.CharField(max_length=50, verbose_name='Template Type')
+    phase = models.FloatField(null=True, blank=True, verbose_name='Phase')
+    redshift = models.FloatField(null=True, blank=True, verbose_name='Redshift')
+    extra = models.JSONField(default=dict, blank=True, verbose_name='Fit Details')
+    codec = models.CharField(max_length=50, verbose_name='Codec')
+    flux = models.BinaryField(verbose_name='Flux on the Observed Grid')
+    created = models.DateTimeField(auto_now_add=True, verbose_name='Matched')
+
+    class Meta:
+        ordering = ['fitter', 'rank']
+        constraints = [
+            models.UniqueConstraint(fields=['reduced_datum', 'fitter', 'rank'], name='unique_template_match_rank'),
+        ]
+
+    def __str__(self):
+        return f"{self.rank}. {self.name} ({self.fitter}) for ReducedDatum {self.reduced_datum_id}"
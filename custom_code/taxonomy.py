@@ -0,0 +1,100 @@
+'''The TiDES classification taxonomy: loading it from its data file, and a process-local cached tree for lookups on hot paths'''
+
+import json
+import os
+import time
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import TidesClass, TidesClassSubClass
+
+TAXONOMY_FILE = os.path.join(os.path.dirname(__file__), 'data', 'tides_taxonomy.json')
+
+_taxonomy = None
+
+
+def load_taxonomy_file(path=TAXONOMY_FILE):
+    """
+    Reads a taxonomy data file.
+
+    :returns: the file version and a dict of class name -> list of sub-class names
+    """
+    with open(path) as f:
+        taxonomy = json.load(f)
+    return taxonomy['version'], taxonomy['classes']
+
+
+def _classes_by_name():
+    classes = {}
+    for main_class in TidesClass.objects.order_by('pk'):
+        # keep the first match, as ``.get()``/``.first()`` lookups did
+        classes.setdefault(main_class.name, main_class)
+    return classes
+
+
+def sync_taxonomy(classes):
+    """
+    Adds the classes and sub-classes missing from the database with bulk inserts. Existing entries are left untouched.
+
+    :param classes: dict of class name -> list of sub-class names
+    :returns: number of classes and of sub-classes added
+    """
+    existing_classes = _classes_by_name()
+    new_classes = [TidesClass(name=name) for name in classes if name not in existing_classes]
+    if new_classes:
+        TidesClass.objects.bulk_create(new_classes)
+        existing_classes = _classes_by_name()
+
+    existing_subclasses = set(TidesClassSubClass.objects.values_list('main_class__name', 'sub_class'))
+    new_subclasses = []
+    for name, sub_classes in classes.items():
+        for sub_class in dict.fromkeys(sub_classes):
+            if (name, sub_class) not in existing_subclasses:
+                new_subclasses.append(TidesClassSubClass(main_class=existing_classes[name], sub_class=sub_class))
+    TidesClassSubClass.objects.bulk_create(new_subclasses)
+    # bulk inserts do not send post_save
+    invalidate_taxonomy()
+    return len(new_classes), len(new_subclasses)
+
+
+class Taxonomy:
+    """
+    In-memory tree of the classes and sub-classes in the database, built with two queries.
+    """
+    def __init__(self):
+        self.classes = _classes_by_name()
+        self.subclasses = {name: [] for name in self.classes}
+        self.subclasses_by_name = {}
+        for subclass in TidesClassSubClass.objects.select_related('main_class').order_by('pk'):
+            if self.classes.get(subclass.main_class.name) == subclass.main_class:
+                self.subclasses[subclass.main_class.name].append(subclass)
+            self.subclasses_by_name.setdefault(subclass.sub_class, subclass)
+        self.built = time.monotonic()
+
+    def subclasses_of(self, class_name):
+        """Sub-classes of the named class (an empty list for unknown classes)."""
+        return self.subclasses.get(class_name, [])
+
+    def subclass(self, sub_class_name):
+        """The first sub-class with this name, or None."""
+        return self.subclasses_by_name.get(sub_class_name)
+
+
+def get_taxonomy():
+    """
+    Returns the cached taxonomy tree, building it on first use. The cache is dropped whenever a class or sub-class is saved or deleted in this process; other processes pick the change up after ``TAXONOMY_CACHE_SECONDS`` at most.
+    """
+    global _taxonomy
+    max_age = getattr(settings, 'TAXONOMY_CACHE_SECONDS', 300)
+    if _taxonomy is None or time.monotonic() - _taxonomy.built > max_age:
+        _taxonomy = Taxonomy()
+    return _taxonomy
+
+
+@receiver([post_save, post_delete], sender=TidesClass)
+@receiver([post_save, post_delete], sender=TidesClassSubClass)
+def invalidate_taxonomy(**kwargs):
+    global _taxonomy
+    _taxonomy = None
@@ -1,3 +1,75 @@
-from django.test import TestCase
+import json
+from io import StringIO
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.auth.models import Permission, User
+from django.core.management import call_command
+from django.test import RequestFactory, TestCase
+from guardian.ctypes import get_content_type
+from guardian.models import UserObjectPermission
+from guardian.shortcuts import get_objects_for_user
+from tom_targets.base_models import BaseTarget
+
+from custom_code.models import TidesTarget, TidesClass, TidesClassSubClass
+from custom_code.taxonomy import get_taxonomy
+from tidestom.views import get_subclasses
+
+
+class TestConvertTargets(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='observer')
+        self.base_targets = [
+            BaseTarget.objects.create(name=f'legacy{i}', type='SIDEREAL')
+            for i in range(5)
+        ]
+        TidesTarget.objects.create(name='converted', type='SIDEREAL')
+        UserObjectPermission.objects.create(
+            user=self.user, object_pk=str(self.base_targets[0].pk),
+            content_type=get_content_type(BaseTarget),
+            permission=Permission.objects.get(codename='view_basetarget')
+        )
+
+    def test_convert_targets(self):
+        out = StringIO()
+        with mock.patch('tidestom.tides_utils.target_utils.run_hook') as hook:
+            call_command('convert_targets', '--batch-size', '2', stdout=out)
+        assert hook.call_count == 5
+        assert 'Updated 5/5 targets' in out.getvalue()
+        assert TidesTarget.objects.count() == 6
+        assert TidesTarget.objects.get(name='legacy3').tidesclass == 'SN'
+        visible = get_objects_for_user(
+            self.user, 'custom_code.view_target', klass=TidesTarget
+        )
+        assert list(visible.values_list('name', flat=True)) == ['legacy0']
+
+        # a second run has nothing left to convert
+        call_command('convert_targets', stdout=out)
+        assert TidesTarget.objects.count() == 6
+
+
+class TestTaxonomy(TestCase):
+    def test_populate_from_data_file(self):
+        out = StringIO()
+        call_command('populate_tidesclasses', stdout=out)
+        assert 'taxonomy version 1' in out.getvalue()
+        assert TidesClass.objects.count() == 18
+        # the duplicated sub-classes of the old command are gone
+        assert TidesClassSubClass.objects.filter(sub_class='SNIcn').count() == 1
+        call_command('populate_tidesclasses', stdout=out)
+        assert TidesClass.objects.count() == 18
+
+    def test_cached_lookups(self):
+        call_command('populate_tidesclasses', stdout=StringIO())
+        get_taxonomy()
+        with self.assertNumQueries(0):
+            subclasses = get_taxonomy().subclasses_of('TDE')
+            response = get_subclasses(RequestFactory().get(
+                '/api/get_subclasses/', {'main_class': 'SNIa'}
+            ))
+        assert len(subclasses) == 5
+        assert len(json.loads(response.content)) == 5
+
+        # saving a model drops the cache
+        snia = TidesClass.objects.get(name='SNIa')
+        TidesClassSubClass.objects.create(main_class=snia, sub_class='SNIa-CSM')
+        assert get_taxonomy().subclass('SNIa-CSM') is not None
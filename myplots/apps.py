@@ -4,3 +4,7 @@ from django.apps import AppConfig
 class MyplotsConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "myplots"
+
+    def ready(self):
+        # connects the signal receivers invalidating the cached plots
+        from . import plot_cache  # noqa: F401
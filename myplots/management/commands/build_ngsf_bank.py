@@ -0,0 +1,38 @@
+from pathlib import Path
+
+import NGSF
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from myplots.ngsf_bank import build_ngsf_bank
+
+ngsf_path = Path(NGSF.__path__[0])
+
+
+class Command(BaseCommand):
+    help = (
+        'Pack the NGSF template bank into memory-mapped arrays with a (SN, phase) index (NGSF_BANK_DIR), '
+        'used to build the NGSF template overlays'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--bank-dir', type=str, default=str(ngsf_path / 'bank/original_resolution'),
+            help="The NGSF bank's original_resolution directory"
+        )
+
+        parser.add_argument(
+            '--peak-file', type=str, default=str(ngsf_path / 'mjd_of_maximum_brightness.csv'),
+            help='CSV file with the MJD of maximum brightness of the SNe'
+        )
+
+        parser.add_argument(
+            '--output', type=str, default=settings.NGSF_BANK_DIR,
+            help='Directory of the packed bank (default: NGSF_BANK_DIR)'
+        )
+
+    def handle(self, *args, **kwargs):
+        n_templates, n_galaxies = build_ngsf_bank(kwargs['bank_dir'], kwargs['peak_file'], kwargs['output'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Packed {n_templates} SN templates and {n_galaxies} host-galaxy templates into {kwargs["output"]}'
+        ))
@@ -0,0 +1,70 @@
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from tom_dataproducts.models import ReducedDatum
+
+from myplots.template_matching import run_template_matching
+
+
+class Command(BaseCommand):
+    help = (
+        'Store the best-match SNID and NGSF templates of the spectra (on their wavelength grids), '
+        'read by the spectroscopy plots of the target pages'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--n', type=int, default=3,
+            help='Number of best matches stored per fitter'
+        )
+
+        parser.add_argument(
+            '--since', type=datetime.fromisoformat,
+            help='Only match spectra whose data product was modified at or after this ISO date/time'
+        )
+
+        parser.add_argument(
+            '--after-id', type=int,
+            help='Only match spectra whose ReducedDatum id is greater than this, e.g. those added by an ingestion run'
+        )
+
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Match spectra again even if they already have stored matches'
+        )
+
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of processes evaluating the fits'
+        )
+
+        parser.add_argument(
+            '--chunk-size', type=int, default=100,
+            help='Number of spectra whose matches are committed per transaction'
+        )
+
+    def handle(self, *args, **kwargs):
+        try:
+            spectroscopy_data_type = settings.DATA_PRODUCT_TYPES['spectroscopy'][0]
+        except (AttributeError, KeyError):
+            spectroscopy_data_type = 'spectroscopy'
+        datums = ReducedDatum.objects.filter(data_product__data_product_type=spectroscopy_data_type)
+        since = kwargs['since']
+        if since:
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+            datums = datums.filter(data_product__modified__gte=since)
+        if kwargs['after_id'] is not None:
+            datums = datums.filter(pk__gt=kwargs['after_id'])
+        if not kwargs['force']:
+            datums = datums.filter(template_matches__isnull=True)
+
+        matched, skipped, errors = run_template_matching(
+            datums, n=kwargs['n'], workers=kwargs['workers'], chunk_size=kwargs['chunk_size'],
+            log=lambda message: self.stderr.write(self.style.ERROR(message))
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f'Matched {matched} spectra ({skipped} without fit results, {errors} failed)'
+        ))
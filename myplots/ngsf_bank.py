@@ -0,0 +1,151 @@
+'''Packed, memory-mapped copy of the NGSF template bank, so that overlay templates are chosen and loaded without
+reading the bank's CSV and ASCII files'''
+
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from astropy.time import Time
+from django.conf import settings
+
+BANK_VERSION = 1
+INDEX_FILE = 'index.json'
+ARRAYS = ('sn_wave', 'sn_flux', 'gal_wave', 'gal_flux')
+
+
+def read_template_file(path):
+    """Wavelength and flux of an NGSF template ASCII file."""
+    temp_df = pd.read_csv(path, sep='\\s+', comment='#')
+    try:
+        temp_wave, temp_flux, _ = temp_df.values.T
+    except Exception:
+        temp_wave, temp_flux = temp_df.values.T
+    return temp_wave, temp_flux
+
+
+def read_peak_mjds(path):
+    """Dict of SN name -> MJD of maximum brightness (the first entry of each name)."""
+    max_df = pd.read_csv(path)
+    peak_mjds = {}
+    for name, mjd_peak in zip(max_df.Name.astype(str), max_df.mjd_peak.astype(float)):
+        peak_mjds.setdefault(name, mjd_peak)
+    return peak_mjds
+
+
+def build_ngsf_bank(bank_dir, peak_file, output_dir):
+    """
+    Packs the NGSF bank into ``output_dir``: all SN templates in one wavelength and one flux array, all host-galaxy
+    templates in two more, and an index with the offset of every template. SN templates are indexed by template
+    directory (e.g. ``'Ia/sn2011fe'``) and sorted by observer-frame days since peak, ``mjd - mjd_peak``.
+
+    :param bank_dir: the bank's ``original_resolution`` directory, with ``sne/<type>/<sn>/`` and ``gal/``
+    :param peak_file: ``mjd_of_maximum_brightness.csv``
+    :param output_dir: directory of the packed bank; it is replaced atomically
+    :returns: number of SN templates and of galaxy templates packed
+    """
+    bank_dir = Path(bank_dir)
+    peak_mjds = read_peak_mjds(peak_file)
+    arrays = {name: [] for name in ARRAYS}
+    offsets = {'sn': 0, 'gal': 0}
+
+    def pack(kind, wave, flux):
+        start = offsets[kind]
+        arrays[f'{kind}_wave'].append(np.asarray(wave, dtype=float))
+        arrays[f'{kind}_flux'].append(np.asarray(flux, dtype=float))
+        offsets[kind] += len(wave)
+        return [start, len(wave)]
+
+    templates = {}
+    for csv_path in sorted(bank_dir.glob('sne/*/*/wiserep_spectra.csv')):
+        temp_dir = csv_path.parent
+        temp_sn = temp_dir.name
+        if temp_sn not in peak_mjds:
+            continue
+        wiserep_df = pd.read_csv(csv_path)
+        days = Time(wiserep_df.JD.values, format='jd').mjd - peak_mjds[temp_sn]
+        entries = []
+        for day, temp_file in zip(days, wiserep_df['Ascii file'].values):
+            entries.append([float(day)] + pack('sn', *read_template_file(temp_dir / temp_file)))
+        templates[f'{temp_dir.parent.name}/{temp_sn}'] = sorted(entries)
+
+    galaxies = {}
+    for gal_file in sorted(path for path in (bank_dir / 'gal').iterdir() if path.is_file()):
+        gal_wave, gal_flux = np.loadtxt(gal_file).T
+        galaxies[gal_file.name] = pack('gal', gal_wave, gal_flux)
+
+    tmp_dir = f'{output_dir}.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for name, chunks in arrays.items():
+        np.save(os.path.join(tmp_dir, f'{name}.npy'), np.concatenate(chunks) if chunks else np.empty(0))
+    with open(os.path.join(tmp_dir, INDEX_FILE), 'w') as f:
+        json.dump({'version': BANK_VERSION, 'peak_mjds': peak_mjds, 'templates': templates,
+                   'galaxies': galaxies}, f)
+    old_dir = f'{output_dir}.old'
+    if os.path.exists(output_dir):
+        os.replace(output_dir, old_dir)
+    os.replace(tmp_dir, output_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+    return sum(len(entries) for entries in templates.values()), len(galaxies)
+
+
+class NGSFBank:
+    """
+    Read access to a packed NGSF bank. The arrays are memory-mapped, so only the pages of the templates used are read.
+    """
+    def __init__(self, directory):
+        with open(os.path.join(directory, INDEX_FILE)) as f:
+            index = json.load(f)
+        if index['version'] != BANK_VERSION:
+            raise ValueError(f'NGSF bank version {index["version"]} in {directory}; rebuild it with build_ngsf_bank')
+        self.peak_mjds = index['peak_mjds']
+        self.galaxies = index['galaxies']
+        self.templates = {}
+        for temp_dir, entries in index['templates'].items():
+            entries = np.array(entries)
+            # days since peak, offsets and lengths
+            self.templates[temp_dir] = (entries[:, 0], entries[:, 1:].astype(int))
+        for name in ARRAYS:
+            setattr(self, name, np.load(os.path.join(directory, f'{name}.npy'), mmap_mode='r'))
+
+    def sn_template(self, temp_dir, phase, z):
+        """
+        The template of ``temp_dir`` (e.g. ``'Ia/sn2011fe'``) closest to the rest-frame ``phase`` at redshift ``z``.
+
+        :returns: writable copies of the wavelength and flux arrays
+        """
+        days, spans = self.templates[temp_dir]
+        # phases = days / (1 + z), so the closest phase is the closest day
+        day = phase * (1 + z)
+        i = np.searchsorted(days, day)
+        if i == len(days) or (i > 0 and day - days[i - 1] <= days[i] - day):
+            i -= 1
+        start, length = spans[i]
+        return np.array(self.sn_wave[start:start + length]), np.array(self.sn_flux[start:start + length])
+
+    def galaxy(self, name):
+        """Writable copies of the wavelength and flux arrays of a host-galaxy template."""
+        start, length = self.galaxies[name]
+        return np.array(self.gal_wave[start:start + length]), np.array(self.gal_flux[start:start + length])
+
+
+_bank = None
+
+
+def get_ngsf_bank():
+    """
+    The packed bank in ``NGSF_BANK_DIR``, loaded once per process and reloaded if it is rebuilt; None if it was not
+    built.
+    """
+    global _bank
+    index_path = os.path.join(settings.NGSF_BANK_DIR, INDEX_FILE)
+    try:
+        mtime = os.stat(index_path).st_mtime_ns
+    except OSError:
+        return None
+    if _bank is None or _bank[0] != (index_path, mtime):
+        _bank = ((index_path, mtime), NGSFBank(settings.NGSF_BANK_DIR))
+    return _bank[1]
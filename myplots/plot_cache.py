@@ -0,0 +1,66 @@
+'''Cache of the figure JSON of the target plots, invalidated when the data of a target change'''
+
+import hashlib
+import json
+import os
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from tom_dataproducts.models import DataProduct, ReducedDatum
+
+
+def _generation_key(target_id):
+    return f'myplots:generation:{target_id}'
+
+
+def plot_cache_key(kind, target_id, datums, params=None, files=()):
+    """
+    Cache key of a plot of a target.
+
+    :param kind: name of the plot (e.g. ``'spectroscopy'``)
+    :param target_id: id of the target
+    :param datums: ``ReducedDatum`` queryset plotted
+    :param params: JSON-serializable plot options (decimation, user, ...)
+    :param files: paths of other inputs of the plot (e.g. template fits); their modification times are part of the key
+    """
+    signature = {
+        'generation': cache.get(_generation_key(target_id), 0),
+        'datums': list(datums.order_by('pk').values_list('pk', 'data_product__modified')),
+        'params': params or {},
+        'files': [(path, os.stat(path).st_mtime_ns if os.path.exists(path) else None) for path in sorted(files)],
+    }
+    digest = hashlib.sha1(json.dumps(signature, default=str, sort_keys=True).encode()).hexdigest()
+    return f'myplots:{kind}:{target_id}:{digest}'
+
+
+def cached_figure_json(key, build, timeout=None):
+    """
+    Returns the figure JSON cached under ``key``, building it with ``build()`` (which returns a figure or None) on a
+    miss. Empty plots are cached too.
+
+    :returns: the figure JSON, or None if there is nothing to plot
+    """
+    figure_json = cache.get(key)
+    if figure_json is None:
+        fig = build()
+        figure_json = fig.to_json() if fig is not None else ''
+        cache.set(key, figure_json, timeout if timeout is not None else settings.PLOT_CACHE_SECONDS)
+    return figure_json or None
+
+
+def bump_plot_generation(target_id):
+    """Drops the cached plots of a target, by moving it to a new cache generation."""
+    key = _generation_key(target_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 1, None)
+
+
+@receiver([post_save, post_delete], sender=DataProduct)
+@receiver([post_save, post_delete], sender=ReducedDatum)
+def invalidate_target_plots(sender, instance, **kwargs):
+    """Drops the cached plots of the target whose data changed."""
+    bump_plot_generation(instance.target_id)
@@ -0,0 +1,24 @@
+// Draws the plots whose figure JSON is served separately from the page:
+// every element with a data-figure-url attribute is filled with its figure.
+document.addEventListener("DOMContentLoaded", function () {
+    document.querySelectorAll("[data-figure-url]").forEach(div => {
+        fetch(div.dataset.figureUrl, { credentials: "same-origin" })
+            .then(response => {
+                if (!response.ok) throw new Error(`${response.status} ${response.statusText}`);
+                return response.status === 204 ? null : response.json();
+            })
+            .then(figure => {
+                if (!figure) {
+                    div.classList.remove("js-plotly-plot");
+                    div.textContent = div.dataset.emptyText || "No data to plot.";
+                    return;
+                }
+                Plotly.newPlot(div, figure.data, figure.layout, { responsive: true, showLink: false });
+            })
+            .catch(error => {
+                div.classList.remove("js-plotly-plot");
+                div.textContent = "The plot could not be loaded.";
+                console.error(`Error loading ${div.dataset.figureUrl}:`, error);
+            });
+    });
+});
@@ -0,0 +1,149 @@
+'''Batch stage collecting the SNID and NGSF fits of the spectra and storing their best-match templates, resampled onto
+the observed grid, so that target pages only read results'''
+
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from pathlib import Path
+
+import django
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Prefetch
+
+from custom_code.models import IngestedSpectrum, TemplateMatch
+from tom_dataproducts.models import ReducedDatum
+from tidestom.tides_utils.spectrum_storage import (CODEC, decode_array, defer_spectrum_values, encode_array,
+                                                   load_spectrum)
+from .plot_cache import bump_plot_generation
+from .templatetags.spectroscopy_settings import ngsf_template_matches, snid_template_matches
+
+MATCH_FIELDS = ('fitter', 'rank', 'name', 'sn_type', 'phase', 'redshift', 'extra')
+
+
+def find_fit_files(spectrum_path):
+    """
+    The fit results of a spectrum file available on disk: ``<name>_snid.h5`` in ``SNID_RESULTS_DIR`` and
+    ``<name>.csv`` in ``NGSF_RESULTS_DIR`` (both default to the directory of the spectrum).
+
+    :returns: dict of fitter -> path
+    """
+    spectrum_path = Path(spectrum_path)
+    fit_files = {
+        TemplateMatch.SNID: Path(settings.SNID_RESULTS_DIR or spectrum_path.parent) / f'{spectrum_path.stem}_snid.h5',
+        TemplateMatch.NGSF: Path(settings.NGSF_RESULTS_DIR or spectrum_path.parent) / f'{spectrum_path.stem}.csv',
+    }
+    return {fitter: str(path) for fitter, path in fit_files.items() if path.exists()}
+
+
+def original_spectrum_path(data_product):
+    """
+    The path of the file a spectroscopy ``DataProduct`` was ingested from, whose name and directory the fit results
+    follow. ``data_product.data`` is a content-addressed copy (``--dedup``) or a link under ``data/spectra``, so the
+    path comes from the ingestion ledger, falling back to the target of the link.
+
+    Use ``prefetch_related('ingested_files')`` on the queryset to fetch the ledger entries along with the products.
+    """
+    ingested = data_product.ingested_files.all()
+    if ingested:
+        return ingested[0].source_path
+    return os.path.realpath(os.path.join(settings.MEDIA_ROOT, data_product.data.name))
+
+
+def match_spectrum(datum_id, fit_files, wavelength, flux, n):
+    """
+    Computes the ``n`` best-match templates of each fitter for a spectrum. Runs in the worker processes.
+
+    :returns: the datum id, a list of (match info, encoded flux on the observed grid), and an error message or None
+    """
+    matchers = {TemplateMatch.SNID: snid_template_matches, TemplateMatch.NGSF: ngsf_template_matches}
+    try:
+        matches = []
+        for fitter, path in fit_files.items():
+            for info, template_flux in matchers[fitter](path, wavelength, flux, n):
+                matches.append((info, encode_array(template_flux)))
+        return datum_id, matches, None
+    except Exception as e:
+        return datum_id, [], f'ReducedDatum {datum_id}: {type(e).__name__}: {e}'
+
+
+def match_info(match):
+    """The info dict of a stored ``TemplateMatch``, as used by ``template_trace``."""
+    return {field: getattr(match, field) for field in MATCH_FIELDS}
+
+
+def match_flux(match):
+    """The flux of a stored ``TemplateMatch`` on its datum's wavelength grid."""
+    return decode_array(match.flux)
+
+
+def _tasks(datums, n, skipped):
+    for datum in datums.iterator(chunk_size=500):
+        fit_files = {}
+        if datum.data_product is not None and datum.data_product.data:
+            fit_files = find_fit_files(original_spectrum_path(datum.data_product))
+        if not fit_files:
+            skipped.append(datum.pk)
+            continue
+        spectrum = load_spectrum(datum)
+        yield datum.pk, fit_files, spectrum.wavelength, spectrum.flux, n
+
+
+def run_template_matching(datums, n=3, workers=1, chunk_size=100, log=print):
+    """
+    Stores the best-match templates of spectroscopy datums, replacing their previous matches. The fits are evaluated
+    in ``workers`` processes and the matches written in one transaction per ``chunk_size`` datums.
+
+    :param datums: ``ReducedDatum`` queryset
+    :param n: number of best matches stored per fitter
+    :param log: called with the error message of every datum that could not be matched
+    :returns: number of datums matched, skipped (no fit results) and failed
+    """
+    datums = defer_spectrum_values(datums.select_related('data_product', 'spectrum_array').order_by('pk'))
+    # the first file ingested into each product, as later copies are only linked to it
+    datums = datums.prefetch_related(Prefetch(
+        'data_product__ingested_files', queryset=IngestedSpectrum.objects.order_by('pk')
+    ))
+    skipped = []
+    matched = errors = 0
+    tasks = _tasks(datums, n, skipped)
+
+    executor = None
+    if workers > 1:
+        executor = ProcessPoolExecutor(
+            max_workers=workers, initializer=django.setup, mp_context=multiprocessing.get_context('spawn')
+        )
+    try:
+        while True:
+            chunk = list(islice(tasks, chunk_size))
+            if not chunk:
+                break
+            if executor is not None:
+                results = list(executor.map(match_spectrum, *zip(*chunk)))
+            else:
+                results = [match_spectrum(*task) for task in chunk]
+            for datum_id, _, error in results:
+                if error is not None:
+                    errors += 1
+                    log(error)
+            done = [(datum_id, matches) for datum_id, matches, error in results if error is None]
+            _store_matches(done)
+            matched += len(done)
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    return matched, len(skipped), errors
+
+
+def _store_matches(results):
+    datum_ids = [datum_id for datum_id, _ in results]
+    with transaction.atomic():
+        TemplateMatch.objects.filter(reduced_datum_id__in=datum_ids).delete()
+        TemplateMatch.objects.bulk_create([
+            TemplateMatch(reduced_datum_id=datum_id, codec=CODEC, flux=flux, **info)
+            for datum_id, matches in results for info, flux in matches
+        ])
+    # bulk inserts do not send post_save
+    for target_id in set(ReducedDatum.objects.filter(pk__in=datum_ids).values_list('target_id', flat=True)):
+        bump_plot_generation(target_id)
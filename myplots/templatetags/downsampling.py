@@ -0,0 +1,124 @@
+import numpy as np
+from django.conf import settings
+
+
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Selects points with the Largest-Triangle-Three-Buckets algorithm.
+
+    The first and last points are always kept. The remaining points are
+    split into ``n_out - 2`` buckets, and from each bucket the point forming
+    the largest triangle with the previously selected point and the mean
+    of the next bucket is kept, which preserves peaks and line features.
+
+    Parameters
+    ----------
+    x: x-axis data, sorted.
+    y: y-axis data.
+    n_out: number of points to keep.
+
+    Returns
+    -------
+    indices: sorted indices of the selected points.
+    """
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    # bucket edges of the points between the first and the last one
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    # mean of every bucket, used as the third vertex of the triangles
+    sizes = np.diff(edges)
+    mean_x = np.add.reduceat(x[1:n - 1], edges[:-1] - 1) / sizes
+    mean_y = np.add.reduceat(y[1:n - 1], edges[:-1] - 1) / sizes
+
+    indices = np.empty(n_out, dtype=int)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+        if i + 1 < n_out - 2:
+            next_x, next_y = mean_x[i + 1], mean_y[i + 1]
+        else:
+            next_x, next_y = x[-1], y[-1]
+        # twice the triangle areas; the factor is irrelevant for argmax
+        areas = np.abs(
+            (x[a] - next_x) * (y[start:stop] - y[a])
+            - (x[a] - x[start:stop]) * (next_y - y[a])
+        )
+        a = start + int(np.argmax(areas))
+        indices[i + 1] = a
+    return indices
+
+
+def minmax_indices(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """Selects the minimum and maximum of ``n_out // 2`` equal-size bins.
+
+    Faster than LTTB and keeps every extreme value, at the cost of a more
+    jagged look.
+
+    Parameters
+    ----------
+    x: x-axis data, sorted.
+    y: y-axis data.
+    n_out: maximum number of points to keep.
+
+    Returns
+    -------
+    indices: sorted indices of the selected points.
+    """
+    n = len(x)
+    n_bins = n_out // 2
+    if n_out >= n or n_bins < 1:
+        return np.arange(n)
+    y = np.asarray(y, dtype=float)
+    edges = np.linspace(0, n, n_bins + 1).astype(int)[:-1]
+    # position of each point within its bin
+    bins = np.repeat(np.arange(n_bins), np.diff(np.append(edges, n)))
+    order = np.lexsort((y, bins))
+    bin_starts = np.searchsorted(bins[order], np.arange(n_bins))
+    bin_stops = np.append(bin_starts[1:], n) - 1
+    indices = np.concatenate([order[bin_starts], order[bin_stops]])
+    return np.unique(indices)
+
+
+DOWNSAMPLING_METHODS = {'lttb': lttb_indices, 'minmax': minmax_indices}
+
+
+def downsample_indices(x: np.ndarray, y: np.ndarray,
+                       max_points: int | None = None,
+                       method: str | None = None) -> np.ndarray:
+    """Indices of the points of a trace to plot.
+
+    Non-finite points are dropped, and traces longer than ``max_points``
+    are decimated with ``method``.
+
+    Parameters
+    ----------
+    x: x-axis data, sorted.
+    y: y-axis data.
+    max_points: maximum number of points (``PLOT_MAX_POINTS`` by default).
+        Zero keeps every point.
+    method: 'lttb' or 'minmax' (``PLOT_DOWNSAMPLING`` by default).
+
+    Returns
+    -------
+    indices: sorted indices of the points to plot.
+    """
+    if max_points is None:
+        max_points = getattr(settings, 'PLOT_MAX_POINTS', 2000)
+    method = method or getattr(settings, 'PLOT_DOWNSAMPLING', 'lttb')
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    finite = np.flatnonzero(np.isfinite(x) & np.isfinite(y))
+    if not max_points or len(finite) <= max_points:
+        return finite
+    selected = DOWNSAMPLING_METHODS[method](x[finite], y[finite], max_points)
+    return finite[selected]
+
+
+def downsample(x: np.ndarray, y: np.ndarray, max_points: int | None = None,
+               method: str | None = None) -> tuple[np.ndarray, np.ndarray]:
+    """Decimated copy of a trace; see ``downsample_indices``."""
+    indices = downsample_indices(x, y, max_points, method)
+    return np.asarray(x)[indices], np.asarray(y)[indices]
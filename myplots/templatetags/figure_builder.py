@@ -0,0 +1,76 @@
+from functools import lru_cache
+
+import plotly.io as pio
+
+
+@lru_cache(maxsize=None)
+def layout_template(name: str) -> dict:
+    """The plotly layout template ``name`` as a plain dict."""
+    return pio.templates[name].to_plotly_json()
+
+
+def scatter(**kwargs) -> dict:
+    """A scatter trace as a plain dict. Unset (None) attributes are left out,
+    as plotly does."""
+    trace = {key: value for key, value in kwargs.items() if value is not None}
+    trace['type'] = 'scatter'
+    return trace
+
+
+def deep_update(target: dict, updates: dict) -> dict:
+    """Recursively merges ``updates`` into ``target``."""
+    for key, value in updates.items():
+        if isinstance(value, dict) and isinstance(target.get(key), dict):
+            deep_update(target[key], value)
+        else:
+            target[key] = value
+    return target
+
+
+class FigureDict:
+    """A plotly figure kept as plain dicts.
+
+    It implements the few ``go.Figure`` methods used to build the plots of
+    this app, without the graph-object validation of every trace and
+    attribute, which dominates the cost of building large figures. The
+    output renders the same as the equivalent ``go.Figure``: the default
+    layout template is included, and ``add_vline`` produces the same shapes
+    and annotations.
+    """
+    def __init__(self, template: str | None = None):
+        self.data = []
+        self.layout = {'template': layout_template(template or pio.templates.default)}
+
+    def add_trace(self, trace: dict) -> 'FigureDict':
+        self.data.append(trace)
+        return self
+
+    def update_layout(self, layout: dict) -> 'FigureDict':
+        """Merges nested layout attributes (no magic underscores)."""
+        deep_update(self.layout, layout)
+        return self
+
+    def add_vline(self, x: float, line_width: float | None = None, line_dash: str | None = None,
+                  line_color: str | None = None, annotation_text: str | None = None,
+                  annotation_position: str = 'top right') -> 'FigureDict':
+        """Vertical line across the plot, with an optional annotation on top."""
+        line = {key: value for key, value in (('color', line_color), ('dash', line_dash), ('width', line_width))
+                if value is not None}
+        self.layout.setdefault('shapes', []).append({
+            'line': line, 'type': 'line', 'x0': x, 'x1': x, 'xref': 'x', 'y0': 0, 'y1': 1, 'yref': 'y domain',
+        })
+        if annotation_text is not None:
+            vertical, horizontal = annotation_position.split()
+            self.layout.setdefault('annotations', []).append({
+                'showarrow': False, 'text': annotation_text, 'x': x,
+                # text on the opposite side of the line to its position
+                'xanchor': 'right' if horizontal == 'left' else 'left', 'xref': 'x',
+                'y': 1 if vertical == 'top' else 0, 'yanchor': vertical, 'yref': 'y domain',
+            })
+        return self
+
+    def to_plotly_json(self) -> dict:
+        return {'data': self.data, 'layout': self.layout}
+
+    def to_json(self) -> str:
+        return pio.to_json(self.to_plotly_json(), validate=False)
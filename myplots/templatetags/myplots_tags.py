@@ -1,28 +1,48 @@
+import hashlib
 import warnings
+from functools import lru_cache
+from urllib.parse import urlencode
+
 import numpy as np
-from plotly import offline
-import plotly.graph_objs as go
+from plotly.offline import get_plotlyjs
 from datetime import datetime
 from astropy.time import Time
 from django import template
 from django.conf import settings
+from django.templatetags.static import static
+from django.urls import reverse
+from django.utils.html import format_html
 
 from tom_dataproducts.models import DataProduct, ReducedDatum
 from guardian.shortcuts import get_objects_for_user
-from tom_dataproducts.processors.data_serializers import SpectrumSerializer
+from tidestom.tides_utils.spectrum_storage import defer_spectrum_values, load_spectrum
 
 from tidestom.settings import BROKERS
 lasair_token = BROKERS['LASAIR']['api_key']
-from .spectroscopy_settings import add_snid_templates, add_ngsf_templates
-from .photometry_settings import plot_lightcurves, fetch_ztf_lasair
+from .spectroscopy_settings import template_trace
+from .photometry_settings import lightcurves_figure, fetch_ztf_lasair
+from .figure_builder import FigureDict, scatter
+from .downsampling import downsample
+from ..template_matching import match_info, match_flux
 
 register = template.Library()
 
-@register.inclusion_tag('myplots/target_spectroscopy.html', takes_context=True)
-def target_spectroscopy(context, target, dataproduct=None):
+
+@lru_cache(maxsize=1)
+def plotly_js_bundle():
+    """The plotly.js bundle of the installed plotly version, and its short content hash."""
+    bundle = get_plotlyjs()
+    return bundle, hashlib.sha1(bundle.encode()).hexdigest()[:12]
+
+
+def plotly_js_digest():
+    return plotly_js_bundle()[1]
+
+
+def spectroscopy_datums(target, user, dataproduct=None):
     """
-    Renders a spectroscopic plot for a ``Target``. If a ``DataProduct`` is specified, it will only render a plot with
-    that spectrum.
+    The spectroscopic ``ReducedDatum``s of a ``Target`` that the user can view, oldest first. If a ``DataProduct`` is
+    specified, only that spectrum is returned.
     """
     try:
         spectroscopy_data_type = settings.DATA_PRODUCT_TYPES['spectroscopy'][0]
@@ -31,23 +51,35 @@ def target_spectroscopy(context, target, dataproduct=None):
     spectral_dataproducts = DataProduct.objects.filter(target=target,
                                                        data_product_type=spectroscopy_data_type)
     if dataproduct:
-        spectral_dataproducts = DataProduct.objects.get(data_product=dataproduct)
+        spectral_dataproducts = spectral_dataproducts.filter(pk=getattr(dataproduct, 'pk', dataproduct))
+    datums = ReducedDatum.objects.filter(data_product__in=spectral_dataproducts).order_by('timestamp', 'pk')
     if settings.TARGET_PERMISSIONS_ONLY:
-        datums = ReducedDatum.objects.filter(data_product__in=spectral_dataproducts)
-    else:
-        datums = get_objects_for_user(context['request'].user,
-                                      'tom_dataproducts.view_reduceddatum',
-                                      klass=ReducedDatum.objects.filter(data_product__in=spectral_dataproducts))
+        return datums
+    return get_objects_for_user(user, 'tom_dataproducts.view_reduceddatum', klass=datums)
+
+
+def spectroscopy_figure(target, user, dataproduct=None, max_points=None):
+    """
+    Builds the spectroscopic plot of a ``Target``: its spectra and the best-matching templates of the last one. If a
+    ``DataProduct`` is specified, only that spectrum is plotted.
+
+    :returns: the figure, or None if there are no spectra to plot
+    """
+    datums = spectroscopy_datums(target, user, dataproduct)
+    datums = list(defer_spectrum_values(datums.select_related('spectrum_array')))
+    if not datums:
+        return None
     
     # Create a figure
-    fig = go.Figure()
+    fig = FigureDict()
     
     # add spectra
-    for datum in datums:
-        deserialized = SpectrumSerializer().deserialize(datum.value)
-        fig.add_trace(go.Scatter(
-            x=deserialized.wavelength.value,
-            y=deserialized.flux.value,
+    spectra = [load_spectrum(datum) for datum in datums]
+    for spectrum in spectra:
+        wave, flux = downsample(spectrum.wavelength, spectrum.flux, max_points)
+        fig.add_trace(scatter(
+            x=wave,
+            y=flux,
             #name=datetime.strftime(datum.timestamp, '%Y%m%d-%H:%M:%s'), 
             #name=target.name, 
             showlegend=False,
@@ -55,63 +87,90 @@ def target_spectroscopy(context, target, dataproduct=None):
             line=dict(color="grey")
         ))
     
-    # add templates - best matches
-    # SNID - mock templates for now
-    data_mean = np.mean(deserialized.flux.value)
-    pysnid_file = '/home/tomas/Softwares/tests/pysnid/l1_obs_joined_87178841_snid.h5'
-    fig = add_snid_templates(pysnid_file,
-                             deserialized.wavelength.value, 
-                             deserialized.flux.value, 
-                             fig, 
-                             n=3
-                             )
-    
-    # NGSF - mock templates for now
-    ngsf_file = '/home/tomas/Softwares/tests/ngsf/l1_obs_joined_87178841.csv'
-    fig = add_ngsf_templates(ngsf_file, 
-                             deserialized.wavelength.value, 
-                             deserialized.flux.value, 
-                             fig, 
-                             n=3
-                             )
+    # add templates - best matches of the latest spectrum, stored by `manage.py match_templates`
+    latest, latest_spectrum = datums[-1], spectra[-1]
+    for match in latest.template_matches.all():
+        fig.add_trace(template_trace(match_info(match), latest_spectrum.wavelength, match_flux(match), max_points))
     
-    fig.update_layout(autosize=True, 
-                      xaxis_title='Observed Wavelength (Å)',
-                      yaxis_title='Flux (erg/s/cm²/Å)',
-                      xaxis = dict(showticklabels=True, ticks='outside', linewidth=2),
-                      yaxis = dict(showticklabels=True, ticks='outside', linewidth=2),
-                      legend_title="Best Templates",
-                      showlegend=True,
-                      )
+    fig.update_layout(dict(autosize=True, 
+                           xaxis=dict(title=dict(text='Observed Wavelength (Å)'),
+                                      showticklabels=True, ticks='outside', linewidth=2),
+                           yaxis=dict(title=dict(text='Flux (erg/s/cm²/Å)'),
+                                      showticklabels=True, ticks='outside', linewidth=2),
+                           legend=dict(title=dict(text="Best Templates")),
+                           showlegend=True,
+                           ))
 
+    return fig
+
+
+@register.inclusion_tag('myplots/target_spectroscopy.html', takes_context=True)
+def target_spectroscopy(context, target, dataproduct=None):
+    """
+    Renders the container of the spectroscopic plot of a ``Target``. The figure itself is fetched from the
+    ``spectroscopy_figure`` endpoint and drawn client-side. If a ``DataProduct`` is specified, it will only render a
+    plot with that spectrum. Traces are decimated to ``PLOT_MAX_POINTS`` points unless the page is requested with
+    ``?full_resolution=1``.
+    """
+    params = {'dataproduct': getattr(dataproduct, 'pk', dataproduct)} if dataproduct else {}
     return {
         'target': target,
-        'plot': offline.plot(fig, output_type='div', show_link=False)
+        'figure_url': figure_url('spectroscopy_figure', target, context, params),
+        'full_resolution': not plot_max_points(context.get('request')),
     }
 
 
+def plot_max_points(request):
+    """Maximum number of points per trace: ``PLOT_MAX_POINTS``, or 0 (no decimation) if the page was requested with
+    ``?full_resolution=1``."""
+    if request is not None and request.GET.get('full_resolution'):
+        return 0
+    return settings.PLOT_MAX_POINTS
+
+
+def figure_url(view_name, target, context, params=None):
+    """URL of the figure JSON of a plot, passing on the ``full_resolution`` flag of the page."""
+    params = dict(params or {})
+    if not plot_max_points(context.get('request')):
+        params['full_resolution'] = 1
+    url = reverse(view_name, args=[target.pk])
+    return f'{url}?{urlencode(params)}' if params else url
+
+
+@register.simple_tag
+def plotly_js():
+    """
+    Script tags loading plotly.js, served once under a content-hashed URL so that browsers can cache it, and the
+    loader drawing the plots whose figures are fetched from ``data-figure-url``.
+    """
+    return format_html(
+        '<script src="{}"></script>\n<script src="{}"></script>',
+        reverse('plotly_js', args=[plotly_js_digest()]), static('myplots/js/figures.js')
+    )
+
+
 ##############
 # Photometry #
 ##############
 
-@register.inclusion_tag('myplots/target_photometry.html', takes_context=True)
-def target_photometry(context, target, dataproduct=None):
+def photometry_figure(target, max_points=None):
     """
-    Renders a photometry plot for a ``Target``. If a ``DataProduct`` is specified, it will only render a plot with
-    that photometry.
+    Builds the photometry plot of a ``Target``, with the epochs of its spectra.
+
+    :returns: the figure, or None if there is no photometry to plot
     """
     # check if the Lasair's API key is set
     if lasair_token is None or lasair_token == "":
         warnings.warn("Warning: Lasair API key not set!", UserWarning)
-        return {'target': target}
+        return None
     
     photometry = fetch_ztf_lasair(49.1384664, 44.9725084)  # ZTF25aacedrs for testing
     #photometry = fetch_ztf_lasair(target.ra, target.dec)
     if photometry is None:
-        return {'target': target}
+        return None
     
     # plot photometry
-    fig = plot_lightcurves(photometry)
+    fig = lightcurves_figure(photometry, max_points=max_points)
     
     # add epochs with spectra
     try:
@@ -125,8 +184,21 @@ def target_photometry(context, target, dataproduct=None):
         mjd = Time(datum.timestamp, scale="utc").mjd
         fig.add_vline(mjd, line_width=2, line_dash="dot", line_color="black", 
                             annotation_text="s", annotation_position="top left")
-        
+    return fig
+
+
+@register.inclusion_tag('myplots/target_photometry.html', takes_context=True)
+def target_photometry(context, target, dataproduct=None):
+    """
+    Renders the container of the photometry plot of a ``Target``, whose figure is fetched from the
+    ``photometry_figure`` endpoint. Dense light curves are decimated as in ``target_spectroscopy``.
+    """
+    # check if the Lasair's API key is set
+    if lasair_token is None or lasair_token == "":
+        warnings.warn("Warning: Lasair API key not set!", UserWarning)
+        return {'target': target}
     return {
         'target': target,
-        'plot': offline.plot(fig, output_type='div', show_link=False)
-    }
\ No newline at end of file
+        'figure_url': figure_url('photometry_figure', target, context),
+        'full_resolution': not plot_max_points(context.get('request')),
+    }
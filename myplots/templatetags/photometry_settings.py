@@ -6,6 +6,8 @@ from astropy.time import Time
 import plotly.graph_objects as go
 
 from lasair import lasair_client
+from .downsampling import downsample_indices
+from .figure_builder import FigureDict, scatter
 from tidestom.settings import BROKERS
 lasair_token = BROKERS['LASAIR']['api_key']
 lasair_api_url = "https://lasair-ztf.lsst.ac.uk/api"
@@ -286,8 +288,19 @@ def create_toggling_buttons(fig: go.Figure) -> list[dict, dict]:
     ]
     return buttons
 
-def plot_lightcurves(photometry: pd.DataFrame) -> go.Figure:
-    """Plots the light curves for a transient.
+FILTER_COLOURS = {"ztf_g":"green", "ztf_r":"red", "ztf_i":"gold",
+                  "gaia_G":"purple",
+                  "atlas_c":"cyan", "atlas_o":"orange",
+                  "neowise_W1":"navy", "neowise_W2":"darkred", 
+                  "neowise_W3":"indigo", "neowise_W4":"darkslategrey",
+                  "tess":"black",
+                  "goto_L":"purple",
+                  "ps1_g":"green", "ps1_r":"red", "ps1_i":"gold",
+                  "clear(VegaMag)":"skyblue",
+                 }
+
+def prepare_photometry(photometry: pd.DataFrame) -> pd.DataFrame:
+    """Adds the flux and display columns used by the light-curve plots.
 
     Parameter
     ---------
@@ -295,18 +308,8 @@ def plot_lightcurves(photometry: pd.DataFrame) -> go.Figure:
 
     Returns
     -------
-    fig: plot figure.
+    photometry: the same dataframe, updated.
     """
-    colour_dict = {"ztf_g":"green", "ztf_r":"red", "ztf_i":"gold",
-                   "gaia_G":"purple",
-                   "atlas_c":"cyan", "atlas_o":"orange",
-                   "neowise_W1":"navy", "neowise_W2":"darkred", 
-                   "neowise_W3":"indigo", "neowise_W4":"darkslategrey",
-                   "tess":"black",
-                   "goto_L":"purple",
-                   "ps1_g":"green", "ps1_r":"red", "ps1_i":"gold",
-                   "clear(VegaMag)":"skyblue",
-                  }
     # add extra columns for displaying purposes
     photometry["Filter"] = photometry["filter"].values
     photometry["MJD"] = photometry["mjd"].values
@@ -331,18 +334,58 @@ def plot_lightcurves(photometry: pd.DataFrame) -> go.Figure:
     for col in photometry.columns:
         if photometry[col].dtype == float:
             photometry[col] = photometry[col].apply(lambda x: np.round(x, 3))
+    return photometry
+
+def decimate_photometry(df: pd.DataFrame, column: str, max_points: int | None = None) -> pd.DataFrame:
+    """Decimates dense light curves, keeping their features.
+
+    Parameters
+    ----------
+    df: light-curve photometry of a single filter, sorted by MJD.
+    column: column used in the y axis.
+    max_points: maximum number of points (see ``downsample_indices``).
+
+    Returns
+    -------
+    df: decimated photometry. Rows without a ``column`` value are dropped
+        if the light curve is decimated.
+    """
+    # the points are picked among the rows with a value only, as filling in missing values would add spurious
+    # extremes that LTTB favours; the indices are then mapped back to the rows of ``df``
+    y = df[column].to_numpy(dtype=float, na_value=np.nan)
+    valid = np.flatnonzero(np.isfinite(y))
+    indices = valid[downsample_indices(df['mjd'].values[valid], y[valid], max_points)]
+    if len(indices) == len(valid):
+        # not decimated: rows with missing values are kept, as they are still shown on hover
+        return df
+    return df.iloc[indices]
+
+def plot_lightcurves(photometry: pd.DataFrame, max_points: int | None = None) -> go.Figure:
+    """Plots the light curves for a transient.
+
+    Parameter
+    ---------
+    photometry: transient dataframe with photometry.
+    max_points: maximum number of detections and of upper limits per filter
+        (see ``downsample_indices``).
+
+    Returns
+    -------
+    fig: plot figure.
+    """
+    photometry = prepare_photometry(photometry)
     
     ########################
     # Initialize the figure
     fig = go.Figure()
     
     # Add traces for each filter
-    for i, (filter, colour) in enumerate(colour_dict.items()):
+    for i, (filter, colour) in enumerate(FILTER_COLOURS.items()):
         filt_df = photometry[photometry["Filter"]==filter]
         # split detections and non-detections
         det_mask = ~filt_df.mag.isna()
-        det_df = filt_df[det_mask]
-        nondet_df = filt_df[~det_mask]
+        det_df = decimate_photometry(filt_df[det_mask], 'mag', max_points)
+        nondet_df = decimate_photometry(filt_df[~det_mask], 'upper_mag', max_points)
     
         # hover templates
         hovertemp_mag = get_hovertemplates(det_df, columns=["Filter", "UTC", "MJD", "Mag", "MagErr"])
@@ -411,3 +454,79 @@ def plot_lightcurves(photometry: pd.DataFrame) -> go.Figure:
     )
     
     return fig
+
+def lightcurves_figure(photometry: pd.DataFrame, max_points: int | None = None) -> FigureDict:
+    """Plots the light curves for a transient, as ``plot_lightcurves`` does,
+    but built from plain dicts (see ``FigureDict``) and without the traces
+    of filters or upper limits with no data.
+
+    Parameter
+    ---------
+    photometry: transient dataframe with photometry.
+    max_points: maximum number of detections and of upper limits per filter
+        (see ``downsample_indices``).
+
+    Returns
+    -------
+    fig: plot figure.
+    """
+    photometry = prepare_photometry(photometry)
+    hovertemp_mag = get_hovertemplates(photometry, columns=["Filter", "UTC", "MJD", "Mag", "MagErr"])
+    hovertemp_flux = get_hovertemplates(photometry, columns=["Filter", "UTC", "MJD", "Flux", "FluxErr"])
+    hovertemp_lim = {
+        'mag': get_hovertemplates(photometry, columns=["Filter", "UTC", "MJD", "MagLimit"]),
+        'flux': get_hovertemplates(photometry, columns=["Filter", "UTC", "MJD", "FluxLimit"]),
+    }
+    filters = dict(tuple(photometry.groupby("Filter", sort=False)))
+
+    fig = FigureDict()
+    for filter, colour in FILTER_COLOURS.items():
+        if filter not in filters:
+            continue
+        filt_df = filters[filter]
+        # split detections and non-detections
+        det_mask = ~filt_df.mag.isna()
+        det_df = decimate_photometry(filt_df[det_mask], 'mag', max_points)
+        nondet_df = decimate_photometry(filt_df[~det_mask], 'upper_mag', max_points)
+        for phot_type, hovertemplate in (('mag', hovertemp_mag), ('flux', hovertemp_flux)):
+            legendgroup = f"{filter}_{phot_type}"
+            # only magnitudes are shown initially
+            visible = phot_type == 'mag'
+            if len(det_df) > 0:
+                x, y = det_df['mjd'].values, det_df[phot_type].values
+                fig.add_trace(scatter(x=x, y=y, mode='markers', name=filter, marker=dict(color=colour),
+                                      customdata=det_df.values, hovertemplate=hovertemplate,
+                                      legendgroup=legendgroup, visible=visible))
+                # error bars - "legendgroup" needs to match the photometry so their legends are connected
+                fig.add_trace(scatter(x=x, y=y, mode='lines', name=filter, line=dict(width=0),
+                                      error_y=dict(type='data', symmetric=True,
+                                                   array=det_df[f'{phot_type}_err'].values, color=colour),
+                                      showlegend=False, legendgroup=legendgroup, visible=visible))
+            if len(nondet_df) > 0:
+                fig.add_trace(scatter(x=nondet_df['mjd'].values, y=nondet_df[f'upper_{phot_type}'].values,
+                                      mode='markers', name=filter,
+                                      marker=dict(color=colour, size=12, symbol="triangle-down-open"),
+                                      opacity=0.7, customdata=nondet_df.values,
+                                      hovertemplate=hovertemp_lim[phot_type], showlegend=False,
+                                      legendgroup=legendgroup, visible=visible))
+
+    mag_visibility = ["flux" not in trace['legendgroup'] for trace in fig.data]
+    flux_visibility = ["mag" not in trace['legendgroup'] for trace in fig.data]
+    buttons = [
+        dict(label='Magnitude', method='update',
+             args=[{'visible': mag_visibility}, {'yaxis': {'title': 'AB Magnitude', 'autorange': 'reversed'}}]),
+        dict(label='Flux', method='update',
+             args=[{'visible': flux_visibility}, {'yaxis': {'title': 'Flux (μJy)'}}]),
+    ]
+    fig.update_layout({
+        'xaxis': {'title': {'text': "Modified Julian Date"}, 'tickformat': '%d'},
+        'yaxis': {'title': {'text': "AB Magnitude"}, 'autorange': 'reversed'},
+        'width': 700,
+        'height': 500,
+        'font': {'family': "P052", 'size': 16},
+        'updatemenus': [
+            dict(type='buttons', showactive=True, buttons=buttons, direction='left',
+                 x=0.15, y=1.15, xanchor='center', yanchor='top')
+        ],
+    })
+    return fig
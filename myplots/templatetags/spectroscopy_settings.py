@@ -1,12 +1,22 @@
+import os
 import re
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
 import numpy as np
 import pandas as pd
 from pathlib import Path
 
 import extinction
-from extinction import apply
 from astropy.time import Time
-import plotly.graph_objs as go
+from django.conf import settings
+
+from myplots.ngsf_bank import get_ngsf_bank, read_template_file
+from .downsampling import downsample
+from .figure_builder import FigureDict, scatter
 
 import pysnid
 from pysnid.snid import SNIDReader
@@ -15,6 +25,8 @@ import NGSF
 ngsf_path = Path(NGSF.__path__[0])
 max_df = pd.read_csv(ngsf_path / 'mjd_of_maximum_brightness.csv')
 
+logger = logging.getLogger(__name__)
+
 def match_grid(x_pred: np.ndarray, x: np.ndarray, y: np.ndarray) -> np.ndarray:
     """Interpolates values to match a desired grip.
     
@@ -34,6 +46,19 @@ def match_grid(x_pred: np.ndarray, x: np.ndarray, y: np.ndarray) -> np.ndarray:
     y_pred = np.interp(x_pred, x, y, left=np.nan, right=np.nan)
     return x_pred.copy(), y_pred
 
+class WaveGrid:
+    """Hashable wrapper of a wavelength grid, hashed by its contents, to use
+    grids as cache keys."""
+    def __init__(self, wave: np.ndarray):
+        self.wave = np.ascontiguousarray(wave, dtype=float)
+        self.digest = hashlib.blake2b(self.wave.tobytes(), digest_size=16).digest()
+
+    def __hash__(self):
+        return hash(self.digest)
+
+    def __eq__(self, other):
+        return isinstance(other, WaveGrid) and self.digest == other.digest
+
 ##################
 # SNID templates #
 ##################
@@ -52,8 +77,145 @@ def get_pysnid_results(inputfile: str) -> SNIDReader:
     snidres = SNIDReader.from_filename(inputfile)
     return snidres
 
+class SizeBoundedLRU:
+    """Thread-safe LRU mapping bounded by the total size of its values.
+
+    Parameters
+    ----------
+    max_bytes: the least recently used entries are evicted once the values
+        take more than this.
+    """
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key][0]
+
+    def set(self, key, value, nbytes: int):
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= self._entries.pop(key)[1]
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes and len(self._entries) > 1:
+                self.nbytes -= self._entries.popitem(last=False)[1][1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+_snid_cache = SizeBoundedLRU(getattr(settings, 'SNID_CACHE_MAX_BYTES', 64 * 1024 ** 2))
+
+def get_snid_models(pysnid_file: str, obs_wave: np.ndarray, n: int = 3) -> list[tuple[dict, np.ndarray]]:
+    """Best-match SNID models, flux-corrected and matched to the observed grid.
+
+    The models are cached per process, keyed on the file path and
+    modification time, the observed grid and ``n``, so repeat renders do
+    not read the file again. The cache holds at most
+    ``SNID_CACHE_MAX_BYTES`` of models.
+
+    Parameters
+    ----------
+    pysnid_file: Pysnid output file ('.h5' extension).
+    obs_wave: Observed spectrum wavelength.
+    n: Number of best-match templates, sorted by reduced chi square.
+
+    Returns
+    -------
+    models: template info (sn, type, age) and model flux on the observed grid,
+        normalised back but not yet scaled to the observed flux, of each
+        best match.
+    """
+    grid = WaveGrid(obs_wave)
+    key = (str(pysnid_file), os.stat(pysnid_file).st_mtime_ns, grid, n)
+    models = _snid_cache.get(key)
+    if models is None:
+        snidres = get_pysnid_results(pysnid_file)
+        models = []
+        for i in range(1, n + 1):
+            model_df = snidres.get_modeldata(i, fluxcorr=True)
+            # normalise back and match observed grid
+            _, model_flux = match_grid(obs_wave, model_df.wavelength.values, model_df.flux.values / 1.05)
+            model_flux.setflags(write=False)
+            temp_info = snidres.results.iloc[i]
+            models.append(({'sn': temp_info.sn, 'type': temp_info.type, 'age': temp_info.age}, model_flux))
+        # the key keeps the observed grid alive too
+        _snid_cache.set(key, models, grid.wave.nbytes + sum(model_flux.nbytes for _, model_flux in models))
+    return models
+
+def snid_template_matches(pysnid_file: str, obs_wave: np.ndarray, obs_flux: np.ndarray,
+                          n: int = 3) -> list[tuple[dict, np.ndarray]]:
+    """Best-match SNID templates on the observed grid.
+
+    Parameters
+    ----------
+    pysnid_file: Pysnid output file ('.h5' extension).
+    obs_wave: Observed spectrum wavelength.
+    obs_flux: Observed spectrum flux.
+    n: Number of best-match templates, sorted by reduced chi square.
+
+    Returns
+    -------
+    matches: template info (see ``template_trace``) and flux on the observed
+        grid, scaled to the observed spectrum, of each best match.
+    """
+    mean = np.nanmean(obs_flux)
+    matches = []
+    for rank, (temp_info, model_flux) in enumerate(get_snid_models(pysnid_file, obs_wave, n), start=1):
+        info = {'fitter': 'snid', 'rank': rank, 'name': str(temp_info['sn']), 'sn_type': str(temp_info['type']),
+                'phase': float(temp_info['age']), 'redshift': None, 'extra': {}}
+        matches.append((info, model_flux * mean))
+    return matches
+
+def template_trace(info: dict, wave: np.ndarray, flux: np.ndarray, max_points: int | None = None) -> dict:
+    """Trace of a best-match template.
+
+    Parameters
+    ----------
+    info: fitter ('snid' or 'ngsf'), rank, name, sn_type, phase, redshift
+        and extra (NGSF's A_v, host and SN fraction) of the match.
+    wave: Observed spectrum wavelength.
+    flux: Template flux on the observed grid.
+    max_points: Maximum number of points (see ``downsample``).
+
+    Returns
+    -------
+    trace: template trace, hidden until selected in the legend.
+    """
+    wave, flux = downsample(wave, flux, max_points)
+    if info['fitter'] == 'snid':
+        name = f"{info['rank']}. {info['name']}<br>{info['sn_type']} (SNID)"
+        hovertemplate = (f"Name: {info['name']}<br>Type: {info['sn_type']}<br>"
+                         f"Phase: {info['phase']:g} d<br>Wave.:%{{x}}")
+    else:
+        extra = info['extra']
+        name = f"{info['rank']}. {info['name']}<br>{info['sn_type']} (NGSF)"
+        hovertemplate = (f"Name: {info['name']}<br>Type: {info['sn_type']}<br>"
+                         f"Phase: {info['phase']}<br>"
+                         f"redshift: {info['redshift']}<br>Av: {extra['A_v']}<br>"
+                         f"Host: {extra['host']}<br>SN frac.: {extra['sn_fraction'] * 100:.1f}%<br>"
+                         f"dWave.:%{{x}}<br>"
+                         )
+    return scatter(
+        x=wave,
+        y=flux,
+        name=name,
+        hovertemplate=hovertemplate,
+        showlegend=True,
+        visible='legendonly',
+    )
+
 def add_snid_templates(pysnid_file: str, obs_wave: np.ndarray, obs_flux: np.ndarray, 
-                       fig: go.Figure, n: int = 3) -> go.Figure:
+                       fig: FigureDict, n: int = 3, max_points: int | None = None) -> FigureDict:
     """Adds best-match SNID templates to the figure.
 
     Parameters
@@ -63,72 +225,89 @@ def add_snid_templates(pysnid_file: str, obs_wave: np.ndarray, obs_flux: np.ndar
     obs_flux: Observed spectrum flux.
     fig: Figure with the plot.
     n: Number of best-match templates, sorted by reduced chi square.
+    max_points: Maximum number of points per template (see ``downsample``).
 
     Returns:
     fig: Updated figure with SNID templates.
     """
-    mean = np.nanmean(obs_flux)
-    snidres = get_pysnid_results(pysnid_file)
-    for i in range(1, n + 1):
-        model_df = snidres.get_modeldata(i, fluxcorr=True)
-        model_wave = model_df.wavelength.values
-        model_flux = model_df.flux.values
-        # normalise back
-        model_flux /= 1.05
-        model_flux *= mean
-        # match observed grid
-        model_wave, model_flux = match_grid(obs_wave, model_wave, model_flux)
-        
-        temp_info = snidres.results.iloc[i]
-        fig.add_trace(go.Scatter(
-            x=model_wave,
-            y=model_flux,
-            name=f"{i}. {temp_info.sn}<br>{temp_info.type} (SNID)",
-            hovertemplate=(f'Name: {temp_info.sn}<br>Type: {temp_info.type}<br>'
-                           f'Phase: {temp_info.age} d<br>Wave.:%{{x}}'),
-            showlegend=True,
-            visible='legendonly',
-        ))
+    for info, flux in snid_template_matches(pysnid_file, obs_wave, obs_flux, n):
+        fig.add_trace(template_trace(info, obs_wave, flux, max_points))
     return fig
 
 ##################
 # NGSF templates #
 ##################
 
+@lru_cache(maxsize=256)
+def _extinction_curve(grid: WaveGrid, A_v: float, R_v: float) -> np.ndarray:
+    curve = 10 ** (-0.4 * extinction.ccm89(grid.wave, A_v, R_v))
+    # shared between callers
+    curve.setflags(write=False)
+    return curve
+
 # function from NGSF, but written locally as the other one fails to import
 def Alam(lamin, A_v: float = 1, R_v: float = 3.1) -> np.ndarray:
     """Add extinction with R_v = 3.1 and A_v = 1, A_v = 1 in order
     to find the constant of proportionality for
     the extinction law.
 
+    The curve is computed once per wavelength grid (hashed by its contents)
+    and ``R_v``, and cached; the returned array is read-only.
+
     Returns
     -------
     redreturn: extincted flux.
     """
-    flux = np.ones(len(lamin))
-    flux = [float(x) for x in flux]
-    lamin = np.array([float(i) for i in lamin])
-    redreturn = apply(extinction.ccm89(lamin, A_v, R_v), flux)
+    return _extinction_curve(WaveGrid(lamin), float(A_v), float(R_v))
 
-    return redreturn
+def find_ngsf_template(temp_dir: Path, temp_sn: str, temp_phase: float, z: float) -> tuple[np.ndarray, np.ndarray]:
+    """Reads the template of an SN closest to a phase from the NGSF bank files.
 
-def add_ngsf_templates(ngsf_file: str, obs_wave: np.ndarray, obs_flux: np.ndarray, 
-                       fig: go.Figure, n: int = 3) -> go.Figure:
-    """Adds best-match NGSF templates to the figure.
+    Used when the packed bank (see ``build_ngsf_bank``) is not available, or does not have the template.
+
+    Parameters
+    ----------
+    temp_dir: directory of the SN templates.
+    temp_sn: SN name.
+    temp_phase: rest-frame phase.
+    z: redshift.
+
+    Returns
+    -------
+    temp_wave, temp_flux: template wavelength and flux.
+    """
+    mjd_peak = max_df[max_df.Name==temp_sn].mjd_peak.values[0]
+    
+    # get phases for all available templates
+    wiserep_df = pd.read_csv(temp_dir / 'wiserep_spectra.csv')
+    mjds = Time(wiserep_df.JD.values, format='jd').mjd
+    phases = (mjds - mjd_peak) / (1 + z)
+    # get the file that matches the phase
+    temp_id = np.argmin(np.abs(phases - temp_phase))
+    temp_file = wiserep_df['Ascii file'].values[temp_id]
+    return read_template_file(temp_dir / temp_file)
+
+def ngsf_template_matches(ngsf_file: str, obs_wave: np.ndarray, obs_flux: np.ndarray,
+                          n: int = 3) -> list[tuple[dict, np.ndarray]]:
+    """Best-match NGSF templates, with their host-galaxy contribution, on
+    the observed grid.
 
     Parameters
     ----------
     ngsf_file: CSV output file from NGSF.
     obs_wave: Observed spectrum wavelength.
     obs_flux: Observed spectrum flux.
-    fig: Figure with the plot.
     n: Number of best-match templates, sorted by reduced chi square.
 
-    Returns:
-    fig: Updated figure with NGSF templates.
+    Returns
+    -------
+    matches: template info (see ``template_trace``) and flux on the observed
+        grid, scaled to the observed spectrum, of each best match.
     """
     median = np.nanmedian(obs_flux)  # to scale the templates
+    bank = get_ngsf_bank()
     sn_df = pd.read_csv(ngsf_file)
+    matches = []
     for i, row in sn_df[:n].iterrows():
         # template info
         z = row.Z  # redshift
@@ -141,24 +320,20 @@ def add_ngsf_templates(ngsf_file: str, obs_wave: np.ndarray, obs_flux: np.ndarra
 
         # get phase from best templates to get peak mjd
         temp_phase = float(row.Phase)
-        mjd_peak = max_df[max_df.Name==temp_sn].mjd_peak.values[0]
-        
-        # get phases for all available templates
-        wiserep_df = pd.read_csv(temp_dir / 'wiserep_spectra.csv')
-        mjds = Time(wiserep_df.JD.values, format='jd').mjd
-        phases = (mjds - mjd_peak) / (1 + z)
-        # get the file that matches the phase
-        temp_id = np.argmin(np.abs(phases - temp_phase))
-        temp_file = wiserep_df['Ascii file'].values[temp_id]
-        temp_df = pd.read_csv(temp_dir / temp_file, sep='\\s+', comment='#')
-        try:
-            temp_wave, temp_flux, _ = temp_df.values.T
-        except Exception:
-            temp_wave, temp_flux = temp_df.values.T
-        
-        # load host-galaxy template
-        gal_file = ngsf_path / 'bank/original_resolution/gal' / row.GALAXY
-        host_wave, host_flux = np.loadtxt(gal_file).T
+        # templates missing from the packed bank (e.g. added to NGSF since it was built) are read from the bank files
+        if bank is not None and str(temp_path) in bank.templates:
+            temp_wave, temp_flux = bank.sn_template(str(temp_path), temp_phase, z)
+        else:
+            if bank is not None:
+                logger.warning(f'NGSF template {temp_path} is not in the packed bank; reading it from the bank files. '
+                               'Rebuild the packed bank with `manage.py build_ngsf_bank`')
+            temp_wave, temp_flux = find_ngsf_template(temp_dir, temp_sn, temp_phase, z)
+        if bank is not None and row.GALAXY in bank.galaxies:
+            host_wave, host_flux = bank.galaxy(row.GALAXY)
+        else:
+            # load host-galaxy template
+            gal_file = ngsf_path / 'bank/original_resolution/gal' / row.GALAXY
+            host_wave, host_flux = np.loadtxt(gal_file).T
         host_flux = np.interp(temp_wave, host_wave, host_flux, left=np.nan, right=np.nan)  # interpolate to match SN template grid
         # normalise
         temp_flux /= np.nanmedian(temp_flux)
@@ -173,19 +348,28 @@ def add_ngsf_templates(ngsf_file: str, obs_wave: np.ndarray, obs_flux: np.ndarra
         temp_total_flux *= median  # add observed spectrum scale
         # match observed grid
         temp_wave, temp_total_flux = match_grid(obs_wave, temp_wave, temp_total_flux)
-            
-        # update figure with templates
-        fig.add_trace(go.Scatter(
-            x=temp_wave,
-            y=temp_total_flux,
-            name=f"{i+1}. {temp_sn}<br>{temp_type} (NGSF)",
-            hovertemplate=(f'Name: {temp_sn}<br>Type: {temp_type}<br>'
-                           f'Phase: {temp_phase}<br>'
-                           f'redshift: {row.Z}<br>Av: {row.A_v}<br>'
-                           f'Host: {row.GALAXY}<br>SN frac.: {row["Frac(SN)"] * 100:.1f}%<br>'
-                           f'dWave.:%{{x}}<br>'
-                           ),
-            showlegend=True,
-            visible='legendonly',
-        ))
-    return fig
\ No newline at end of file
+        info = {'fitter': 'ngsf', 'rank': i + 1, 'name': temp_sn, 'sn_type': temp_type, 'phase': temp_phase,
+                'redshift': float(z), 'extra': {'A_v': float(row.A_v), 'host': row.GALAXY,
+                                                'sn_fraction': float(row["Frac(SN)"])}}
+        matches.append((info, temp_total_flux))
+    return matches
+
+def add_ngsf_templates(ngsf_file: str, obs_wave: np.ndarray, obs_flux: np.ndarray, 
+                       fig: FigureDict, n: int = 3, max_points: int | None = None) -> FigureDict:
+    """Adds best-match NGSF templates to the figure.
+
+    Parameters
+    ----------
+    ngsf_file: CSV output file from NGSF.
+    obs_wave: Observed spectrum wavelength.
+    obs_flux: Observed spectrum flux.
+    fig: Figure with the plot.
+    n: Number of best-match templates, sorted by reduced chi square.
+    max_points: Maximum number of points per template (see ``downsample``).
+
+    Returns:
+    fig: Updated figure with NGSF templates.
+    """
+    for info, flux in ngsf_template_matches(ngsf_file, obs_wave, obs_flux, n):
+        fig.add_trace(template_trace(info, obs_wave, flux, max_points))
+    return fig
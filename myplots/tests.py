@@ -1,9 +1,37 @@
-from django.test import TestCase
+from django.contrib.auth.models import User
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.template import Context, Template
+from django.test import RequestFactory, TestCase, override_settings
+from django.urls import reverse
 #from tom_targets.tests.factories import SiderealTargetFactory
 from tom_targets.models import Target
+from tom_dataproducts.models import DataProduct, ReducedDatum
+from custom_code.models import TidesTarget
+from tidestom.tides_utils.ingest_utils import SpectrumIngester
 
+import os
+import json
+import shutil
+import tempfile
 import warnings
+from io import StringIO
+from datetime import timedelta
+from pathlib import Path
+from unittest import mock
+import numpy as np
+import extinction
+import plotly.graph_objs as go
 import pandas as pd
+from astropy.io import fits
+from myplots.templatetags.downsampling import lttb_indices, minmax_indices, downsample
+from myplots.templatetags.myplots_tags import plotly_js_digest
+from myplots.templatetags.figure_builder import FigureDict, scatter
+from myplots.templatetags import spectroscopy_settings
+from myplots.ngsf_bank import get_ngsf_bank
+from myplots.template_matching import match_flux
+from myplots.templatetags.photometry_settings import plot_lightcurves, lightcurves_figure, decimate_photometry
 from myplots.templatetags.photometry_settings import fetch_ztf_lasair, is_site_up
 from tidestom.settings import BROKERS
 lasair_token = BROKERS['LASAIR']['api_key']
@@ -23,3 +51,392 @@ class TestPhotometry(TestCase):
         else:
             photometry = fetch_ztf_lasair(self.target.ra, self.target.dec)
             assert isinstance(photometry, pd.DataFrame), f"Photometry object is not a DataFrame! Check {fetch_ztf_lasair}."
+
+
+class TestDownsampling(TestCase):
+    def setUp(self):
+        self.x = np.linspace(4000, 9000, 20000)
+        self.y = np.sin(self.x / 200)
+        # a narrow emission line
+        self.y[12345] = 50
+
+    def test_lttb(self):
+        indices = lttb_indices(self.x, self.y, 500)
+        assert len(indices) == 500
+        assert indices[0] == 0 and indices[-1] == len(self.x) - 1
+        assert np.all(np.diff(indices) > 0)
+        assert 12345 in indices
+
+    def test_minmax(self):
+        indices = minmax_indices(self.x, self.y, 500)
+        assert len(indices) <= 500
+        assert 12345 in indices
+        assert self.y[indices].min() == self.y.min()
+
+    def test_downsample(self):
+        self.y[:10] = np.nan
+        x, y = downsample(self.x, self.y, max_points=1000)
+        assert len(x) == 1000
+        assert np.isfinite(y).all()
+        # short traces and max_points=0 keep every finite point
+        x, y = downsample(self.x, self.y, max_points=0)
+        assert len(x) == len(self.x) - 10
+        x, y = downsample(self.x[:100], self.y[:100], max_points=1000)
+        assert len(x) == 90
+
+    def test_decimate_photometry_missing_values(self):
+        y = 18 + self.y / 10
+        y[::7] = np.nan
+        df = pd.DataFrame({'mjd': self.x, 'upper_mag': y}, index=np.arange(len(y)) + 100)
+        decimated = decimate_photometry(df, 'upper_mag', max_points=500)
+        # missing values are not picked as (zero) extremes, and rows keep their labels
+        assert len(decimated) == 500
+        assert decimated['upper_mag'].notna().all()
+        assert decimated['upper_mag'].min() > 17
+        assert 12345 + 100 in decimated.index
+        pd.testing.assert_frame_equal(decimated, df.loc[decimated.index])
+        # short light curves are kept whole
+        assert decimate_photometry(df[:100], 'upper_mag', max_points=500).equals(df[:100])
+
+
+# keeps the figures cached by the views out of the project's file-based cache
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TestFigureEndpoints(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.target = TidesTarget.objects.create(name='no_spectra', type='SIDEREAL')
+        self.user = User.objects.create_superuser(username='admin')
+
+    def test_spectroscopy_figure(self):
+        url = reverse('spectroscopy_figure', args=[self.target.pk])
+        assert self.client.get(url).status_code == 404
+        self.client.force_login(self.user)
+        # nothing to plot
+        assert self.client.get(url).status_code == 204
+        # data product ids that are not integers
+        assert self.client.get(url, {'dataproduct': 'x'}).status_code == 404
+        assert self.client.get(url, {'dataproduct': '1.5'}).status_code == 404
+
+    def test_cached_spectroscopy_figure(self):
+        self.client.force_login(self.user)
+        url = reverse('spectroscopy_figure', args=[self.target.pk])
+        self.add_spectrum('spectrum_1')
+        assert len(self.client.get(url).json()['data']) == 1
+
+        with mock.patch('myplots.views.spectroscopy_figure') as build:
+            response = self.client.get(url)
+        build.assert_not_called()
+        assert len(response.json()['data']) == 1
+
+        # new data invalidate the cached figure
+        self.add_spectrum('spectrum_2')
+        assert len(self.client.get(url).json()['data']) == 2
+
+    def test_spectra_ordered_by_timestamp(self):
+        self.client.force_login(self.user)
+        newer = self.add_spectrum('newer')
+        older = self.add_spectrum('older', flux=[2.0, 4.0, 3.0])
+        older.timestamp = newer.timestamp - timedelta(days=10)
+        older.save()
+        data = self.client.get(reverse('spectroscopy_figure', args=[self.target.pk])).json()['data']
+        assert np.allclose(data[0]['y'], [2.0, 4.0, 3.0])
+        assert np.allclose(data[1]['y'], [1.0, 2.0, 1.5])
+
+    def add_spectrum(self, product_id, flux=(1.0, 2.0, 1.5)):
+        data_product = DataProduct.objects.create(
+            product_id=product_id, target=self.target, data_product_type='spectroscopy'
+        )
+        return ReducedDatum.objects.create(
+            target=self.target, data_product=data_product, data_type='spectroscopy',
+            value={'wavelength': [4000.0, 5000.0, 6000.0], 'flux': list(flux)}
+        )
+
+    def test_plotly_js(self):
+        html = Template('{% load myplots_tags %}{% plotly_js %}').render(Context())
+        url = reverse('plotly_js', args=[plotly_js_digest()])
+        assert url in html
+        response = self.client.get(url)
+        assert response.status_code == 200
+        assert 'immutable' in response['Cache-Control']
+        assert self.client.get(reverse('plotly_js', args=['0' * 12])).status_code == 404
+
+    def test_target_spectroscopy_tag(self):
+        request = RequestFactory().get('/', {'full_resolution': 1})
+        html = Template('{% load myplots_tags %}{% target_spectroscopy target %}').render(
+            Context({'target': self.target, 'request': request})
+        )
+        assert f'data-figure-url="/targets/{self.target.pk}/spectroscopy.json?full_resolution=1"' in html
+        # the figure is not embedded in the page
+        assert 'Plotly.newPlot' not in html
+
+
+class TestFigureBuilder(TestCase):
+    def test_lightcurves_figure(self):
+        rng = np.random.default_rng(1)
+        n = 200
+        mag = 18 + rng.normal(size=n)
+        mag[::5] = np.nan
+        photometry = pd.DataFrame({
+            'filter': rng.choice(['ztf_g', 'ztf_r'], n),
+            'mjd': 60000 + np.sort(rng.uniform(0, 100, n)),
+            'mag': mag, 'mag_err': 0.1, 'upper_mag': 20.5,
+        }).sort_values(['filter', 'mjd'])
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            legacy = json.loads(plot_lightcurves(photometry.copy()).to_json())
+            fast = json.loads(lightcurves_figure(photometry.copy()).to_json())
+
+        # the same traces, without those of the 14 filters with no data
+        kept = [i for i, trace in enumerate(legacy['data']) if trace['x']]
+        assert len(legacy['data']) == 96 and len(fast['data']) == 12
+        assert fast['data'] == [legacy['data'][i] for i in kept]
+        for button in legacy['layout']['updatemenus'][0]['buttons']:
+            visible = button['args'][0]['visible']
+            button['args'][0]['visible'] = [visible[i] for i in kept]
+        assert fast['layout'] == legacy['layout']
+
+    def test_figure_dict(self):
+        legacy = go.Figure()
+        fast = FigureDict()
+        for fig, trace in ((legacy, go.Scatter), (fast, scatter)):
+            fig.add_trace(trace(x=np.arange(3), y=np.ones(3), showlegend=False, hoverinfo='skip',
+                                line=dict(color='grey'), name=None))
+            fig.add_vline(60000.5, line_width=2, line_dash="dot", line_color="black",
+                          annotation_text="s", annotation_position="top left")
+        legacy.update_layout(xaxis_title='Observed Wavelength (Å)', legend_title="Best Templates",
+                             xaxis=dict(showticklabels=True, ticks='outside'))
+        fast.update_layout(dict(xaxis=dict(title=dict(text='Observed Wavelength (Å)'),
+                                           showticklabels=True, ticks='outside'),
+                                legend=dict(title=dict(text="Best Templates"))))
+        assert json.loads(fast.to_json()) == json.loads(legacy.to_json())
+
+
+class TestNGSFBank(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        root = Path(self.tmp_dir.name)
+        self.bank_dir = root / 'bank' / 'original_resolution'
+        sn_dir = self.bank_dir / 'sne' / 'Ia' / 'sn2011fe'
+        sn_dir.mkdir(parents=True)
+        (self.bank_dir / 'gal').mkdir()
+        wave = np.linspace(3000, 10000, 200)
+        files = []
+        for day in (-10, 0, 5, 20):
+            files.append(f'sn2011fe_{day}.dat')
+            flux = np.exp(-((wave - 6000 - 50 * day) / 800) ** 2) + 0.1
+            pd.DataFrame({'wave': wave, 'flux': flux}).to_csv(sn_dir / files[-1], sep=' ', index=False)
+        pd.DataFrame({'JD': 2400000.5 + 55800 + np.array([-10, 0, 5, 20]), 'Ascii file': files}).to_csv(
+            sn_dir / 'wiserep_spectra.csv', index=False
+        )
+        np.savetxt(self.bank_dir / 'gal' / 'E', np.column_stack([wave, np.linspace(1, 2, 200)]))
+        self.peak_file = root / 'mjd_of_maximum_brightness.csv'
+        pd.DataFrame({'Name': ['sn2011fe'], 'mjd_peak': [55800.0], 'band_peak': ['B'],
+                      'isupperlimit': [0]}).to_csv(self.peak_file, index=False)
+        self.ngsf_file = root / 'ngsf.csv'
+        pd.DataFrame({'SN': ['Ia/sn2011fe/sn2011fe_5.dat a b c'], 'Z': [0.05], 'Phase': [4.0],
+                      'GALAXY': ['E'], 'A_v': [0.3], 'CONST_SN': [0.8], 'CONST_GAL': [0.2],
+                      'Frac(SN)': [0.8]}).to_csv(self.ngsf_file, index=False)
+        self.output = root / 'ngsf_bank'
+
+    def test_packed_bank_matches_bank_files(self):
+        out = StringIO()
+        call_command('build_ngsf_bank', '--bank-dir', str(self.bank_dir), '--peak-file', str(self.peak_file),
+                     '--output', str(self.output), stdout=out)
+        assert 'Packed 4 SN templates and 1 host-galaxy templates' in out.getvalue()
+
+        obs_wave = np.linspace(4000, 9000, 300)
+        obs_flux = np.ones(300)
+        figures = []
+        with mock.patch.object(spectroscopy_settings, 'ngsf_path', Path(self.tmp_dir.name)), \
+                mock.patch.object(spectroscopy_settings, 'max_df', pd.read_csv(self.peak_file)):
+            for bank_dir in (str(self.output), os.path.join(self.tmp_dir.name, 'missing')):
+                with self.settings(NGSF_BANK_DIR=bank_dir):
+                    fig = spectroscopy_settings.add_ngsf_templates(self.ngsf_file, obs_wave, obs_flux,
+                                                                   FigureDict(), max_points=0)
+                figures.append(fig.data[0])
+        packed, files = figures
+        np.testing.assert_allclose(packed['y'], files['y'])
+        assert packed['name'] == files['name']
+
+        # templates added to the bank files after packing are read from the files
+        sn_dir = self.bank_dir / 'sne' / 'Ia' / 'sn2011fe'
+        shutil.copytree(sn_dir, self.bank_dir / 'sne' / 'Ia' / 'sn2011by')
+        pd.DataFrame({'SN': ['Ia/sn2011by/sn2011fe_5.dat a b c'], 'Z': [0.05], 'Phase': [4.0],
+                      'GALAXY': ['E'], 'A_v': [0.3], 'CONST_SN': [0.8], 'CONST_GAL': [0.2],
+                      'Frac(SN)': [0.8]}).to_csv(self.ngsf_file, index=False)
+        peaks = pd.read_csv(self.peak_file)
+        peaks = pd.concat([peaks, peaks.assign(Name='sn2011by')])
+        with mock.patch.object(spectroscopy_settings, 'ngsf_path', Path(self.tmp_dir.name)), \
+                mock.patch.object(spectroscopy_settings, 'max_df', peaks), \
+                self.settings(NGSF_BANK_DIR=str(self.output)), \
+                self.assertLogs(spectroscopy_settings.logger, 'WARNING'):
+            (info, flux), = spectroscopy_settings.ngsf_template_matches(self.ngsf_file, obs_wave, obs_flux, n=1)
+        assert info['name'] == 'sn2011by'
+        np.testing.assert_allclose(flux, packed['y'])
+
+        with self.settings(NGSF_BANK_DIR=str(self.output)):
+            bank = get_ngsf_bank()
+        assert bank.peak_mjds == {'sn2011fe': 55800.0}
+        # phase 12 d at z=0.5 is 18 d after peak in the observer frame
+        wave, flux = bank.sn_template('Ia/sn2011fe', 12, 0.5)
+        assert np.argmax(flux) == np.argmin(np.abs(wave - 7000))
+
+
+class TestExtinction(TestCase):
+    def test_alam(self):
+        wave = np.linspace(3000, 10000, 5000)
+        expected = extinction.apply(extinction.ccm89(wave, 1.0, 3.1), np.ones(len(wave)))
+        spectroscopy_settings._extinction_curve.cache_clear()
+        np.testing.assert_allclose(spectroscopy_settings.Alam(wave), expected)
+        # equal grids hit the cache, whatever the array object
+        curve = spectroscopy_settings.Alam(wave.copy())
+        assert spectroscopy_settings._extinction_curve.cache_info().hits == 1
+        assert not curve.flags.writeable
+        spectroscopy_settings.Alam(wave, R_v=2.0)
+        assert spectroscopy_settings._extinction_curve.cache_info().misses == 2
+
+
+class TestSNIDCache(TestCase):
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.pysnid_file = os.path.join(tmp_dir.name, 'spectrum_snid.h5')
+        open(self.pysnid_file, 'w').close()
+        spectroscopy_settings._snid_cache.clear()
+        self.addCleanup(spectroscopy_settings._snid_cache.clear)
+        self.obs_wave = np.linspace(4000, 9000, 500)
+
+    def fake_results(self):
+        snidres = mock.Mock()
+        wave = np.linspace(3500, 9500, 1000)
+        snidres.get_modeldata.side_effect = lambda i, fluxcorr: pd.DataFrame(
+            {'wavelength': wave, 'flux': np.full(1000, 1.05 * i)}
+        )
+        snidres.results = pd.DataFrame({'sn': ['sn0', 'sn1', 'sn2', 'sn3'], 'type': 'Ia', 'age': [0, 1, 2, 3]})
+        return snidres
+
+    def test_snid_models_are_cached(self):
+        with mock.patch.object(spectroscopy_settings, 'get_pysnid_results',
+                               side_effect=lambda path: self.fake_results()) as reader:
+            fig = spectroscopy_settings.add_snid_templates(self.pysnid_file, self.obs_wave, np.full(500, 2.0),
+                                                           FigureDict(), max_points=0)
+            spectroscopy_settings.add_snid_templates(self.pysnid_file, self.obs_wave.copy(), np.ones(500),
+                                                     FigureDict())
+            assert reader.call_count == 1
+            assert [trace['y'][0] for trace in fig.data] == [2.0, 4.0, 6.0]
+            assert fig.data[2]['name'] == '3. sn3<br>Ia (SNID)'
+
+            # a new fit is read again
+            os.utime(self.pysnid_file, (0, 0))
+            spectroscopy_settings.get_snid_models(self.pysnid_file, self.obs_wave)
+            assert reader.call_count == 2
+
+    def test_size_bounded_lru(self):
+        cache = spectroscopy_settings.SizeBoundedLRU(max_bytes=100)
+        cache.set('a', 1, 40)
+        cache.set('b', 2, 40)
+        cache.get('a')
+        cache.set('c', 3, 40)
+        assert cache.get('b') is None
+        assert cache.get('a') == 1 and cache.get('c') == 3
+        assert cache.nbytes == 80
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class TestTemplateMatching(TestCase):
+    def setUp(self):
+        cache.clear()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        media_settings = override_settings(MEDIA_ROOT=tmp_dir.name, SNID_RESULTS_DIR=None, NGSF_RESULTS_DIR=None)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        spectroscopy_settings._snid_cache.clear()
+        self.addCleanup(spectroscopy_settings._snid_cache.clear)
+
+        self.target = TidesTarget.objects.create(name='matched', type='SIDEREAL')
+        self.user = User.objects.create_superuser(username='admin')
+        data_product = DataProduct.objects.create(
+            product_id='spectrum', target=self.target, data_product_type='spectroscopy', data='matched/spectrum.fits'
+        )
+        self.obs_wave = np.linspace(4000, 9000, 50)
+        self.datum = ReducedDatum.objects.create(
+            target=self.target, data_product=data_product, data_type='spectroscopy',
+            value={'wavelength': self.obs_wave.tolist(), 'flux': [2.0] * 50}
+        )
+        os.makedirs(os.path.join(tmp_dir.name, 'matched'))
+        open(os.path.join(tmp_dir.name, 'matched', 'spectrum_snid.h5'), 'w').close()
+
+    fake_results = TestSNIDCache.fake_results
+
+    def test_match_templates(self):
+        with mock.patch.object(spectroscopy_settings, 'get_pysnid_results',
+                               side_effect=lambda path: self.fake_results()):
+            call_command('match_templates', stdout=StringIO())
+        matches = list(self.datum.template_matches.all())
+        assert [(match.fitter, match.rank, match.name) for match in matches] == [
+            ('snid', 1, 'sn1'), ('snid', 2, 'sn2'), ('snid', 3, 'sn3')
+        ]
+        assert np.allclose(match_flux(matches[1]), 4.0)
+
+        # matched spectra are skipped unless forced
+        with mock.patch.object(spectroscopy_settings, 'get_pysnid_results') as reader:
+            out = StringIO()
+            call_command('match_templates', stdout=out)
+            reader.assert_not_called()
+        assert 'Matched 0 spectra' in out.getvalue()
+        with mock.patch.object(spectroscopy_settings, 'get_pysnid_results',
+                               side_effect=lambda path: self.fake_results()):
+            call_command('match_templates', '--force', '--n', '2', stdout=StringIO())
+        assert self.datum.template_matches.count() == 2
+
+    def test_match_templates_of_deduplicated_spectra(self):
+        # spectra ingested with --dedup are kept as <sha256>.fits in the content-addressed store, while their fit
+        # results follow the name of the original file
+        spectra_dir = os.path.join(settings.MEDIA_ROOT, 'incoming')
+        os.makedirs(spectra_dir)
+        spectrum_file = os.path.join(spectra_dir, 'l1_obs_1001.fits')
+        fits.BinTableHDU.from_columns([
+            fits.Column(name='WAVE', format='50E', array=self.obs_wave[None]),
+            fits.Column(name='FLUX', format='50E', array=np.ones((1, 50))),
+        ]).writeto(spectrum_file)
+        open(os.path.join(spectra_dir, 'l1_obs_1001_snid.h5'), 'w').close()
+        target = TidesTarget.objects.create(name='1001', type='SIDEREAL')
+        with override_settings(BASE_DIR=settings.MEDIA_ROOT):
+            SpectrumIngester(dedup=True).run([{'obj_name': '1001', 'spectrum_file': spectrum_file}])
+        datum = ReducedDatum.objects.get(target=target)
+        assert '/data/spectra/store/' in datum.data_product.data.name
+
+        with mock.patch.object(spectroscopy_settings, 'get_pysnid_results',
+                               side_effect=lambda path: self.fake_results()) as reader:
+            call_command('match_templates', stdout=StringIO())
+        reader.assert_any_call(os.path.join(spectra_dir, 'l1_obs_1001_snid.h5'))
+        assert datum.template_matches.count() == 3
+
+    def test_figure_reads_stored_matches(self):
+        with mock.patch.object(spectroscopy_settings, 'get_pysnid_results',
+                               side_effect=lambda path: self.fake_results()):
+            call_command('match_templates', stdout=StringIO())
+        self.client.force_login(self.user)
+        with mock.patch.object(spectroscopy_settings, 'get_pysnid_results') as reader:
+            data = self.client.get(reverse('spectroscopy_figure', args=[self.target.pk])).json()['data']
+            reader.assert_not_called()
+        assert [trace.get('name') for trace in data[1:]] == [
+            '1. sn1<br>Ia (SNID)', '2. sn2<br>Ia (SNID)', '3. sn3<br>Ia (SNID)'
+        ]
+        assert np.allclose(data[3]['y'], 6.0)
+
+        # the templates are those of the latest spectrum, not of the last one added
+        older = DataProduct.objects.create(product_id='older', target=self.target, data_product_type='spectroscopy')
+        ReducedDatum.objects.create(
+            target=self.target, data_product=older, data_type='spectroscopy',
+            timestamp=self.datum.timestamp - timedelta(days=10),
+            value={'wavelength': self.obs_wave.tolist(), 'flux': [1.0] * 50}
+        )
+        data = self.client.get(reverse('spectroscopy_figure', args=[self.target.pk])).json()['data']
+        assert len(data) == 5
+        assert np.allclose(data[1]['y'], 2.0)
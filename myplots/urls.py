@@ -0,0 +1,9 @@
+from django.urls import path
+
+from .views import spectroscopy_figure_json, photometry_figure_json, plotly_js
+
+urlpatterns = [
+    path('targets/<int:pk>/spectroscopy.json', spectroscopy_figure_json, name='spectroscopy_figure'),
+    path('targets/<int:pk>/photometry.json', photometry_figure_json, name='photometry_figure'),
+    path('plotly/<str:digest>.min.js', plotly_js, name='plotly_js'),
+]
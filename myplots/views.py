@@ -1,3 +1,78 @@
-from django.shortcuts import render
+from django.conf import settings
+from django.http import Http404, HttpResponse
+from guardian.shortcuts import get_objects_for_user
+from tom_targets.models import Target
 
-# Create your views here.
+from .plot_cache import plot_cache_key, cached_figure_json
+from .templatetags.myplots_tags import (
+    spectroscopy_datums, spectroscopy_figure, photometry_figure, plot_max_points,
+    plotly_js_bundle
+)
+
+
+def get_visible_target(user, pk):
+    """Returns the target if the user can view it, else raises Http404."""
+    targets = get_objects_for_user(user, f'{Target._meta.app_label}.view_target', klass=Target)
+    try:
+        return targets.get(pk=pk)
+    except Target.DoesNotExist:
+        raise Http404('Target not found')
+
+
+def get_dataproduct_pk(request):
+    """The ``?dataproduct=`` of a request as a primary key, or None if not given; raises Http404 if it is not one."""
+    dataproduct = request.GET.get('dataproduct')
+    if not dataproduct:
+        return None
+    try:
+        return int(dataproduct)
+    except ValueError:
+        raise Http404('Data product not found')
+
+
+def figure_response(figure_json):
+    """JSON response with a plotly figure; 204 (No Content) if there is nothing to plot."""
+    if figure_json is None:
+        return HttpResponse(status=204)
+    return HttpResponse(figure_json, content_type='application/json')
+
+
+def spectroscopy_figure_json(request, pk):
+    """Figure JSON of the spectroscopy panel of a target, cached until its spectra or template matches change."""
+    target = get_visible_target(request.user, pk)
+    dataproduct = get_dataproduct_pk(request)
+    max_points = plot_max_points(request)
+    key = plot_cache_key(
+        'spectroscopy', target.pk, spectroscopy_datums(target, request.user, dataproduct),
+        params={'dataproduct': dataproduct, 'max_points': max_points}
+    )
+    return figure_response(cached_figure_json(
+        key, lambda: spectroscopy_figure(target, request.user, dataproduct, max_points=max_points)
+    ))
+
+
+def photometry_figure_json(request, pk):
+    """
+    Figure JSON of the photometry panel of a target, cached until its spectra change, or for
+    ``PHOTOMETRY_CACHE_SECONDS`` as the light curves come from the brokers.
+    """
+    target = get_visible_target(request.user, pk)
+    max_points = plot_max_points(request)
+    key = plot_cache_key(
+        'photometry', target.pk, spectroscopy_datums(target, request.user), params={'max_points': max_points}
+    )
+    return figure_response(cached_figure_json(
+        key, lambda: photometry_figure(target, max_points=max_points), timeout=settings.PHOTOMETRY_CACHE_SECONDS
+    ))
+
+
+def plotly_js(request, digest):
+    """
+    The plotly.js bundle. Its URL contains the hash of its contents, so it can be cached by browsers for good.
+    """
+    bundle, current_digest = plotly_js_bundle()
+    if digest != current_digest:
+        raise Http404('Unknown plotly.js version')
+    response = HttpResponse(bundle, content_type='application/javascript')
+    response['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
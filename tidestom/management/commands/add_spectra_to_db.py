@@ -4,24 +4,32 @@ import pandas as pd
 from datetime import datetime
 from pathlib import Path  # Import pathlib
 
-from django.core.management.base import BaseCommand
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
 from django.conf import settings
 from custom_code.models import TidesTarget as Target
-from custom_code.models import TidesClassSubClass
-from tom_dataproducts.models import DataProduct
-from tidestom.tides_utils.target_utils import (
-    generate_spectrum_plot, add_spectrum_to_database
+from custom_code.taxonomy import get_taxonomy
+from django.db.models import Max
+from tom_dataproducts.models import DataProduct, ReducedDatum
+from tidestom.tides_utils.target_utils import get_tom_spectrum_path
+from tidestom.tides_utils.ingest_utils import (
+    SpectrumIngester, add_spectrum_to_database, pipeline_rows, mock_rows,
+    mock_row_chunks, read_csv_chunks, PIPELINE_DTYPES
 )
+from tidestom.tides_utils.job_queue import enqueue_rows
 
-# Configure logging
-logging.basicConfig(
-    filename=(
-        '/Users/pwise/4MOST/tides/tidestom/logs'
-        f'/add_spectra_to_db_{datetime.now().strftime("%Y%m%d%H%M%S")}.log'
-    ),  # Replace with your desired logfile path
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-)
+
+def configure_logging():
+    # Log files go to settings.LOG_DIR ($TIDES_LOG_DIR)
+    os.makedirs(settings.LOG_DIR, exist_ok=True)
+    logging.basicConfig(
+        filename=os.path.join(
+            settings.LOG_DIR,
+            f'add_spectra_to_db_{datetime.now().strftime("%Y%m%d%H%M%S")}.log'
+        ),
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s',
+    )
 
 
 class Command(BaseCommand):
@@ -43,9 +51,114 @@ class Command(BaseCommand):
             help='Path to the pipeline results file'
         )
 
+        parser.add_argument(
+            '--bulk', action='store_true',
+            help='Use set-based queries and bulk inserts/updates'
+        )
+
+        parser.add_argument(
+            '--stream', action='store_true',
+            help=(
+                'Read the input table in chunks of --chunk-size rows and '
+                'commit each chunk on its own (implies --bulk)'
+            )
+        )
+
+        parser.add_argument(
+            '--since', type=datetime.fromisoformat,
+            help=(
+                'Only ingest files modified at or after this ISO date/time '
+                '(implies --bulk)'
+            )
+        )
+
+        parser.add_argument(
+            '--force', action='store_true',
+            help=(
+                'Reprocess files even if they are recorded in the ingestion '
+                'ledger (implies --bulk)'
+            )
+        )
+
+        parser.add_argument(
+            '--hash', action='store_true',
+            help=(
+                'Record content hashes in the ingestion ledger and skip '
+                'files whose contents did not change (implies --bulk)'
+            )
+        )
+
+        parser.add_argument(
+            '--dedup', action='store_true',
+            help=(
+                'Keep spectra in the content-addressed store and link files '
+                'with already-stored contents to the existing product '
+                'instead of processing them (implies --bulk)'
+            )
+        )
+
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help=(
+                'Number of processes reading spectra (implies --bulk)'
+            )
+        )
+
+        parser.add_argument(
+            '--enqueue', action='store_true',
+            help=(
+                'Queue the spectra as ingestion jobs for `ingest_worker` '
+                'processes instead of ingesting them here (implies --bulk)'
+            )
+        )
+
+        parser.add_argument(
+            '--chunk-size', type=int, default=500,
+            help='Number of rows committed per transaction in bulk mode'
+        )
+
+        parser.add_argument(
+            '--match-templates', action='store_true',
+            help=(
+                'Store the best-match templates of the spectra added by this '
+                'run once they are ingested (see `match_templates`); not '
+                'available with --enqueue'
+            )
+        )
+
     def handle(self, *args, **kwargs):
+        if kwargs['match_templates'] and kwargs['enqueue']:
+            raise CommandError(
+                '--match-templates cannot be used with --enqueue, as the '
+                'spectra are ingested later by `ingest_worker`; run '
+                '`match_templates` once the queue is done'
+            )
+        configure_logging()
+        # the datums added by this run are those with a greater id
+        last_datum_id = (
+            ReducedDatum.objects.aggregate(last=Max('pk'))['last'] or 0
+        )
+        stream = kwargs['stream']
+        bulk = (
+            kwargs['bulk'] or kwargs['workers'] > 1 or kwargs['since']
+            or kwargs['force'] or kwargs['hash'] or stream
+            or kwargs['enqueue'] or kwargs['dedup']
+        )
+        ingest_options = {
+            'chunk_size': kwargs['chunk_size'],
+            'workers': kwargs['workers'],
+            'since': kwargs['since'],
+            'force': kwargs['force'],
+            'use_hash': kwargs['hash'],
+            'dedup': kwargs['dedup'],
+        }
         if kwargs['mock']:
-            self.add_spectra_from_mock_db()
+            if bulk:
+                self.add_spectra_from_mock_db_bulk(
+                    ingest_options, stream, kwargs['enqueue']
+                )
+            else:
+                self.add_spectra_from_mock_db()
 
         elif kwargs['pipeline']:
             pipeline_results_path = kwargs['pipeline_results']
@@ -55,12 +168,26 @@ class Command(BaseCommand):
                     "--pipeline option"
                 )
                 return
-            self.add_spectra_from_pipeline(pipeline_results_path)
+            if bulk:
+                self.add_spectra_from_pipeline_bulk(
+                    pipeline_results_path, ingest_options, stream,
+                    kwargs['enqueue']
+                )
+            else:
+                self.add_spectra_from_pipeline(pipeline_results_path)
 
         else:
             logging.error(
                 "Either --mock or --pipeline option must be specified"
             )
+            return
+
+        if kwargs['match_templates']:
+            call_command(
+                'match_templates', after_id=last_datum_id,
+                workers=kwargs['workers'], stdout=self.stdout,
+                stderr=self.stderr
+            )
 
     def add_spectra_from_mock_db(self):
         test_data_dir = Path(settings.BASE_DIR) / 'data/spectra/test'
@@ -85,14 +212,11 @@ class Command(BaseCommand):
             if os.path.exists(spectrum_file_path):
                 # Check if the spectrum already exists in the database
                 spectrum_exists = DataProduct.objects.filter(
-                    target=target, data=spectrum_file_path
+                    target=target,
+                    data=get_tom_spectrum_path(spectrum_file_path)
                 ).exists()
 
                 if not spectrum_exists:
-                    generate_spectrum_plot(target, spectrum_file_path)
-                    logging.info(
-                        f'Successfully updated plots for target {target.name}'
-                    )
                     result = add_spectrum_to_database(
                         target, spectrum_file_path
                     )
@@ -124,11 +248,10 @@ class Command(BaseCommand):
                     if auto_class:
                         target.auto_tidesclass = auto_class
 
-                        # Retrieve the TidesClassSubClass instance using the
-                        # correct field
+                        # Retrieve the TidesClassSubClass instance from the
+                        # cached taxonomy
                         auto_class_subclass_instance = (
-                            TidesClassSubClass.objects
-                            .filter(sub_class=auto_class_subclass).first()
+                            get_taxonomy().subclass(auto_class_subclass)
                         )
 
                         if auto_class_subclass_instance:
@@ -184,13 +307,9 @@ class Command(BaseCommand):
 
             # Check if the spectrum already exists in the database
             spectrum_exists = DataProduct.objects.filter(
-                target=target, data=spectrum_file_path
+                target=target, data=get_tom_spectrum_path(spectrum_file_path)
             ).exists()
             if not spectrum_exists:
-                generate_spectrum_plot(target, spectrum_file_path)
-                logging.info(
-                    f'Successfully updated plots for target {target.name}.'
-                )
                 result = add_spectrum_to_database(target, spectrum_file_path)
                 if 'Error' in result:
                     logging.error(result)
@@ -206,12 +325,10 @@ class Command(BaseCommand):
             if auto_class:
                 target.auto_tidesclass = auto_class
 
-                # Retrieve the TidesClassSubClass instance using the correct
-                # field
+                # Retrieve the TidesClassSubClass instance from the cached
+                # taxonomy
                 auto_class_subclass_instance = (
-                    TidesClassSubClass
-                    .objects
-                    .filter(sub_class=auto_class_subclass).first()
+                    get_taxonomy().subclass(auto_class_subclass)
                 )
 
                 if auto_class_subclass_instance:
@@ -233,3 +350,57 @@ class Command(BaseCommand):
                 logging.warning(
                     f'No auto classification found for target {target.name}'
                 )
+
+    def add_spectra_from_mock_db_bulk(self, ingest_options, stream=False,
+                                      enqueue=False):
+        test_data_dir = Path(settings.BASE_DIR) / 'data/spectra/test'
+        test_data_dir.mkdir(parents=True, exist_ok=True)
+        target_csv_path = os.path.join(settings.TEST_DIR, "mock_DB.csv")
+
+        if not os.path.exists(target_csv_path):
+            self.stdout.write(
+                self.style.ERROR(
+                    f"Target CSV file not found at {target_csv_path}"
+                )
+            )
+            return
+
+        sims_dir = os.path.join(settings.TEST_DIR, 'sims')
+        if stream:
+            row_chunks = mock_row_chunks(
+                target_csv_path, sims_dir, ingest_options['chunk_size']
+            )
+        else:
+            dbdf = pd.read_csv(target_csv_path, index_col=0)
+            row_chunks = [mock_rows(
+                dbdf, Target.objects.values_list('name', flat=True), sims_dir
+            )]
+        self.ingest_row_chunks(row_chunks, ingest_options, enqueue)
+
+    def add_spectra_from_pipeline_bulk(self, pipeline_results_path,
+                                       ingest_options, stream=False,
+                                       enqueue=False):
+        if stream:
+            row_chunks = (
+                pipeline_rows(chunk) for chunk in read_csv_chunks(
+                    pipeline_results_path, list(PIPELINE_DTYPES),
+                    PIPELINE_DTYPES, ingest_options['chunk_size']
+                )
+            )
+        else:
+            pipeline_results = pd.read_csv(pipeline_results_path)
+            row_chunks = [pipeline_rows(pipeline_results)]
+        self.ingest_row_chunks(row_chunks, ingest_options, enqueue)
+
+    def ingest_row_chunks(self, row_chunks, ingest_options, enqueue=False):
+        if enqueue:
+            queued = sum(enqueue_rows(rows) for rows in row_chunks)
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f'{queued} ingestion jobs queued; run `python manage.py '
+                    'ingest_worker` to process them'
+                )
+            )
+            return
+        stats = SpectrumIngester(**ingest_options).run_stream(row_chunks)
+        self.stdout.write(self.style.SUCCESS(stats.summary()))
@@ -1,17 +1,48 @@
 import os
 import pandas as pd
 from django.core.management.base import BaseCommand
+from django.db import transaction
 from tom_targets.models import Target
-from tidestom.tides_utils.target_utils import create_target
+from tidestom.tides_utils.target_utils import (
+    create_target, bulk_upsert_targets
+)
+from tidestom.tides_utils.ingest_utils import read_csv_chunks, MOCK_DB_DTYPES
 from django.conf import settings
 ### TODO: WRITE CORRECT DIRECTORY IN HER, USING AN ENVIRONMENT VARIABLE
 
+TARGET_COLUMNS = ['OBS_STATUS_4MOST', 'ra', 'dec', 'MJD_DET']
+
 
 class Command(BaseCommand):
     # Placeholder code that currently looks at a set of simulated spectra from
     # Georgios.
     help = 'Add new targets from a distant directory'
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--stream', action='store_true',
+            help=(
+                'Read the catalogue in chunks of --chunk-size rows and commit '
+                'each chunk on its own'
+            )
+        )
+
+        parser.add_argument(
+            '--chunk-size', type=int, default=10000,
+            help=(
+                'Number of catalogue rows per chunk in streaming mode, and '
+                'per upsert transaction in bulk mode'
+            )
+        )
+
+        parser.add_argument(
+            '--bulk', action='store_true',
+            help=(
+                'Upsert targets with bulk queries and only print a summary '
+                'of inserted, updated and skipped targets'
+            )
+        )
+
     def handle(self, *args, **kwargs):
         # directory = os.environ['TARGET_DB']
         target_csv_path = os.path.join(settings.TEST_DIR, "mock_DB.csv")
@@ -23,41 +54,90 @@ class Command(BaseCommand):
                 )
             )
             return
-        dbdf = pd.read_csv(target_csv_path, index_col=0)
-        for index, row in dbdf.iterrows():
-            name = index
-
-            # Check if the target has been observed by 4MOST
-            if row['OBS_STATUS_4MOST']:
-                external_id = name
-                other_fields = {
-                    'ra': row['ra'],
-                    'dec': row['dec'],
-                    'created': row['MJD_DET'],
-                    'type': 'SIDEREAL'
-                    # Add other fields as needed
-                }
-
-                # Check if the target already exists
-                target, created = Target.objects.update_or_create(
-                    name=name,
-                    defaults=other_fields
+
+        chunk_size = kwargs['chunk_size']
+        if kwargs['stream']:
+            chunks = read_csv_chunks(
+                target_csv_path, TARGET_COLUMNS, MOCK_DB_DTYPES,
+                chunk_size=chunk_size, index_col=0
+            )
+        else:
+            dbdf = pd.read_csv(target_csv_path, index_col=0)
+            if not kwargs['bulk']:
+                for index, row in dbdf.iterrows():
+                    self.add_target(index, row)
+                return
+            chunks = (
+                dbdf.iloc[i:i + chunk_size]
+                for i in range(0, len(dbdf), chunk_size)
+            )
+
+        inserted = updated = skipped = 0
+        for dbdf in chunks:
+            if kwargs['bulk']:
+                counts = self.upsert_targets(dbdf)
+                inserted += counts[0]
+                updated += counts[1]
+                skipped += counts[2]
+            else:
+                with transaction.atomic():
+                    for index, row in dbdf.iterrows():
+                        self.add_target(index, row)
+
+        if kwargs['bulk']:
+            self.stdout.write(
+                self.style.SUCCESS(
+                    f'{inserted} targets added, {updated} updated, {skipped} '
+                    'not observed by 4MOST and skipped'
                 )
+            )
 
-                if created:
-                    self.stdout.write(
-                        self.style.SUCCESS(f'Successfully added target {name}')
-                    )
-                else:
-                    self.stdout.write(
-                        self.style.SUCCESS(
-                            f'Successfully updated target {name}'
-                        )
-                    )
+    def upsert_targets(self, dbdf):
+        # Keep only the targets observed by 4MOST, in one vectorized step
+        observed = dbdf['OBS_STATUS_4MOST'].fillna(False).astype(bool)
+        observed_df = dbdf.loc[observed, ['ra', 'dec']]
+        observed_df = observed_df.astype(object).where(
+            observed_df.notna(), None
+        )
+        target_fields = {
+            str(name): {'ra': ra, 'dec': dec, 'type': 'SIDEREAL'}
+            for name, ra, dec in observed_df.itertuples()
+        }
+        inserted, updated = bulk_upsert_targets(target_fields)
+        return inserted, updated, len(dbdf) - len(observed_df)
+
+    def add_target(self, name, row):
+        # Check if the target has been observed by 4MOST
+        if row['OBS_STATUS_4MOST']:
+            external_id = name
+            other_fields = {
+                'ra': row['ra'],
+                'dec': row['dec'],
+                'created': row['MJD_DET'],
+                'type': 'SIDEREAL'
+                # Add other fields as needed
+            }
+
+            # Check if the target already exists
+            target, created = Target.objects.update_or_create(
+                name=name,
+                defaults=other_fields
+            )
+
+            if created:
+                self.stdout.write(
+                    self.style.SUCCESS(f'Successfully added target {name}')
+                )
             else:
                 self.stdout.write(
-                    self.style.WARNING(
-                        f'Target {name} has not been observed '
-                        'by 4MOST and will not be added'
+                    self.style.SUCCESS(
+                        f'Successfully updated target {name}'
                     )
                 )
+        else:
+            self.stdout.write(
+                self.style.WARNING(
+                    f'Target {name} has not been observed '
+                    'by 4MOST and will not be added'
+                )
+            )
@@ -0,0 +1,258 @@
+import os
+import sys
+import json
+import time
+import shlex
+import resource
+import platform
+import tempfile
+import subprocess
+from io import StringIO
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.backends.base.creation import TEST_DATABASE_PREFIX
+from django.test.utils import override_settings
+from tidestom.tides_utils.synthetic_data import make_synthetic_dataset
+
+
+class QueryCounter:
+    """Database execute wrapper counting the queries run through it."""
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    """High-water mark of the resident set size of the process (or of its
+    largest child), since it started."""
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / 1024 ** (2 if sys.platform == 'darwin' else 1)
+
+
+def rss_mb():
+    """Current resident set size of the process, or None where
+    /proc/self/statm is not available."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * resource.getpagesize() / 1024 ** 2
+
+
+def format_mb(value):
+    return 'n/a' if value is None else f'{value:+.0f} MB'
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=settings.BASE_DIR,
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark add_targets and add_spectra_to_db on synthetic 4MOST data '
+        'in a scratch database, and append the results to a JSON file'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+            help='Numbers of catalogue targets to benchmark'
+        )
+
+        parser.add_argument(
+            '--n-pix', type=int, default=5000,
+            help='Number of pixels of the synthetic spectra'
+        )
+
+        parser.add_argument(
+            '--data-dir', type=str,
+            help=(
+                'Directory to keep the synthetic data in, so that it is only '
+                'generated once (default: a temporary directory)'
+            )
+        )
+
+        parser.add_argument(
+            '--targets-args', type=str, default='--bulk',
+            help='Arguments passed to add_targets'
+        )
+
+        parser.add_argument(
+            '--spectra-args', type=str, default='--bulk',
+            help='Arguments passed to add_spectra_to_db (besides --mock)'
+        )
+
+        parser.add_argument(
+            '--seed', type=int, default=0,
+            help='Random seed of the synthetic data'
+        )
+
+        parser.add_argument(
+            '--output', type=str, default='ingestion_benchmark.json',
+            help='JSON file the results are appended to'
+        )
+
+        parser.add_argument(
+            '--allow-non-debug', action='store_true',
+            help=(
+                'Run even though DEBUG is off. The scratch database is '
+                'created and dropped through the default connection, so '
+                'this should never be used against a production server'
+            )
+        )
+
+    def handle(self, *args, **kwargs):
+        if not settings.DEBUG and not kwargs['allow_non_debug']:
+            raise CommandError(
+                'DEBUG is off, so this may be a production deployment; '
+                'benchmark_ingestion creates and drops a scratch database on '
+                'the default connection. Pass --allow-non-debug to run anyway'
+            )
+
+        run = {
+            'commit': git_commit(),
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': connection.vendor,
+            'n_pix': kwargs['n_pix'],
+            'targets_args': kwargs['targets_args'],
+            'spectra_args': kwargs['spectra_args'],
+            'results': [],
+        }
+
+        for n_targets in sorted(kwargs['sizes']):
+            with tempfile.TemporaryDirectory() as work_dir:
+                data_dir = os.path.join(work_dir, 'data_in')
+                if kwargs['data_dir']:
+                    data_dir = os.path.join(
+                        kwargs['data_dir'], f'{n_targets}_{kwargs["n_pix"]}'
+                    )
+                catalogue = os.path.join(data_dir, 'mock_DB.csv')
+                if not os.path.exists(catalogue):
+                    self.stdout.write(
+                        f'Generating {n_targets} synthetic targets...'
+                    )
+                    os.makedirs(data_dir, exist_ok=True)
+                    make_synthetic_dataset(
+                        data_dir, n_targets, n_pix=kwargs['n_pix'],
+                        seed=kwargs['seed']
+                    )
+                n_spectra = len(os.listdir(os.path.join(data_dir, 'sims')))
+
+                steps = [
+                    ('add_targets', shlex.split(kwargs['targets_args']),
+                     n_targets),
+                    ('add_spectra_to_db',
+                     ['--mock'] + shlex.split(kwargs['spectra_args']),
+                     n_spectra),
+                ]
+                for result in self.run_steps(steps, data_dir, work_dir):
+                    result['targets'] = n_targets
+                    run['results'].append(result)
+                    self.stdout.write(
+                        f'{n_targets} targets, {result["command"]}: '
+                        f'{result["wall_time"]:.1f} s, '
+                        f'{result["rows_per_sec"]:.0f} rows/s, '
+                        f'{result["queries"]} queries, '
+                        f'{format_mb(result["rss_delta_mb"])} RSS delta, '
+                        f'process peak RSS '
+                        f'{result["process_peak_rss_mb"]:.0f} MB'
+                    )
+
+        self.write_results(kwargs['output'], run)
+        self.stdout.write(
+            self.style.SUCCESS(f'Results appended to {kwargs["output"]}')
+        )
+
+    def run_steps(self, steps, data_dir, work_dir):
+        # A scratch database, created and destroyed as the test runner
+        # does; on SQLite it is a file so that timings include disk I/O
+        test_settings = connection.settings_dict.setdefault('TEST', {})
+        old_test_name = test_settings.get('NAME')
+        if connection.vendor == 'sqlite':
+            test_settings['NAME'] = os.path.join(work_dir, 'benchmark.sqlite3')
+        # the name create_test_db uses
+        scratch_name = (
+            test_settings.get('NAME')
+            or TEST_DATABASE_PREFIX + connection.settings_dict['NAME']
+        )
+        if scratch_name == connection.settings_dict['NAME']:
+            test_settings['NAME'] = old_test_name
+            raise CommandError(
+                f'The scratch database would be the live one ({scratch_name});'
+                ' set a different TEST NAME for the default database'
+            )
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False
+        )
+        results = []
+        try:
+            with override_settings(
+                TEST_DIR=data_dir,
+                BASE_DIR=work_dir,
+                MEDIA_ROOT=os.path.join(work_dir, 'data'),
+                STATICFILES_DIRS=[os.path.join(work_dir, 'static')],
+                LOG_DIR=os.path.join(work_dir, 'logs'),
+            ):
+                call_command('populate_tidesclasses', stdout=StringIO())
+                for command, args, rows in steps:
+                    results.append(self.measure(command, args, rows))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            test_settings['NAME'] = old_test_name
+        return results
+
+    def measure(self, command, args, rows):
+        counter = QueryCounter()
+        rss_before = rss_mb()
+        peak_before = peak_rss_mb()
+        start = time.perf_counter()
+        with connection.execute_wrapper(counter):
+            call_command(command, *args, stdout=StringIO())
+        wall_time = time.perf_counter() - start
+        rss_after = rss_mb()
+        return {
+            'command': command,
+            'args': args,
+            'rows': rows,
+            'wall_time': wall_time,
+            'rows_per_sec': rows / wall_time if wall_time else None,
+            'queries': counter.count,
+            # memory the step kept, and how far it raised the process peak
+            # (0 when it stayed under the peak of an earlier step)
+            'rss_delta_mb': (
+                None if rss_before is None else rss_after - rss_before
+            ),
+            'peak_rss_growth_mb': peak_rss_mb() - peak_before,
+            # high-water marks of the whole run so far, not of this step
+            'process_peak_rss_mb': peak_rss_mb(),
+            'children_process_peak_rss_mb': peak_rss_mb(
+                resource.RUSAGE_CHILDREN
+            ),
+        }
+
+    def write_results(self, path, run):
+        runs = []
+        if os.path.exists(path):
+            with open(path) as f:
+                runs = json.load(f)['runs']
+        runs.append(run)
+        with open(path, 'w') as f:
+            json.dump({'runs': runs}, f, indent=2)
@@ -0,0 +1,83 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from tom_dataproducts.models import ReducedDatum
+
+from custom_code.models import SpectrumArray
+from tidestom.tides_utils.spectrum_storage import (
+    BINARY_STORAGE, JSON_STORAGE, pack_spectrum
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Convert the stored spectroscopy ReducedDatums between JSON and '
+        'compact binary storage'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--to', choices=[BINARY_STORAGE, JSON_STORAGE],
+            default=BINARY_STORAGE,
+            help='Storage to convert the datums to'
+        )
+
+        parser.add_argument(
+            '--batch-size', type=int, default=500,
+            help='Number of datums converted per transaction'
+        )
+
+    def handle(self, *args, **kwargs):
+        datums = ReducedDatum.objects.filter(data_type='spectroscopy')
+        if kwargs['to'] == BINARY_STORAGE:
+            datums = datums.filter(spectrum_array__isnull=True)
+            convert = self.pack_batch
+        else:
+            # Packed values are rebuilt as the datums are loaded
+            datums = datums.filter(spectrum_array__isnull=False)
+            convert = self.unpack_batch
+
+        converted = 0
+        last_pk = 0
+        while True:
+            # Batches are keyed on pk, since converted rows drop out of the
+            # filter while we go
+            batch = list(
+                datums.filter(pk__gt=last_pk).order_by('pk')
+                [:kwargs['batch_size']]
+            )
+            if not batch:
+                break
+            last_pk = batch[-1].pk
+            with transaction.atomic():
+                converted += convert(batch)
+            self.stdout.write(f'{converted} spectra converted...')
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'{converted} spectra converted to {kwargs["to"]} storage'
+            )
+        )
+
+    def pack_batch(self, batch):
+        packed = []
+        arrays = []
+        for datum in batch:
+            if 'flux' not in datum.value:
+                self.stdout.write(
+                    self.style.WARNING(
+                        f'ReducedDatum {datum.pk} has no flux; left as is'
+                    )
+                )
+                continue
+            datum.value, spectrum_array = pack_spectrum(datum.value)
+            spectrum_array.reduced_datum = datum
+            packed.append(datum)
+            arrays.append(spectrum_array)
+        SpectrumArray.objects.bulk_create(arrays)
+        ReducedDatum.objects.bulk_update(packed, ['value'])
+        return len(packed)
+
+    def unpack_batch(self, batch):
+        ReducedDatum.objects.bulk_update(batch, ['value'])
+        SpectrumArray.objects.filter(reduced_datum__in=batch).delete()
+        return len(batch)
@@ -0,0 +1,101 @@
+import os
+import multiprocessing
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from tom_dataproducts.models import DataProduct
+from tidestom.tides_utils.target_utils import (
+    get_spectrum_plot_path, render_spectrum_thumbnail, thumbnail_is_stale
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Render the missing or out-of-date spectrum thumbnails '
+        '(static/plots/spectrum_<target id>.png) in a process pool'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count() or 1,
+            help='Number of rendering processes'
+        )
+
+        parser.add_argument(
+            '--since', type=datetime.fromisoformat,
+            help=(
+                'Only consider targets with spectroscopy data products '
+                'modified at or after this ISO date/time'
+            )
+        )
+
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Re-render thumbnails even if they are up to date'
+        )
+
+    def handle(self, *args, **kwargs):
+        products = DataProduct.objects.filter(
+            data_product_type='spectroscopy'
+        ).exclude(data='')
+        since = kwargs['since']
+        if since:
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+            products = products.filter(
+                target__in=products.filter(
+                    modified__gte=since
+                ).values('target')
+            )
+
+        sources = {}
+        target_names = {}
+        for target_id, target_name, data in products.order_by(
+            'pk'
+        ).values_list('target_id', 'target__name', 'data'):
+            # paths are stored absolute; relative ones are under MEDIA_ROOT
+            sources.setdefault(target_id, []).append(
+                os.path.join(settings.MEDIA_ROOT, data)
+            )
+            target_names[target_id] = target_name
+
+        tasks = []
+        for target_id, spec_fns in sources.items():
+            plot_path = get_spectrum_plot_path(target_id)
+            if kwargs['force'] or thumbnail_is_stale(plot_path, spec_fns):
+                tasks.append((spec_fns, plot_path, target_names[target_id]))
+        skipped = len(sources) - len(tasks)
+        self.stdout.write(
+            f'{len(tasks)} thumbnails to render, {skipped} up to date'
+        )
+        if not tasks:
+            return
+
+        errors = 0
+        workers = max(1, min(kwargs['workers'], len(tasks)))
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=django.setup,
+            mp_context=multiprocessing.get_context('spawn')
+        ) as executor:
+            results = executor.map(
+                render_spectrum_thumbnail,
+                *zip(*tasks),
+                chunksize=max(1, len(tasks) // (4 * workers))
+            )
+            for done, error in enumerate(results, start=1):
+                if error is not None:
+                    errors += 1
+                    self.stderr.write(error)
+                if done % 1000 == 0:
+                    self.stdout.write(f'{done}/{len(tasks)} rendered...')
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'{len(tasks) - errors} thumbnails rendered, {skipped} up to '
+                f'date, {errors} errors'
+            )
+        )
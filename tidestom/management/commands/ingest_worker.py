@@ -0,0 +1,126 @@
+import os
+import time
+import socket
+import logging
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from tidestom.tides_utils.ingest_utils import SpectrumIngester
+from tidestom.tides_utils.job_queue import (
+    claim_jobs, finish_jobs, requeue_stale_jobs, queue_progress
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = (
+        'Claim queued ingestion jobs and ingest them; start as many workers '
+        'as needed, on any node sharing the database'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=100,
+            help='Number of jobs claimed and ingested at a time'
+        )
+
+        parser.add_argument(
+            '--dedup', action='store_true',
+            help=(
+                'Keep spectra in the content-addressed store and skip files '
+                'whose contents are already stored'
+            )
+        )
+
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of processes reading spectra'
+        )
+
+        parser.add_argument(
+            '--poll-interval', type=float, default=5.0,
+            help='Seconds to wait when the queue is empty'
+        )
+
+        parser.add_argument(
+            '--retry-delay', type=float, default=60.0,
+            help=(
+                'Seconds before the first retry of a failed job; the delay '
+                'doubles with every further attempt'
+            )
+        )
+
+        parser.add_argument(
+            '--defer-delay', type=float, default=600.0,
+            help=(
+                'Seconds before a job whose target is not in the database '
+                'is tried again (this does not count as an attempt)'
+            )
+        )
+
+        parser.add_argument(
+            '--stale-after', type=float, default=3600.0,
+            help=(
+                'Seconds after which a running job is assumed to belong to '
+                'a dead worker and is queued again'
+            )
+        )
+
+        parser.add_argument(
+            '--exit-when-empty', action='store_true',
+            help='Stop once there are no pending jobs left'
+        )
+
+    def handle(self, *args, **kwargs):
+        worker = f'{socket.gethostname()}:{os.getpid()}'
+        stale_after = timedelta(seconds=kwargs['stale_after'])
+        self.retry_delay = timedelta(seconds=kwargs['retry_delay'])
+        self.defer_delay = timedelta(seconds=kwargs['defer_delay'])
+        self.stdout.write(f'Ingestion worker {worker} started')
+
+        with SpectrumIngester(
+            workers=kwargs['workers'], dedup=kwargs['dedup']
+        ) as ingester:
+            try:
+                while True:
+                    requeued = requeue_stale_jobs(stale_after)
+                    if requeued:
+                        logger.warning(f'Requeued {requeued} stale jobs')
+
+                    jobs = claim_jobs(worker, kwargs['batch_size'])
+                    if jobs:
+                        self.run_jobs(ingester, jobs)
+                    elif kwargs['exit_when_empty']:
+                        break
+                    else:
+                        time.sleep(kwargs['poll_interval'])
+            except KeyboardInterrupt:
+                self.stdout.write('Stopped')
+
+    def run_jobs(self, ingester, jobs):
+        try:
+            stats = ingester.run([job.row for job in jobs])
+            failures = ingester.failures
+            missing_targets = ingester.missing_targets
+        except Exception as e:
+            logger.exception('Ingestion batch failed')
+            stats = None
+            failures = {
+                (job.spectrum_file, str(job.row.get('obj_name'))): repr(e)
+                for job in jobs
+            }
+            missing_targets = ()
+        finish_jobs(
+            jobs, failures, missing_targets, base_delay=self.retry_delay,
+            defer_delay=self.defer_delay
+        )
+
+        progress = queue_progress()
+        if stats is not None:
+            self.stdout.write(self.style.SUCCESS(stats.summary()))
+        self.stdout.write(
+            f'Queue: {progress["pending"]} pending, {progress["running"]} '
+            f'running, {progress["done"]} done, {progress["failed"]} failed; '
+            f'{progress["last_hour"]} done in the last hour'
+        )
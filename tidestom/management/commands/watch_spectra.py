@@ -0,0 +1,262 @@
+import os
+import re
+import time
+import fnmatch
+import logging
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from tidestom.tides_utils.ingest_utils import SpectrumIngester
+from tidestom.tides_utils.tides_data_processor import file_target_names
+
+logger = logging.getLogger(__name__)
+
+SPECTRUM_NAME_RE = re.compile(r'^l1_obs_joined_(?P<name>.+)\.fits$')
+
+
+class SpectrumWatcher:
+    """Polls a directory for newly landed spectrum files.
+
+    The directory itself is only listed again when its modification time
+    changes (i.e. files were added, removed or renamed into place); in
+    between, only the files that were still being written or are due for
+    a retry are stat-ed again.
+
+    Files handed out by ``poll`` are only remembered as done once they are
+    reported back with ``done``; files that failed to ingest are reported
+    again after ``retry_interval`` seconds, or as soon as they change.
+
+    Parameters
+    ----------
+    directory: directory to watch.
+    pattern: glob pattern of the spectrum file names.
+    settle: seconds a file must be left untouched before it is reported,
+        so half-written files are not picked up.
+    retry_interval: seconds to wait before reporting a failed file again.
+    """
+
+    def __init__(self, directory, pattern='l1_obs_joined_*.fits', settle=2.0,
+                 retry_interval=60.0):
+        self.directory = directory
+        self.pattern = pattern
+        self.settle = settle
+        self.retry_interval = retry_interval
+        self.dir_mtime = None
+        self.known = {}
+        self.pending = {}
+        self.retries = {}
+        self.unsettled = {}
+
+    def poll(self) -> list[str]:
+        """Returns the files that appeared or were replaced since the last
+        poll and are no longer being written, and the failed files due for
+        a retry."""
+        now = time.time()
+        dir_mtime = os.stat(self.directory).st_mtime
+        # a file landing within the same mtime tick as the last listing
+        # would not change dir_mtime, so recent changes are listed again
+        if (
+            dir_mtime != self.dir_mtime
+            or now - dir_mtime < self.settle + 1
+        ):
+            self.dir_mtime = dir_mtime
+            with os.scandir(self.directory) as entries:
+                candidates = [
+                    entry.path for entry in entries
+                    if fnmatch.fnmatch(entry.name, self.pattern)
+                ]
+            present = set(candidates)
+            for state in (self.known, self.pending, self.retries):
+                for path in [path for path in state if path not in present]:
+                    del state[path]
+        else:
+            candidates = list(self.unsettled) + [
+                path for path, (_, due) in self.retries.items() if due <= now
+            ]
+
+        ready = []
+        for path in candidates:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                self.unsettled.pop(path, None)
+                self.retries.pop(path, None)
+                continue
+            signature = (stat.st_size, stat.st_mtime)
+            if signature in (self.known.get(path), self.pending.get(path)):
+                continue
+            if path in self.retries:
+                failed_signature, due = self.retries[path]
+                if signature == failed_signature and now < due:
+                    continue
+            if now - stat.st_mtime < self.settle:
+                self.unsettled[path] = signature
+                continue
+            self.unsettled.pop(path, None)
+            self.retries.pop(path, None)
+            self.pending[path] = signature
+            ready.append(path)
+        return ready
+
+    def done(self, paths, failed=()):
+        """Records the outcome of ingesting files returned by ``poll``.
+
+        Parameters
+        ----------
+        paths: the files that were handed to the ingester.
+        failed: (file, object name) of the rows that could not be ingested,
+            as keyed in ``SpectrumIngester.failures``; files with any failed
+            row are polled again after ``retry_interval`` seconds.
+        """
+        failed = {path for path, _ in failed}
+        retry_at = time.time() + self.retry_interval
+        for path in paths:
+            signature = self.pending.pop(path, None)
+            if signature is None:
+                continue
+            if path in failed:
+                self.retries[path] = (signature, retry_at)
+            else:
+                self.known[path] = signature
+
+
+class Command(BaseCommand):
+    help = (
+        'Watch a directory for newly landed L1 spectra and ingest them in '
+        'micro-batches'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'directory', nargs='?', default=settings.L1_SPECTRA_DIR,
+            help='Directory to watch (default: $TIDES_L1_DIR)'
+        )
+
+        parser.add_argument(
+            '--pattern', type=str, default='l1_obs_joined_*.fits',
+            help='Glob pattern of the spectrum files'
+        )
+
+        parser.add_argument(
+            '--window', type=float, default=5.0,
+            help=(
+                'Seconds to collect files after the first new one arrives '
+                'before ingesting them as one batch'
+            )
+        )
+
+        parser.add_argument(
+            '--max-batch', type=int, default=1000,
+            help='Ingest as soon as this many files are waiting'
+        )
+
+        parser.add_argument(
+            '--poll-interval', type=float, default=1.0,
+            help='Seconds between directory polls'
+        )
+
+        parser.add_argument(
+            '--settle', type=float, default=2.0,
+            help='Seconds a file must be untouched before it is ingested'
+        )
+
+        parser.add_argument(
+            '--retry-interval', type=float, default=60.0,
+            help=(
+                'Seconds to wait before trying again to ingest a file that '
+                'failed (e.g. whose target is not in the database yet)'
+            )
+        )
+
+        parser.add_argument(
+            '--dedup', action='store_true',
+            help=(
+                'Keep spectra in the content-addressed store and skip files '
+                'whose contents are already stored'
+            )
+        )
+
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of processes reading spectra'
+        )
+
+        parser.add_argument(
+            '--once', action='store_true',
+            help='Ingest what is in the directory now and exit'
+        )
+
+    def handle(self, *args, **kwargs):
+        directory = kwargs['directory']
+        if not directory or not os.path.isdir(directory):
+            raise CommandError(
+                f'Directory to watch not found: {directory}. Pass it as an '
+                'argument or set TIDES_L1_DIR.'
+            )
+
+        watcher = SpectrumWatcher(
+            directory, pattern=kwargs['pattern'], settle=kwargs['settle'],
+            retry_interval=kwargs['retry_interval']
+        )
+        self.stdout.write(f'Watching {directory} for {kwargs["pattern"]}')
+
+        batch = []
+        batch_started = None
+        with SpectrumIngester(
+            workers=kwargs['workers'], dedup=kwargs['dedup']
+        ) as ingester:
+            try:
+                while True:
+                    new_files = watcher.poll()
+                    if new_files and not batch:
+                        batch_started = time.monotonic()
+                    batch.extend(new_files)
+
+                    if batch and (
+                        kwargs['once']
+                        or len(batch) >= kwargs['max_batch']
+                        or time.monotonic() - batch_started >= kwargs['window']
+                    ):
+                        self.ingest_batch(ingester, watcher, batch)
+                        batch = []
+
+                    if kwargs['once']:
+                        break
+                    time.sleep(kwargs['poll_interval'])
+            except KeyboardInterrupt:
+                if batch:
+                    self.ingest_batch(ingester, watcher, batch)
+                self.stdout.write('Stopped watching')
+
+    def ingest_batch(self, ingester, watcher, spectrum_files):
+        rows = []
+        unreadable = []
+        for spectrum_file in spectrum_files:
+            try:
+                names = file_target_names(spectrum_file)
+            except (OSError, ValueError) as e:
+                logger.warning(f'Cannot read {spectrum_file}: {e}')
+                unreadable.append((spectrum_file, None))
+                continue
+            if not names:
+                # single-target files are named after their target
+                match = SPECTRUM_NAME_RE.match(os.path.basename(spectrum_file))
+                if not match:
+                    logger.warning(
+                        f'Cannot tell the target of {spectrum_file};'
+                        ' skipping it'
+                    )
+                    continue
+                names = [match.group('name')]
+            # joined files get one row per target, like the pipeline results
+            rows.extend(
+                {'obj_name': name, 'spectrum_file': spectrum_file}
+                for name in names
+            )
+        stats = ingester.run(rows)
+        # failed files are retried later; the others are done, including
+        # those whose target cannot be told, which would fail again
+        watcher.done(
+            spectrum_files, failed=[*ingester.failures, *unreadable]
+        )
+        self.stdout.write(self.style.SUCCESS(stats.summary()))
@@ -18,6 +18,10 @@ import tempfile
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 TEST_DIR = os.environ.get('TIDES_TEST_DIR')
+# Directory where new 4MOST L1 spectra land (watched by `watch_spectra`)
+L1_SPECTRA_DIR = os.environ.get('TIDES_L1_DIR')
+# Directory for the log files of the ingestion commands
+LOG_DIR = os.environ.get('TIDES_LOG_DIR', os.path.join(BASE_DIR, 'logs'))
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/2.1/howto/deployment/checklist/
@@ -286,6 +290,27 @@ DATA_PROCESSORS = {
 # 'spectroscopy':
 # 'tom_dataproducts.processors.spectroscopy_processor.SpectroscopyProcessor',
 
+# How new spectroscopy ReducedDatums are stored: 'json' (lists of floats in
+# ReducedDatum.value) or 'binary' (compressed float32 arrays in the
+# SpectrumArray side table, rebuilt into ReducedDatum.value when a datum is
+# loaded). Existing rows are converted with
+# `python manage.py convert_spectra_storage`.
+SPECTRUM_STORAGE = os.environ.get('TIDES_SPECTRUM_STORAGE', 'json')
+
+# On-disk cache of the spectrum thumbnails rendered on demand, evicted
+# least-recently-used first once it holds more than THUMBNAIL_CACHE_MAX_BYTES
+THUMBNAIL_CACHE_DIR = os.environ.get(
+    'TIDES_THUMBNAIL_CACHE_DIR', os.path.join(BASE_DIR, 'cache', 'thumbnails')
+)
+THUMBNAIL_CACHE_MAX_BYTES = 500 * 1024 ** 2
+# How long browsers may reuse a thumbnail before revalidating its ETag
+THUMBNAIL_MAX_AGE = 24 * 3600
+
+# Maximum age (seconds) of the in-process taxonomy cache. Saving a class or
+# sub-class drops the cache at once in the process that saved it; other
+# processes rebuild theirs after this long.
+TAXONOMY_CACHE_SECONDS = 300
+
 TOM_FACILITY_CLASSES = [
     'tom_observations.facilities.lco.LCOFacility',
     'tom_observations.facilities.gemini.GEMFacility',
@@ -391,6 +416,30 @@ REST_FRAMEWORK = {
 # 'plotly', 'plotly_white', 'plotly_dark', 'ggplot2', 'seaborn', 'simple_white', 'none'
 PLOTLY_THEME = 'plotly_white'
 
+# Spectra, templates and light curves are decimated to at most this many
+# points per trace ('lttb' or 'minmax' downsampling); pages requested with
+# ?full_resolution=1 show every point
+PLOT_MAX_POINTS = 2000
+PLOT_DOWNSAMPLING = 'lttb'
+
+# Lifetime (seconds) of the cached figures of the target plots. Spectroscopy
+# figures are also dropped whenever the spectra of their target change;
+# photometry figures are refreshed more often, as the light curves come from
+# the brokers
+PLOT_CACHE_SECONDS = 7 * 24 * 3600
+PHOTOMETRY_CACHE_SECONDS = 3600
+
+# Packed NGSF template bank, built with `manage.py build_ngsf_bank`; the NGSF
+# overlays read the bank files directly until it is built
+NGSF_BANK_DIR = os.path.join(BASE_DIR, 'data', 'ngsf_bank')
+# Memory each process may use to cache the SNID best-match models
+SNID_CACHE_MAX_BYTES = 64 * 1024 ** 2
+# Directories of the SNID (`<spectrum>_snid.h5`) and NGSF (`<spectrum>.csv`)
+# fit results read by `manage.py match_templates`; None looks next to each
+# spectrum file
+SNID_RESULTS_DIR = None
+NGSF_RESULTS_DIR = None
+
 try:
     from local_settings import * # noqa
 except ImportError:
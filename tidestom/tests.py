@@ -0,0 +1,675 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from custom_code.models import (
+    TidesTarget, TidesClass, TidesClassSubClass, IngestedSpectrum,
+    SpectrumArray, IngestionJob
+)
+from tom_dataproducts.models import DataProduct, ReducedDatum
+from tom_targets.base_models import BaseTarget
+from tidestom.tides_utils.tides_data_processor import (
+    QMOSTSpectroscopyProcessor
+)
+from tidestom.tides_utils import ingest_utils, thumbnail_cache
+from tidestom.tides_utils.ingest_utils import (
+    SpectrumIngester, ingest_spectra_bulk, add_spectrum_to_database,
+    pipeline_rows, read_csv_chunks, PIPELINE_DTYPES
+)
+from tidestom.tides_utils.job_queue import (
+    enqueue_rows, claim_jobs, finish_jobs
+)
+from tidestom.tides_utils.synthetic_data import make_synthetic_dataset
+from tidestom.tides_utils.spectrum_storage import (
+    pack_spectrum, unpack_spectrum, load_spectrum, StoredSpectrum
+)
+from tidestom.management.commands.watch_spectra import SpectrumWatcher
+
+
+def write_l1_spectrum(path, n_rows=1, n_pix=50, obj_names=None):
+    wave = np.linspace(4000, 9000, n_pix)
+    columns = [
+        fits.Column(name='WAVE', format=f'{n_pix}E',
+                    array=np.tile(wave, (n_rows, 1))),
+        fits.Column(name='FLUX', format=f'{n_pix}E',
+                    array=np.ones((n_rows, n_pix))),
+    ]
+    if obj_names is not None:
+        # joined file: one row per entry of obj_names
+        columns.append(
+            fits.Column(name='OBJ_NME', format='10A', array=obj_names)
+        )
+    fits.BinTableHDU.from_columns(columns).writeto(path, overwrite=True)
+
+
+class TestBulkIngestion(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        settings_override = override_settings(
+            BASE_DIR=self.tmp_dir.name,
+            MEDIA_ROOT=os.path.join(self.tmp_dir.name, 'data'),
+            STATICFILES_DIRS=[os.path.join(self.tmp_dir.name, 'static')],
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        snia = TidesClass.objects.create(name='SNIa')
+        TidesClassSubClass.objects.create(main_class=snia,
+                                          sub_class='SNIa-norm')
+        self.targets = [
+            TidesTarget.objects.create(name=name, type='SIDEREAL')
+            for name in ('1001', '1002')
+        ]
+        rows = []
+        for target in self.targets:
+            spectrum_file = os.path.join(
+                self.tmp_dir.name, f'l1_obs_joined_{target.name}.fits'
+            )
+            write_l1_spectrum(spectrum_file)
+            rows.append({
+                'obj_name': int(target.name),
+                'spectrum_file': spectrum_file,
+                'auto_class_agg': 'SNIa',
+                'auto_class_subclass_agg': 'SNIa-norm',
+                'auto_class_prob_agg': 0.9,
+            })
+        rows.append({
+            'obj_name': 9999,
+            'spectrum_file': os.path.join(self.tmp_dir.name,
+                                          'l1_obs_joined_9999.fits')
+        })
+        self.pipeline_results = pd.DataFrame(rows)
+
+    def test_bulk_ingestion(self):
+        rows = pipeline_rows(self.pipeline_results)
+        with mock.patch(
+            'tidestom.tides_utils.target_utils.run_hook'
+        ) as hook:
+            stats = ingest_spectra_bulk(rows, chunk_size=1, plots=False)
+        # targets whose auto classification changed get their save hook
+        assert [
+            call.kwargs['target'] for call in hook.call_args_list
+        ] == self.targets
+        assert stats.added == 2
+        assert stats.missing_targets == 1
+        assert DataProduct.objects.count() == 2
+        assert ReducedDatum.objects.count() == 2
+        metrics = json.loads(DataProduct.objects.first().extra_data)
+        assert metrics['n_spectra'] == 1
+        assert metrics['spectra'][0]['n_pix'] == 50
+        for target in self.targets:
+            target.refresh_from_db()
+            assert target.auto_tidesclass == 'SNIa'
+            assert target.auto_tidesclass_subclass.sub_class == 'SNIa-norm'
+
+        # a rerun skips the files recorded in the ingestion ledger
+        stats = ingest_spectra_bulk(rows, plots=False)
+        assert stats.added == 0
+        assert stats.unchanged == 2
+        assert DataProduct.objects.count() == 2
+
+    def test_row_by_row_ingestion(self):
+        # stores the same values and metrics as the bulk path
+        target = self.targets[0]
+        spectrum_file = self.pipeline_results['spectrum_file'][0]
+        result = add_spectrum_to_database(target, spectrum_file)
+        assert result.startswith('Added')
+        data_product = DataProduct.objects.get(target=target)
+        assert json.loads(data_product.extra_data)['n_spectra'] == 1
+        datum = ReducedDatum.objects.get(data_product=data_product)
+        assert datum.value['flux'] == [1.0] * 50
+
+        result = add_spectrum_to_database(target, self.tmp_dir.name)
+        assert result.startswith('Error')
+        assert DataProduct.objects.count() == 1
+
+    def test_ingestion_ledger(self):
+        rows = pipeline_rows(self.pipeline_results)
+        ingest_spectra_bulk(rows, plots=False)
+        assert IngestedSpectrum.objects.count() == 2
+
+        # products registered before the ledger existed are only recorded
+        IngestedSpectrum.objects.all().delete()
+        stats = ingest_spectra_bulk(rows, plots=False)
+        assert stats.skipped == 2
+        assert IngestedSpectrum.objects.count() == 2
+
+        # a modified file is reprocessed into its existing product
+        os.utime(rows[0]['spectrum_file'], (0, 0))
+        stats = ingest_spectra_bulk(rows, plots=False)
+        assert stats.added == 1
+        assert stats.unchanged == 1
+        assert DataProduct.objects.count() == 2
+        assert ReducedDatum.objects.count() == 2
+
+        # --force reprocesses everything without duplicating products
+        stats = ingest_spectra_bulk(rows, plots=False, force=True)
+        assert stats.added == 2
+        assert DataProduct.objects.count() == 2
+        assert ReducedDatum.objects.count() == 2
+
+    def test_parallel_ingestion(self):
+        rows = pipeline_rows(self.pipeline_results)
+        stats = ingest_spectra_bulk(rows, workers=2, plots=True)
+        assert stats.added == 2
+        assert stats.errors == 0
+        assert ReducedDatum.objects.count() == 2
+        for target in self.targets:
+            assert os.path.exists(os.path.join(
+                self.tmp_dir.name, 'static', 'plots',
+                f'spectrum_{target.id}.png'
+            ))
+
+    def test_streaming_ingestion(self):
+        csv_path = os.path.join(self.tmp_dir.name, 'pipeline_results.csv')
+        self.pipeline_results.assign(extra_column=1).to_csv(
+            csv_path, index=False
+        )
+        chunks = list(read_csv_chunks(
+            csv_path, list(PIPELINE_DTYPES), PIPELINE_DTYPES, chunk_size=2
+        ))
+        assert [len(chunk) for chunk in chunks] == [2, 1]
+        assert 'extra_column' not in chunks[0].columns
+        assert chunks[0]['auto_class_prob_agg'].dtype == np.float32
+
+        stats = SpectrumIngester(plots=False).run_stream(
+            pipeline_rows(chunk) for chunk in chunks
+        )
+        assert stats.rows == 3
+        assert stats.added == 2
+        assert DataProduct.objects.count() == 2
+
+    def test_binary_storage(self):
+        rows = pipeline_rows(self.pipeline_results)
+        with override_settings(SPECTRUM_STORAGE='binary'):
+            ingest_spectra_bulk(rows, plots=False)
+        assert SpectrumArray.objects.count() == 2
+        # only a stub is stored in the value...
+        stored = ReducedDatum.objects.values_list('value', flat=True)
+        assert all(value['storage'] == 'binary' for value in stored)
+        datum = ReducedDatum.objects.defer('value').select_related(
+            'spectrum_array'
+        ).first()
+        np.testing.assert_array_equal(load_spectrum(datum).flux, 1)
+        # ...and rebuilt when the datum is loaded, e.g. for sharing
+        datum = ReducedDatum.objects.get(pk=datum.pk)
+        assert datum.value['flux'] == [1.0] * 50
+
+    def test_content_addressed_store(self):
+        rows = pipeline_rows(self.pipeline_results)
+        # a renamed copy in the same run is linked to the first product
+        copy = os.path.join(self.tmp_dir.name, 'renamed_1001.fits')
+        shutil.copyfile(rows[0]['spectrum_file'], copy)
+        rows.append(dict(rows[0], spectrum_file=copy))
+        stats = ingest_spectra_bulk(rows, plots=False, dedup=True)
+        assert stats.added == 2
+        assert stats.duplicates == 1
+        assert DataProduct.objects.count() == 2
+        product = DataProduct.objects.get(target=self.targets[0])
+        assert '/data/spectra/store/' in product.data.name
+        assert not os.path.islink(product.data.name)
+        assert IngestedSpectrum.objects.get(
+            source_path=copy
+        ).data_product == product
+
+        # so is a re-delivered file in a later run
+        redelivered = os.path.join(self.tmp_dir.name, 'redelivered.fits')
+        shutil.copyfile(rows[1]['spectrum_file'], redelivered)
+        stats = ingest_spectra_bulk(
+            [dict(rows[1], spectrum_file=redelivered)], plots=False,
+            dedup=True
+        )
+        assert stats.duplicates == 1
+        assert DataProduct.objects.count() == 2
+        assert ReducedDatum.objects.count() == 2
+
+    def test_file_rewritten_during_ingestion(self):
+        rows = pipeline_rows(self.pipeline_results)
+        process = ingest_utils.process_spectrum_file
+
+        def process_then_rewrite(path, *args):
+            result = process(path, *args)
+            if path == rows[0]['spectrum_file']:
+                write_l1_spectrum(path, n_pix=60)
+            return result
+
+        with mock.patch.object(ingest_utils, 'process_spectrum_file',
+                               process_then_rewrite):
+            ingester = SpectrumIngester(plots=False, dedup=True)
+            stats = ingester.run(rows)
+        assert stats.added == 1
+        assert stats.errors == 1
+        assert (rows[0]['spectrum_file'], '1001') in ingester.failures
+        assert not DataProduct.objects.filter(target=self.targets[0]).exists()
+        # every stored copy is named after the hash of its own contents
+        store_dir = os.path.join(self.tmp_dir.name, 'data/spectra/store')
+        for root, _, files in os.walk(store_dir):
+            for name in files:
+                with open(os.path.join(root, name), 'rb') as f:
+                    digest = hashlib.sha256(f.read()).hexdigest()
+                assert name.startswith(digest)
+
+        # the next run ingests the new contents
+        stats = ingest_spectra_bulk(rows, plots=False, dedup=True)
+        assert stats.added == 1
+        assert DataProduct.objects.filter(target=self.targets[0]).exists()
+
+    def test_create_thumbnails(self):
+        ingest_spectra_bulk(pipeline_rows(self.pipeline_results),
+                            plots=False)
+        plot_paths = [
+            os.path.join(self.tmp_dir.name, 'static', 'plots',
+                         f'spectrum_{target.id}.png')
+            for target in self.targets
+        ]
+        out = StringIO()
+        call_command('create_thumbnails', '--workers', '2', stdout=out)
+        assert '2 thumbnails rendered' in out.getvalue()
+        assert all(os.path.exists(path) for path in plot_paths)
+
+        # only images older than their spectrum are rendered again
+        os.utime(plot_paths[0], (0, 0))
+        out = StringIO()
+        call_command('create_thumbnails', '--workers', '1', stdout=out)
+        assert '1 thumbnails rendered, 1 up to date' in out.getvalue()
+
+        out = StringIO()
+        call_command('create_thumbnails', '--since', '2100-01-01',
+                     stdout=out)
+        assert '0 thumbnails to render, 0 up to date' in out.getvalue()
+
+    def test_thumbnail_view(self):
+        ingest_spectra_bulk(pipeline_rows(self.pipeline_results))
+        cache_dir = os.path.join(self.tmp_dir.name, 'cache')
+        user = User.objects.create_superuser(username='admin')
+        self.client.force_login(user)
+        urls = [
+            reverse('spectrum_thumbnail', args=[target.id])
+            for target in self.targets
+        ]
+        with self.settings(THUMBNAIL_CACHE_DIR=cache_dir,
+                           THUMBNAIL_CACHE_MAX_BYTES=0):
+            response = self.client.get(urls[0])
+            assert response.status_code == 200
+            assert response['Content-Type'] == 'image/png'
+            assert 'max-age' in response['Cache-Control']
+            etag = response['ETag']
+            assert os.listdir(cache_dir) == [
+                f'{self.targets[0].id}_{etag.strip(chr(34))}.png'
+            ]
+
+            response = self.client.get(urls[0], HTTP_IF_NONE_MATCH=etag)
+            assert response.status_code == 304
+
+            # the least recently used thumbnail is evicted
+            assert self.client.get(urls[1]).status_code == 200
+            assert len(os.listdir(cache_dir)) == 1
+            assert os.listdir(cache_dir)[0].startswith(
+                f'{self.targets[1].id}_'
+            )
+
+        # under the limit, misses do not list the cache directory
+        with self.settings(THUMBNAIL_CACHE_DIR=os.path.join(cache_dir, 'new')):
+            with mock.patch.object(thumbnail_cache, '_cached_files',
+                                   wraps=thumbnail_cache._cached_files) as ls:
+                for url in urls:
+                    assert self.client.get(url).status_code == 200
+            assert ls.call_count == 1
+
+        self.client.logout()
+        assert self.client.get(urls[0]).status_code == 404
+
+    def test_thumbnail_evicted_before_opening(self):
+        ingest_spectra_bulk(pipeline_rows(self.pipeline_results))
+        user = User.objects.create_superuser(username='admin')
+        self.client.force_login(user)
+        url = reverse('spectrum_thumbnail', args=[self.targets[0].id])
+        get_thumbnail = thumbnail_cache.get_thumbnail
+
+        def get_then_evict(*args):
+            # another process evicts everything right after the render
+            path = get_thumbnail(*args)
+            thumbnail_cache.evict_thumbnails(0)
+            return path
+
+        with self.settings(
+            THUMBNAIL_CACHE_DIR=os.path.join(self.tmp_dir.name, 'cache'),
+            THUMBNAIL_CACHE_MAX_BYTES=0
+        ):
+            # rendered again once...
+            with mock.patch('tidestom.views.get_thumbnail') as render:
+                render.side_effect = lambda *args: (
+                    get_then_evict if render.call_count == 1
+                    else get_thumbnail
+                )(*args)
+                assert self.client.get(url).status_code == 200
+            assert render.call_count == 2
+            # ...and not found if it keeps being evicted
+            with mock.patch('tidestom.views.get_thumbnail', get_then_evict):
+                assert self.client.get(url).status_code == 404
+
+    def test_job_queue(self):
+        rows = pipeline_rows(self.pipeline_results)
+        assert enqueue_rows(rows) == 3
+        # files already queued are not queued twice
+        assert enqueue_rows(rows) == 0
+
+        jobs = claim_jobs('worker-1', 2)
+        assert len(jobs) == 2
+        assert all(job.status == IngestionJob.RUNNING for job in jobs)
+        assert len(claim_jobs('worker-2', 5)) == 1
+        IngestionJob.objects.update(status=IngestionJob.PENDING, attempts=0)
+
+        call_command(
+            'ingest_worker', '--exit-when-empty', stdout=StringIO()
+        )
+        assert DataProduct.objects.count() == 2
+        assert IngestionJob.objects.filter(
+            status=IngestionJob.DONE
+        ).count() == 2
+        # the job of the unknown target is deferred without using up an
+        # attempt, and not claimed again before it is due
+        deferred = IngestionJob.objects.get(status=IngestionJob.PENDING)
+        assert deferred.attempts == 0
+        assert 'not found' in deferred.error
+        assert deferred.available_at > timezone.now()
+        assert claim_jobs('worker-1', 5) == []
+
+        # failed jobs are retried with a growing delay, then marked as
+        # failed
+        IngestionJob.objects.update(available_at=timezone.now())
+        for attempt in range(1, deferred.max_attempts + 1):
+            job, = claim_jobs('worker-1', 5)
+            assert job.attempts == attempt
+            finish_jobs([job], {(job.spectrum_file, '9999'): 'Error'},
+                        base_delay=timedelta(minutes=1))
+            if attempt < job.max_attempts:
+                assert job.status == IngestionJob.PENDING
+                assert job.available_at - job.finished == timedelta(
+                    minutes=2 ** (attempt - 1)
+                )
+                IngestionJob.objects.filter(pk=job.pk).update(
+                    available_at=timezone.now()
+                )
+        assert job.status == IngestionJob.FAILED
+
+    def test_job_queue_joined_file(self):
+        # a missing target only defers the job of its own rows
+        spectrum_file = os.path.join(self.tmp_dir.name, 'l1_obs_joined.fits')
+        write_l1_spectrum(spectrum_file, n_rows=2, obj_names=['1001', '8888'])
+        enqueue_rows([
+            {'obj_name': name, 'spectrum_file': spectrum_file}
+            for name in ('1001', '8888')
+        ])
+        call_command(
+            'ingest_worker', '--exit-when-empty', stdout=StringIO()
+        )
+        done = IngestionJob.objects.get(row__obj_name='1001')
+        assert done.status == IngestionJob.DONE
+        assert done.error == ''
+        deferred = IngestionJob.objects.get(row__obj_name='8888')
+        assert deferred.status == IngestionJob.PENDING
+        assert deferred.attempts == 0
+        assert ReducedDatum.objects.filter(target=self.targets[0]).count() == 1
+
+    def test_watch_spectra(self):
+        call_command(
+            'watch_spectra', self.tmp_dir.name, '--once', '--settle', '0',
+            stdout=StringIO()
+        )
+        assert DataProduct.objects.count() == 2
+        assert IngestedSpectrum.objects.count() == 2
+
+    def test_watch_joined_spectra(self):
+        # the targets of a joined file are read from its table, not its name
+        watch_dir = os.path.join(self.tmp_dir.name, 'joined')
+        os.mkdir(watch_dir)
+        write_l1_spectrum(
+            os.path.join(watch_dir, 'l1_obs_joined_0001.fits'), n_rows=3,
+            obj_names=['1001', '1002', '1001']
+        )
+        call_command(
+            'watch_spectra', watch_dir, '--once', '--settle', '0',
+            stdout=StringIO()
+        )
+        assert ReducedDatum.objects.filter(
+            target=self.targets[0]
+        ).count() == 2
+        assert ReducedDatum.objects.filter(
+            target=self.targets[1]
+        ).count() == 1
+        assert IngestedSpectrum.objects.count() == 2
+
+    def test_watcher_retries_failed_files(self):
+        watcher = SpectrumWatcher(self.tmp_dir.name, settle=0)
+        ready = watcher.poll()
+        assert len(ready) == 2
+        # files being ingested are not handed out twice
+        assert watcher.poll() == []
+
+        watcher.done(ready, failed=[(ready[0], '1001')])
+        assert watcher.poll() == []
+        watcher.retries[ready[0]] = (watcher.retries[ready[0]][0], 0)
+        assert watcher.poll() == ready[:1]
+        watcher.done(ready[:1])
+        assert watcher.poll() == []
+
+
+class TestSpectrumStorage(TestCase):
+    def setUp(self):
+        target = TidesTarget.objects.create(name='1001', type='SIDEREAL')
+        self.value = {
+            'flux': np.linspace(1, 2, 50).tolist(),
+            'flux_units': 'erg / (Angstrom s cm2)',
+            'wavelength': np.linspace(4000, 9000, 50).tolist(),
+            'wavelength_units': 'Angstrom',
+        }
+        self.datum = ReducedDatum.objects.create(
+            target=target, data_type='spectroscopy', value=self.value
+        )
+
+    def test_round_trip(self):
+        stub, spectrum_array = pack_spectrum(self.value)
+        assert stub['n_pix'] == 50
+        spectrum = StoredSpectrum(stub, spectrum_array)
+        assert spectrum.flux.dtype == np.float32
+        assert spectrum.flux_units == self.value['flux_units']
+        np.testing.assert_allclose(spectrum.wavelength,
+                                   self.value['wavelength'])
+        value = unpack_spectrum(spectrum_array)
+        np.testing.assert_allclose(value['flux'], self.value['flux'],
+                                   rtol=1e-6)
+
+    def test_convert_command(self):
+        call_command('convert_spectra_storage', stdout=StringIO())
+        stored = ReducedDatum.objects.values_list('value', flat=True).get(
+            pk=self.datum.pk
+        )
+        assert stored['storage'] == 'binary'
+        datum = ReducedDatum.objects.defer('value').select_related(
+            'spectrum_array'
+        ).get(pk=self.datum.pk)
+        spectrum = load_spectrum(datum)
+        assert spectrum.flux.dtype == np.float32
+        np.testing.assert_allclose(spectrum.flux, self.value['flux'],
+                                   rtol=1e-6)
+
+        # the full value is rebuilt when the datum is loaded
+        datum = ReducedDatum.objects.get(pk=self.datum.pk)
+        np.testing.assert_allclose(datum.value['flux'], self.value['flux'],
+                                   rtol=1e-6)
+        assert datum.value['flux_units'] == self.value['flux_units']
+
+        call_command('convert_spectra_storage', '--to', 'json',
+                     stdout=StringIO())
+        assert SpectrumArray.objects.count() == 0
+        stored = ReducedDatum.objects.values_list('value', flat=True).get(
+            pk=self.datum.pk
+        )
+        assert len(stored['flux']) == 50
+
+
+class TestSyntheticData(TestCase):
+    def test_synthetic_dataset(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            n_spectra = make_synthetic_dataset(tmp_dir, 20, n_pix=100)
+            catalogue = pd.read_csv(os.path.join(tmp_dir, 'mock_DB.csv'),
+                                    index_col=0)
+            assert len(catalogue) == 20
+            assert n_spectra == catalogue['OBS_STATUS_4MOST'].sum()
+            name = catalogue.index[catalogue['OBS_STATUS_4MOST']][0]
+            spectra = QMOSTSpectroscopyProcessor().read_spectra(os.path.join(
+                tmp_dir, 'sims', f'l1_obs_joined_{name}.fits'
+            ))
+        spectrum, obs_date, _ = spectra[0]
+        assert spectrum.uncertainty is not None
+        assert obs_date.year >= 2023
+
+
+class TestBulkTargets(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp_dir.cleanup)
+        pd.DataFrame({
+            'name': [1, 2, 3],
+            'OBS_STATUS_4MOST': [True, False, True],
+            'ra': [10.0, 20.0, 30.0],
+            'dec': [-1.0, -2.0, -3.0],
+            'MJD_DET': [60000.0, 60001.0, 60002.0],
+        }).set_index('name').to_csv(
+            os.path.join(self.tmp_dir.name, 'mock_DB.csv')
+        )
+        TidesTarget.objects.create(name='1', type='SIDEREAL', ra=0, dec=0)
+
+    def test_bulk_upsert(self):
+        out = StringIO()
+        with override_settings(TEST_DIR=self.tmp_dir.name):
+            call_command('add_targets', '--bulk', stdout=out)
+        assert '1 targets added, 1 updated, 1 not observed' in out.getvalue()
+        assert TidesTarget.objects.count() == 2
+        assert TidesTarget.objects.get(name='1').ra == 10.0
+        new_target = TidesTarget.objects.get(name='3')
+        assert new_target.tidesclass == 'SN'
+        assert new_target.dec == -3.0
+
+    def test_bulk_upsert_hooks_and_legacy_targets(self):
+        # a BaseTarget created before the custom target model
+        BaseTarget.objects.create(name='3', type='SIDEREAL')
+        with override_settings(TEST_DIR=self.tmp_dir.name), \
+                mock.patch('tidestom.tides_utils.target_utils.run_hook') as hook:
+            call_command('add_targets', '--bulk', stdout=StringIO())
+        assert TidesTarget.objects.get(name='3').ra == 30.0
+        hook.assert_called_once_with(
+            'target_post_save', target=TidesTarget.objects.get(name='1'),
+            created=False
+        )
+
+
+class TestSpectroscopyProcessor(TestCase):
+    def test_all_rows_are_read(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            spectrum_file = os.path.join(tmp_dir, 'l1_obs_joined_1.fits')
+            write_l1_spectrum(spectrum_file, n_rows=3)
+            data = QMOSTSpectroscopyProcessor().process_file(spectrum_file)
+        assert len(data) == 3
+        for timestamp, value, source in data:
+            assert len(value['flux']) == 50
+            assert source == '4MOST'
+
+    def test_joined_file_rows_of_target(self):
+        n_pix = 50
+        columns = [
+            fits.Column(name='OBJ_NME', format='10A',
+                        array=['1001', '1002', '1001']),
+            fits.Column(name='WAVE', format=f'{n_pix}E',
+                        array=np.tile(np.linspace(4000, 9000, n_pix),
+                                      (3, 1))),
+            fits.Column(name='FLUX', format=f'{n_pix}E',
+                        array=np.arange(3)[:, None] * np.ones((3, n_pix))),
+        ]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            spectrum_file = os.path.join(tmp_dir, 'l1_obs_joined.fits')
+            fits.BinTableHDU.from_columns(columns).writeto(spectrum_file)
+            processor = QMOSTSpectroscopyProcessor()
+            data = processor.process_file(spectrum_file, '1001')
+            assert [value['flux'][0] for _, value, _ in data] == [0, 2]
+            assert len(processor.process_file(spectrum_file, '1002')) == 1
+            with self.assertRaises(ValueError):
+                processor.process_file(spectrum_file, '9999')
+
+            # each target only gets its own spectra
+            for name in ('1001', '1002'):
+                TidesTarget.objects.create(name=name, type='SIDEREAL')
+            rows = [
+                {'obj_name': name, 'spectrum_file': spectrum_file}
+                for name in ('1001', '1002')
+            ]
+            with override_settings(BASE_DIR=tmp_dir):
+                ingest_spectra_bulk(rows)
+                # one ledger entry per target
+                assert ingest_spectra_bulk(rows).unchanged == 2
+        assert ReducedDatum.objects.filter(target__name='1001').count() == 2
+        assert ReducedDatum.objects.filter(target__name='1002').count() == 1
+
+    def test_l1_masks_and_epochs(self):
+        n_pix = 50
+        quality = np.zeros((2, n_pix), dtype=np.int16)
+        quality[0, :5] = 1
+        error = np.full((2, n_pix), 0.1)
+        error[1, -3:] = 0
+        columns = [
+            fits.Column(name='WAVE', format=f'{n_pix}E',
+                        array=np.tile(np.linspace(4000, 9000, n_pix),
+                                      (2, 1))),
+            fits.Column(name='FLUX', format=f'{n_pix}E',
+                        array=np.ones((2, n_pix))),
+            fits.Column(name='ERR_FLUX', format=f'{n_pix}E', array=error),
+            fits.Column(name='QUAL', format=f'{n_pix}I', array=quality),
+        ]
+        hdu = fits.BinTableHDU.from_columns(columns)
+        hdu.header['MJD-OBS'] = 60000.5
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            spectrum_file = os.path.join(tmp_dir, 'l1_obs_joined_1.fits')
+            hdu.writeto(spectrum_file)
+            processor = QMOSTSpectroscopyProcessor()
+            spectra = processor.read_spectra(spectrum_file)
+            data = processor.process_file(spectrum_file)
+        assert [len(spectrum.flux) for spectrum, _, _ in spectra] == [45, 47]
+        timestamp, value, _ = data[0]
+        assert timestamp.isoformat() == '2023-02-25T12:00:00+00:00'
+        np.testing.assert_allclose(value['error'], 0.1, rtol=1e-6)
+
+    def test_rows_without_good_pixels_are_skipped(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            spectrum_file = os.path.join(tmp_dir, 'l1_obs_joined_1.fits')
+            n_pix = 50
+            flux = np.ones((2, n_pix))
+            flux[0] = np.nan
+            fits.BinTableHDU.from_columns([
+                fits.Column(name='WAVE', format=f'{n_pix}E',
+                            array=np.tile(np.linspace(4000, 9000, n_pix),
+                                          (2, 1))),
+                fits.Column(name='FLUX', format=f'{n_pix}E', array=flux),
+            ]).writeto(spectrum_file)
+            with self.assertLogs(
+                'tidestom.tides_utils.tides_data_processor', 'WARNING'
+            ) as logs:
+                data = QMOSTSpectroscopyProcessor().process_file(spectrum_file)
+        assert len(data) == 1
+        assert any('Skipping row 0' in line for line in logs.output)
@@ -0,0 +1,872 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import multiprocessing
+from datetime import datetime
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+
+import pandas as pd
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils.module_loading import import_string
+
+from custom_code.models import TidesTarget as Target
+from custom_code.models import IngestedSpectrum, SpectrumArray
+from custom_code.taxonomy import get_taxonomy
+from tom_dataproducts.models import DataProduct, ReducedDatum
+from tom_targets.sharing import continuous_share_data
+from tidestom.tides_utils.tides_data_processor import (
+    spectrum_quality_metrics, spectrum_value_to_json
+)
+from tidestom.tides_utils.spectrum_storage import (
+    use_binary_storage, pack_spectrum
+)
+from tidestom.tides_utils.target_utils import (
+    render_spectra_plot, get_spectrum_plot_path, link_spectrum_file,
+    get_tom_spectrum_path, make_product_id, store_spectrum_file,
+    make_content_product_id, run_target_save_hooks
+)
+
+logger = logging.getLogger(__name__)
+
+AUTO_CLASS_FIELDS = [
+    'auto_tidesclass', 'auto_tidesclass_subclass', 'auto_tidesclass_prob'
+]
+
+
+@dataclass
+class IngestStats:
+    """Counters collected during a bulk ingestion run."""
+    rows: int = 0
+    added: int = 0
+    skipped: int = 0
+    unchanged: int = 0
+    missing_targets: int = 0
+    missing_files: int = 0
+    classified: int = 0
+    duplicates: int = 0
+    errors: int = 0
+    elapsed: float = 0.0
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self.rows / self.elapsed if self.elapsed > 0 else 0.0
+
+    def summary(self) -> str:
+        return (
+            f'{self.rows} rows in {self.elapsed:.1f} s '
+            f'({self.rows_per_sec:.1f} rows/s): {self.added} spectra added, '
+            f'{self.skipped} already in the database, '
+            f'{self.unchanged} unchanged since the last run, '
+            f'{self.duplicates} duplicates of stored spectra, '
+            f'{self.classified} auto classifications updated, '
+            f'{self.missing_targets} unknown targets, '
+            f'{self.missing_files} missing files, {self.errors} errors'
+        )
+
+
+def _batched(values, size):
+    values = list(values)
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+
+def _query_batch_size():
+    # SQLite caps the number of parameters per query; other backends do not
+    return connection.features.max_query_params or 10000
+
+
+def _get_spectroscopy_processor():
+    try:
+        processor_class = settings.DATA_PROCESSORS['spectroscopy']
+    except (AttributeError, KeyError):
+        processor_class = (
+            'tidestom.tides_utils.tides_data_processor'
+            '.QMOSTSpectroscopyProcessor'
+        )
+    return import_string(processor_class)()
+
+
+PIPELINE_DTYPES = {
+    'obj_name': 'string',
+    'spectrum_file': 'string',
+    'auto_class_agg': 'category',
+    'auto_class_subclass_agg': 'category',
+    'auto_class_prob_agg': 'float32',
+}
+
+MOCK_DB_DTYPES = {
+    'ra': 'float64',
+    'dec': 'float64',
+    'MJD_DET': 'float64',
+    'AutoClass': 'category',
+    'AutoClass_SubClass': 'category',
+    'AutoClassProb': 'float32',
+}
+
+
+def read_csv_chunks(csv_path, columns, dtypes=None, chunk_size=10000,
+                    index_col=None):
+    """Streams a CSV table in bounded-size chunks.
+
+    Only the requested columns are parsed (missing ones are ignored) and
+    they are read with the given compact dtypes, so memory use depends on
+    the chunk size rather than on the size of the table.
+
+    Parameters
+    ----------
+    csv_path: path to the CSV file.
+    columns: names of the columns to read.
+    dtypes: dtypes of some or all of the columns.
+    chunk_size: number of rows per chunk.
+    index_col: position of the index column, which is always read.
+
+    Yields
+    ------
+    chunk: dataframe with at most ``chunk_size`` rows.
+    """
+    header = pd.read_csv(csv_path, nrows=0).columns
+    index_name = header[index_col] if index_col is not None else None
+    usecols = [
+        column for column in header
+        if column in columns or column == index_name
+    ]
+    dtype = {
+        column: value for column, value in (dtypes or {}).items()
+        if column in usecols
+    }
+    with pd.read_csv(
+        csv_path, usecols=usecols, dtype=dtype, index_col=index_name,
+        chunksize=chunk_size
+    ) as reader:
+        yield from reader
+
+
+def pipeline_rows(pipeline_results: pd.DataFrame) -> list[dict]:
+    """Converts the pipeline-results table into ingestion rows.
+
+    Parameters
+    ----------
+    pipeline_results: pipeline results with ``obj_name``, ``spectrum_file``
+        and (optionally) the aggregated auto-classification columns.
+
+    Returns
+    -------
+    rows: one dictionary per spectrum.
+    """
+    columns = {
+        'obj_name': 'obj_name',
+        'spectrum_file': 'spectrum_file',
+        'auto_class_agg': 'auto_class',
+        'auto_class_subclass_agg': 'auto_class_subclass',
+        'auto_class_prob_agg': 'auto_class_prob',
+    }
+    df = pipeline_results.reindex(columns=list(columns)).rename(
+        columns=columns
+    )
+    df = df.astype(object).where(df.notna(), None)
+    return df.to_dict('records')
+
+
+def mock_rows(dbdf: pd.DataFrame, target_names, sims_dir) -> list[dict]:
+    """Builds ingestion rows for the mock catalogue.
+
+    Parameters
+    ----------
+    dbdf: mock catalogue indexed by target name, with the ``AutoClass``,
+        ``AutoClass_SubClass`` and ``AutoClassProb`` columns.
+    target_names: names of the targets to look spectra up for.
+    sims_dir: directory with the simulated ``l1_obs_joined_*.fits`` files.
+
+    Returns
+    -------
+    rows: one dictionary per target.
+    """
+    auto_columns = ['AutoClass', 'AutoClass_SubClass', 'AutoClassProb']
+    auto_df = dbdf.reindex(columns=auto_columns)
+    auto_df = auto_df.astype(object).where(auto_df.notna(), None)
+    auto_classes = dict(zip(auto_df.index, auto_df.itertuples(index=False)))
+
+    rows = []
+    for name in target_names:
+        auto_class = auto_classes.get(int(name), (None, None, None))
+        rows.append({
+            'obj_name': name,
+            'spectrum_file': os.path.join(
+                sims_dir, f'l1_obs_joined_{name}.fits'
+            ),
+            'auto_class': auto_class[0],
+            'auto_class_subclass': auto_class[1],
+            'auto_class_prob': auto_class[2],
+        })
+    return rows
+
+
+def mock_row_chunks(csv_path, sims_dir, chunk_size=10000):
+    """Streams ingestion rows for the mock catalogue, one chunk at a time.
+
+    Only catalogue entries that exist as targets produce rows.
+
+    Parameters
+    ----------
+    csv_path: path to ``mock_DB.csv``.
+    sims_dir: directory with the simulated ``l1_obs_joined_*.fits`` files.
+    chunk_size: number of catalogue rows read at a time.
+
+    Yields
+    ------
+    rows: list of rows for one chunk of the catalogue.
+    """
+    columns = ['AutoClass', 'AutoClass_SubClass', 'AutoClassProb']
+    for dbdf in read_csv_chunks(csv_path, columns, MOCK_DB_DTYPES,
+                                chunk_size=chunk_size, index_col=0):
+        names = []
+        for batch in _batched(dbdf.index.astype(str), _query_batch_size()):
+            names.extend(
+                Target.objects.filter(name__in=batch)
+                .values_list('name', flat=True)
+            )
+        yield mock_rows(dbdf, names, sims_dir)
+
+
+def resolve_targets(names) -> dict:
+    """Maps target names to targets with a single ``in_bulk`` query."""
+    return Target.objects.in_bulk(
+        {str(name) for name in names}, field_name='name'
+    )
+
+
+def resolve_subclasses(sub_class_names) -> dict:
+    """Maps sub-class names to ``TidesClassSubClass`` instances, from the
+    cached taxonomy."""
+    taxonomy = get_taxonomy()
+    subclasses = {}
+    for name in set(sub_class_names):
+        subclass = taxonomy.subclass(name) if name else None
+        if subclass is not None:
+            subclasses[name] = subclass
+    return subclasses
+
+
+def existing_spectrum_products(tom_file_paths) -> dict:
+    """Maps the (target id, path) pairs already registered to product ids."""
+    existing = {}
+    for batch in _batched(set(tom_file_paths), _query_batch_size()):
+        queryset = DataProduct.objects.filter(data__in=batch)
+        for pk, target_id, data in queryset.values_list(
+            'pk', 'target_id', 'data'
+        ):
+            existing[(target_id, data)] = pk
+    return existing
+
+
+def content_addressed_products(target_digests) -> dict:
+    """Maps (target id, content hash) pairs to the DataProduct already
+    holding those contents.
+
+    Products are found by their content-derived product id, or through
+    ledger entries that recorded the hash of the file they came from.
+
+    Parameters
+    ----------
+    target_digests: (target, SHA-256 hex digest) pairs.
+    """
+    product_ids = {
+        make_content_product_id(target, digest): (target.id, digest)
+        for target, digest in target_digests
+    }
+    wanted = set(product_ids.values())
+    found = {}
+    for batch in _batched(product_ids, _query_batch_size()):
+        for pk, product_id in DataProduct.objects.filter(
+            product_id__in=batch
+        ).values_list('pk', 'product_id'):
+            found[product_ids[product_id]] = pk
+    digests = {digest for _, digest in wanted}
+    for batch in _batched(digests, _query_batch_size()):
+        for digest, target_id, pk in IngestedSpectrum.objects.filter(
+            content_hash__in=batch, data_product__isnull=False
+        ).values_list('content_hash', 'data_product__target_id',
+                      'data_product_id'):
+            if (target_id, digest) in wanted:
+                found.setdefault((target_id, digest), pk)
+    return found
+
+
+def load_ingestion_ledger(source_paths) -> dict:
+    """Maps (source path, target id) pairs to their ``IngestedSpectrum``
+    ledger entries.
+
+    Small sets of paths are looked up with one ``IN`` query; larger ones
+    (that would need to be split on SQLite) read the whole ledger in a
+    single query instead.
+    """
+    source_paths = set(source_paths)
+    queryset = IngestedSpectrum.objects.all()
+    if len(source_paths) <= _query_batch_size():
+        queryset = queryset.filter(source_path__in=source_paths)
+    return {
+        (entry.source_path, entry.target_id): entry
+        for entry in queryset.only(
+            'source_path', 'target_id', 'size', 'mtime', 'content_hash',
+            'data_product_id'
+        )
+        if entry.source_path in source_paths
+    }
+
+
+def file_digest(path, block_size=1 << 20) -> str:
+    """Returns the SHA-256 hex digest of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def process_spectrum_file(spectrum_file_path, plot_path=None,
+                          target_name=None):
+    """Runs the CPU-heavy part of ingesting one spectrum file.
+
+    The file is decoded once; the serializer, the quality metrics and the
+    thumbnail renderer all work from the same in-memory spectra. Nothing
+    here touches the database, so it can run in a worker process.
+
+    Parameters
+    ----------
+    spectrum_file_path: path to the spectrum file.
+    plot_path: where to save the spectrum thumbnail, or None to skip it.
+    target_name: name of the target whose spectra are read from joined
+        files (see ``target_rows``).
+
+    Returns
+    -------
+    data, metrics, error: processed data (list of (timestamp, value,
+        source) tuples), quality metrics and None, or None, None and the
+        error message.
+    """
+    try:
+        processor = _get_spectroscopy_processor()
+        spectra = processor.read_spectra(spectrum_file_path, target_name)
+        data = processor.process_spectra(spectra)
+        metrics = spectrum_quality_metrics(spectra)
+        if plot_path is not None:
+            render_spectra_plot(
+                [
+                    (spectrum.spectral_axis.value, spectrum.flux.value)
+                    for spectrum, _, _ in spectra
+                ],
+                plot_path
+            )
+    except Exception as e:
+        return None, None, str(e)
+    return data, metrics, None
+
+
+class SpectrumIngester:
+    """Adds spectra and auto classifications to the database in bulk.
+
+    All targets, sub-classes, ledger entries and already-registered
+    products are resolved up front; DataProducts and ReducedDatums are then
+    inserted with ``bulk_create`` and the auto-classification fields
+    written with ``bulk_update``, one transaction per chunk of rows. With
+    more than one worker, reading the spectra and rendering the thumbnails
+    is done in a process pool while the database writes stay in this
+    process.
+
+    Files whose size and modification time match their ``IngestedSpectrum``
+    ledger entry are skipped without being opened.
+
+    Parameters
+    ----------
+    chunk_size: number of rows committed per transaction.
+    plots: whether to also render the spectrum thumbnail of new spectra.
+        Off by default: thumbnails are rendered on demand by the
+        ``spectrum_thumbnail`` view.
+    workers: number of worker processes.
+    since: only consider files modified at or after this time.
+    force: reprocess files even if the ledger or an existing DataProduct
+        says they were already ingested. Files changed since their ledger
+        entry are always reprocessed into their existing DataProduct.
+    use_hash: store a content hash in the ledger, and skip files whose
+        contents did not change even if their modification time did.
+    dedup: keep new spectra in the content-addressed store under
+        ``data/spectra/store`` and give them content-derived product ids;
+        files whose contents a target already has (re-delivered or
+        renamed files) are linked to the existing product without being
+        processed. Implies ``use_hash``.
+
+    After a run, ``failures`` maps the (spectrum file, object name) of every
+    row that could not be ingested to the reason, and ``missing_targets``
+    holds those of the rows whose target is not in the database (yet).
+    """
+
+    def __init__(self, chunk_size: int = 500, plots: bool = False,
+                 workers: int = 1, since: datetime | None = None,
+                 force: bool = False, use_hash: bool = False,
+                 dedup: bool = False):
+        self.chunk_size = chunk_size
+        self.plots = plots
+        self.workers = workers
+        self.since = since.timestamp() if since else None
+        self.force = force
+        self.use_hash = use_hash or dedup
+        self.dedup = dedup
+        self.executor = None
+
+    def __enter__(self):
+        # keeps the worker pool alive across runs
+        self.start_workers()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop_workers()
+
+    def start_workers(self):
+        if self.workers > 1 and self.executor is None:
+            # spawned workers start from a fresh interpreter, so Django has
+            # to be set up before this module can be imported there
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.workers, initializer=django.setup,
+                mp_context=multiprocessing.get_context('spawn')
+            )
+
+    def stop_workers(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def run(self, rows) -> IngestStats:
+        """Ingests the given rows.
+
+        Parameters
+        ----------
+        rows: dictionaries with ``obj_name``, ``spectrum_file``,
+            ``auto_class``, ``auto_class_subclass`` and ``auto_class_prob``
+            keys.
+
+        Returns
+        -------
+        stats: counters and timing of the run.
+        """
+        return self.run_stream([list(rows)])
+
+    def run_stream(self, row_chunks) -> IngestStats:
+        """Ingests rows arriving in chunks, e.g. from ``read_csv_chunks``.
+
+        Lookups are done once per chunk and nothing is kept from one chunk
+        to the next, so memory use does not grow with the input size.
+
+        Parameters
+        ----------
+        row_chunks: iterable of lists of rows (see ``run``).
+
+        Returns
+        -------
+        stats: counters and timing of the run.
+        """
+        start = time.perf_counter()
+        self.stats = IngestStats()
+        self.failures = {}
+        self.missing_targets = set()
+        self.product_ids = set()
+        self.product_id_stamp = None
+
+        own_workers = self.executor is None
+        self.start_workers()
+        try:
+            for rows in row_chunks:
+                self.stats.rows += len(rows)
+                self._prepare(rows)
+                for chunk in _batched(rows, self.chunk_size):
+                    self._ingest_chunk(chunk)
+                    self.stats.elapsed = time.perf_counter() - start
+                    logger.info(self.stats.summary())
+        finally:
+            if own_workers:
+                self.stop_workers()
+
+        self.stats.elapsed = time.perf_counter() - start
+        return self.stats
+
+    def _prepare(self, rows):
+        # Set-based lookups for everything the rows refer to
+        spectrum_files = [
+            row['spectrum_file'] for row in rows if row.get('spectrum_file')
+        ]
+        self.targets = resolve_targets(row['obj_name'] for row in rows)
+        self.subclasses = resolve_subclasses(
+            row.get('auto_class_subclass') for row in rows
+        )
+        self.existing = existing_spectrum_products(
+            get_tom_spectrum_path(path) for path in spectrum_files
+        )
+        self.ledger = {}
+        if not self.force:
+            self.ledger = load_ingestion_ledger(
+                os.path.abspath(path) for path in spectrum_files
+            )
+        # files from earlier chunks are in the ledger/database by now
+        self.seen = set()
+
+    def _new_product_id(self, target):
+        product_id = make_product_id(target)
+        # ids embed the time to the second: only those of the current
+        # second can clash
+        stamp = product_id[len(target.name):]
+        if stamp != self.product_id_stamp:
+            self.product_id_stamp = stamp
+            self.product_ids.clear()
+        # several spectra of one target can land in the same second
+        suffix = 1
+        unique_id = product_id
+        while unique_id in self.product_ids:
+            unique_id = f'{product_id}_{suffix}'
+            suffix += 1
+        self.product_ids.add(unique_id)
+        return unique_id
+
+    def _ingest_chunk(self, chunk):
+        stats = self.stats
+        self.chunk_duplicates = []
+        pending = []
+        ledger_entries = {}
+        updated_targets = {}
+
+        for row in chunk:
+            obj_name = str(row['obj_name'])
+            spectrum_file_path = row.get('spectrum_file')
+
+            target = self.targets.get(obj_name)
+            if not target:
+                logger.warning(f'Target {obj_name} not found in the database')
+                stats.missing_targets += 1
+                self.missing_targets.add((spectrum_file_path, obj_name))
+                self.failures[(spectrum_file_path, obj_name)] = (
+                    f'Target {obj_name} not found in the database'
+                )
+                continue
+
+            try:
+                stat = os.stat(spectrum_file_path)
+            except (OSError, TypeError):
+                logger.warning(
+                    f'Spectrum file {spectrum_file_path} not found for'
+                    f' target {obj_name}.'
+                )
+                stats.missing_files += 1
+                self.failures[(spectrum_file_path, obj_name)] = (
+                    'Spectrum file not found'
+                )
+                continue
+
+            source_path = os.path.abspath(spectrum_file_path)
+            entry = IngestedSpectrum(
+                source_path=source_path, target=target, size=stat.st_size,
+                mtime=stat.st_mtime
+            )
+            # joined files are ingested once for each of their targets
+            key = (source_path, target.id)
+            if key in self.seen:
+                stats.skipped += 1
+            elif self.since is not None and stat.st_mtime < self.since:
+                stats.unchanged += 1
+            elif self._is_unchanged(entry):
+                stats.unchanged += 1
+                if entry.content_hash:
+                    # same contents with a new mtime: refresh the ledger
+                    ledger_entries[key] = entry
+            else:
+                tom_file_path = get_tom_spectrum_path(spectrum_file_path)
+                product_pk = self.existing.get((target.id, tom_file_path))
+                if self.use_hash and not entry.content_hash:
+                    entry.content_hash = file_digest(source_path)
+                if (
+                    product_pk is not None and not self.force
+                    and key not in self.ledger
+                ):
+                    # ingested before the ledger existed: just record it
+                    stats.skipped += 1
+                    entry.data_product_id = product_pk
+                else:
+                    pending.append(
+                        (target, spectrum_file_path, product_pk, entry)
+                    )
+                ledger_entries[key] = entry
+            self.seen.add(key)
+
+            # Add or update automatic classification
+            auto_class = row.get('auto_class')
+            if auto_class:
+                auto_class_subclass = row.get('auto_class_subclass')
+                target.auto_tidesclass = auto_class
+                subclass = self.subclasses.get(auto_class_subclass)
+                if subclass:
+                    target.auto_tidesclass_subclass = subclass
+                else:
+                    logger.warning(
+                        f"Subclass '{auto_class_subclass}' not found in"
+                        f" TidesClassSubClass for target {target.name}."
+                    )
+                target.auto_tidesclass_prob = row.get('auto_class_prob')
+                updated_targets[target.id] = target
+            elif 'auto_class' in row:
+                logger.warning(
+                    f'No auto classification found for target {target.name}'
+                )
+
+        if self.dedup and not self.force:
+            pending = self._drop_duplicates(pending)
+
+        # CPU-heavy part: in the process pool, if there is one
+        spectrum_paths = [item[1] for item in pending]
+        plot_paths = [
+            get_spectrum_plot_path(item[0].id) if self.plots else None
+            for item in pending
+        ]
+        target_names = [item[0].name for item in pending]
+        if self.executor is not None:
+            results = self.executor.map(
+                process_spectrum_file, spectrum_paths, plot_paths,
+                target_names,
+                chunksize=max(1, len(pending) // (4 * self.workers))
+            )
+        else:
+            results = map(
+                process_spectrum_file, spectrum_paths, plot_paths,
+                target_names
+            )
+
+        products = []
+        new_data = []
+        stored = {}
+        for item, (data, metrics, error) in zip(pending, results):
+            target, spectrum_file_path, product_pk, entry = item
+            if error is not None:
+                logger.error(
+                    f'Error adding spectrum for {target.name}: {error}'
+                )
+                stats.errors += 1
+                self.failures[(spectrum_file_path, target.name)] = error
+                del ledger_entries[(entry.source_path, target.id)]
+                continue
+            product_id = None
+            if self.dedup:
+                # joined files are stored once for all their targets
+                if entry.source_path not in stored:
+                    stored[entry.source_path] = store_spectrum_file(
+                        spectrum_file_path
+                    )
+                data_file, digest = stored[entry.source_path]
+                if digest != entry.content_hash:
+                    # rewritten since it was hashed and read: the data may
+                    # not match the stored copy, so leave it to the next run
+                    error = 'Spectrum file changed while being ingested'
+                    logger.error(f'{error}: {spectrum_file_path}')
+                    stats.errors += 1
+                    self.failures[(spectrum_file_path, target.name)] = error
+                    del ledger_entries[(entry.source_path, target.id)]
+                    continue
+                if product_pk is None:
+                    product_id = make_content_product_id(
+                        target, entry.content_hash
+                    )
+            else:
+                data_file = link_spectrum_file(spectrum_file_path)
+                if product_pk is None:
+                    product_id = self._new_product_id(target)
+            data_product = DataProduct(
+                pk=product_pk,
+                target=target,
+                data_product_type='spectroscopy',
+                product_id=product_id,
+                data=data_file,
+                extra_data=json.dumps(metrics)
+            )
+            entry.data_product = data_product
+            products.append(data_product)
+            new_data.append(data)
+
+        for entry, first in self.chunk_duplicates:
+            # copies of a file processed in this same chunk
+            if first.data_product is None:
+                del ledger_entries[(entry.source_path, entry.target_id)]
+            else:
+                entry.data_product = first.data_product
+
+        with transaction.atomic():
+            _write_chunk(
+                products, new_data, updated_targets.values(),
+                ledger_entries.values()
+            )
+        stats.added += len(products)
+        stats.classified += len(updated_targets)
+
+    def _drop_duplicates(self, pending):
+        # Links files whose contents the target already has to the
+        # existing product instead of processing them again
+        stored = content_addressed_products(
+            (item[0], item[3].content_hash) for item in pending
+            if item[2] is None
+        )
+        first_entries = {}
+        self.chunk_duplicates = []
+        remaining = []
+        for item in pending:
+            target, _, product_pk, entry = item
+            key = (target.id, entry.content_hash)
+            if product_pk is not None:
+                remaining.append(item)
+            elif key in stored:
+                entry.data_product_id = stored[key]
+                self.stats.duplicates += 1
+            elif key in first_entries:
+                self.chunk_duplicates.append((entry, first_entries[key]))
+                self.stats.duplicates += 1
+            else:
+                first_entries[key] = entry
+                remaining.append(item)
+        return remaining
+
+    def _is_unchanged(self, entry):
+        # Compares a freshly stat-ed ledger entry against the stored one
+        stored = self.ledger.get((entry.source_path, entry.target_id))
+        if stored is None:
+            return False
+        if stored.size == entry.size and stored.mtime == entry.mtime:
+            return True
+        if self.use_hash and stored.content_hash:
+            entry.content_hash = file_digest(entry.source_path)
+            if entry.content_hash == stored.content_hash:
+                entry.data_product_id = stored.data_product_id
+                return True
+        return False
+
+
+def ingest_spectra_bulk(rows, **kwargs) -> IngestStats:
+    """Runs a ``SpectrumIngester`` over ``rows``; see its parameters."""
+    return SpectrumIngester(**kwargs).run(rows)
+
+
+def _write_chunk(products, new_data, updated_targets, ledger_entries):
+    new_products = [dp for dp in products if dp.pk is None]
+    reprocessed = [dp for dp in products if dp.pk is not None]
+    DataProduct.objects.bulk_create(new_products)
+    DataProduct.objects.bulk_update(reprocessed, ['data', 'extra_data'])
+    ReducedDatum.objects.filter(data_product__in=reprocessed).delete()
+    reduced_datums = create_reduced_datums(products, new_data)
+
+    Target.objects.bulk_update(updated_targets, AUTO_CLASS_FIELDS)
+    # as target.save() does in the row-by-row path
+    run_target_save_hooks(
+        [target.pk for target in updated_targets], created=False
+    )
+
+    IngestedSpectrum.objects.bulk_create(
+        ledger_entries, update_conflicts=True,
+        unique_fields=['source_path', 'target'],
+        update_fields=[
+            'size', 'mtime', 'content_hash', 'data_product', 'ingested'
+        ]
+    )
+
+    share_reduced_datums(reduced_datums)
+
+
+def create_reduced_datums(data_products, new_data):
+    """Bulk-creates the ReducedDatums of processed spectrum files.
+
+    Parameters
+    ----------
+    data_products: saved DataProducts of the files.
+    new_data: processed data of each file, as returned by
+        ``process_spectrum_file``.
+
+    Returns
+    -------
+    reduced_datums: the created ReducedDatums.
+    """
+    reduced_datums = [
+        ReducedDatum(
+            target=data_product.target, data_product=data_product,
+            data_type=data_product.data_product_type, timestamp=datum[0],
+            value=datum[1], source_name=datum[2]
+        )
+        for data_product, data in zip(data_products, new_data)
+        for datum in data
+    ]
+    # The processed values still hold NumPy arrays. Packed datums keep only a
+    # stub in the value, which is rebuilt from the side table when they are
+    # loaded back for sharing, the TOM API or the tom_dataproducts views
+    arrays = None
+    if use_binary_storage():
+        arrays = []
+        for datum in reduced_datums:
+            datum.value, spectrum_array = pack_spectrum(datum.value)
+            arrays.append(spectrum_array)
+    else:
+        for datum in reduced_datums:
+            datum.value = spectrum_value_to_json(datum.value)
+    reduced_datums = ReducedDatum.objects.bulk_create(reduced_datums)
+    if arrays is not None:
+        for datum, spectrum_array in zip(reduced_datums, arrays):
+            spectrum_array.reduced_datum = datum
+        SpectrumArray.objects.bulk_create(arrays)
+    return reduced_datums
+
+
+def share_reduced_datums(reduced_datums):
+    # Sharing failures must not prevent ingestion, as in run_data_processor
+    datums_by_target = {}
+    for datum in reduced_datums:
+        datums_by_target.setdefault(datum.target, []).append(datum)
+    for target, datums in datums_by_target.items():
+        try:
+            continuous_share_data(target, datums)
+        except Exception as e:
+            logger.warning(
+                f'Failed to share new data for {target.name}: {repr(e)}'
+            )
+
+
+def add_spectrum_to_database(target, spectrum_file_path):
+    """Adds the spectra of a single file to a target.
+
+    Row-by-row counterpart of ``SpectrumIngester``, going through the same
+    steps: the file is decoded once by ``process_spectrum_file``, and its
+    datums are written by ``create_reduced_datums`` and shared.
+
+    Returns
+    -------
+    message: outcome, starting with 'Error' if the spectrum was not added.
+    """
+    if not os.path.exists(spectrum_file_path):
+        return f'Spectrum file for {target.name} does not exist'
+
+    data, metrics, error = process_spectrum_file(
+        spectrum_file_path, target_name=target.name
+    )
+    if error is not None:
+        return f'Error adding spectrum for {target.name}: {error}'
+
+    try:
+        tom_file_path = link_spectrum_file(spectrum_file_path)
+        logger.info(f'Adding {tom_file_path} to target {target.name}')
+        with transaction.atomic():
+            data_product = DataProduct.objects.create(
+                target=target,
+                data_product_type='spectroscopy',
+                product_id=make_product_id(target),
+                data=tom_file_path,
+                extra_data=json.dumps(metrics)
+            )
+            reduced_datums = create_reduced_datums([data_product], [data])
+            share_reduced_datums(reduced_datums)
+    except Exception as e:
+        return f'Error adding spectrum for {target.name}: {e}'
+    return f'Added spectrum for {target.name} to the database'
@@ -0,0 +1,190 @@
+import uuid
+import logging
+from datetime import timedelta
+
+import numpy as np
+from django.db import transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+from custom_code.models import IngestionJob
+from tidestom.tides_utils.ingest_utils import _query_batch_size
+
+logger = logging.getLogger(__name__)
+
+# Delay before the first retry of a failed job; it doubles with every
+# further attempt, up to MAX_RETRY_DELAY
+RETRY_DELAY = timedelta(minutes=1)
+MAX_RETRY_DELAY = timedelta(hours=1)
+# Delay before trying again a job whose target is not in the database yet
+DEFER_DELAY = timedelta(minutes=10)
+
+
+def _json_row(row: dict) -> dict:
+    # rows read with pandas carry NumPy scalars
+    return {
+        key: value.item() if isinstance(value, np.generic) else value
+        for key, value in row.items()
+    }
+
+
+def enqueue_rows(rows, max_attempts: int = 3) -> int:
+    """Queues ingestion rows as ``IngestionJob`` s.
+
+    Rows whose spectrum file already has a pending or running job for the
+    same target are not queued again (joined files hold the spectra of
+    several targets).
+
+    Parameters
+    ----------
+    rows: ingestion rows (see ``SpectrumIngester.run``).
+    max_attempts: number of times a job is tried before it is marked as
+        failed.
+
+    Returns
+    -------
+    queued: number of jobs added.
+    """
+    rows = [_json_row(row) for row in rows if row.get('spectrum_file')]
+    spectrum_files = {row['spectrum_file'] for row in rows}
+    # one IN query, or the whole active queue if that would be too long
+    active = IngestionJob.objects.filter(
+        status__in=[IngestionJob.PENDING, IngestionJob.RUNNING]
+    )
+    if len(spectrum_files) <= _query_batch_size() - 2:
+        active = active.filter(spectrum_file__in=spectrum_files)
+    queued = {
+        (spectrum_file, str(row.get('obj_name')))
+        for spectrum_file, row in active.values_list('spectrum_file', 'row')
+    }
+    jobs = []
+    for row in rows:
+        key = (row['spectrum_file'], str(row.get('obj_name')))
+        if key in queued:
+            continue
+        queued.add(key)
+        jobs.append(IngestionJob(
+            spectrum_file=row['spectrum_file'], row=row,
+            max_attempts=max_attempts
+        ))
+    IngestionJob.objects.bulk_create(jobs, batch_size=500)
+    return len(jobs)
+
+
+def claim_jobs(worker: str, limit: int) -> list[IngestionJob]:
+    """Claims up to ``limit`` pending jobs for ``worker``, leaving out
+    those waiting to be retried (``available_at`` still in the future).
+
+    Candidate rows are locked with ``select_for_update(skip_locked=True)``
+    so concurrent workers pick disjoint jobs without waiting on each other.
+    The claim is also written with a conditional update and a per-claim
+    token, which keeps it safe on backends without row locks (SQLite).
+    """
+    token = uuid.uuid4().hex
+    with transaction.atomic():
+        candidates = list(
+            IngestionJob.objects.select_for_update(skip_locked=True)
+            .filter(status=IngestionJob.PENDING,
+                    available_at__lte=timezone.now())
+            .order_by('pk')
+            .values_list('pk', flat=True)[:limit]
+        )
+        IngestionJob.objects.filter(
+            pk__in=candidates, status=IngestionJob.PENDING
+        ).update(
+            status=IngestionJob.RUNNING, worker=worker, claim=token,
+            started=timezone.now(), finished=None,
+            attempts=F('attempts') + 1
+        )
+    return list(IngestionJob.objects.filter(claim=token).order_by('pk'))
+
+
+def retry_delay(attempts: int, base: timedelta = RETRY_DELAY,
+                maximum: timedelta = MAX_RETRY_DELAY) -> timedelta:
+    """Exponential backoff: ``base`` after the first attempt, doubling with
+    every further attempt, capped at ``maximum``."""
+    return min(base * 2 ** max(attempts - 1, 0), maximum)
+
+
+def finish_jobs(jobs, failures: dict, missing_targets=(),
+                base_delay: timedelta = RETRY_DELAY,
+                defer_delay: timedelta = DEFER_DELAY):
+    """Marks claimed jobs as done, or as pending again (for a retry) or
+    failed once they ran out of attempts.
+
+    Failed jobs are retried with an exponential backoff (see
+    ``retry_delay``). Jobs whose target is not in the database yet are
+    deferred instead: put back after ``defer_delay``, without using up an
+    attempt, since retrying them sooner cannot help.
+
+    Parameters
+    ----------
+    jobs: the claimed jobs.
+    failures: error message by (spectrum file, object name), for the jobs
+        that failed (see ``SpectrumIngester.failures``).
+    missing_targets: (spectrum file, object name) of the jobs whose target
+        was not found (see ``SpectrumIngester.missing_targets``).
+    base_delay: delay before the first retry of a failed job.
+    defer_delay: delay before a deferred job is tried again.
+    """
+    now = timezone.now()
+    for job in jobs:
+        job.finished = now
+        job.claim = ''
+        key = (job.spectrum_file, str(job.row.get('obj_name')))
+        error = failures.get(key)
+        if key in missing_targets:
+            job.error = str(error or 'Target not found in the database')
+            job.status = IngestionJob.PENDING
+            job.attempts -= 1
+            job.available_at = now + defer_delay
+        elif error is None:
+            job.status = IngestionJob.DONE
+            job.error = ''
+        else:
+            job.error = str(error)
+            if job.attempts >= job.max_attempts:
+                job.status = IngestionJob.FAILED
+            else:
+                job.status = IngestionJob.PENDING
+                job.available_at = now + retry_delay(job.attempts, base_delay)
+    IngestionJob.objects.bulk_update(
+        jobs, ['status', 'error', 'claim', 'finished', 'attempts',
+               'available_at'],
+        batch_size=500
+    )
+
+
+def requeue_stale_jobs(older_than: timedelta) -> int:
+    """Puts back running jobs claimed more than ``older_than`` ago, e.g. by
+    a worker that died; returns how many there were."""
+    stale = IngestionJob.objects.filter(
+        status=IngestionJob.RUNNING,
+        started__lt=timezone.now() - older_than
+    )
+    failed = stale.filter(attempts__gte=F('max_attempts')).update(
+        status=IngestionJob.FAILED, claim='',
+        error='Worker did not finish the job'
+    )
+    requeued = stale.update(
+        status=IngestionJob.PENDING, claim='',
+        error='Worker did not finish the job'
+    )
+    return failed + requeued
+
+
+def queue_progress() -> dict:
+    """Job counts by status, and the number of jobs finished in the last
+    hour."""
+    counts = dict.fromkeys(
+        [status for status, _ in IngestionJob.STATUS_CHOICES], 0
+    )
+    counts.update(
+        IngestionJob.objects.values_list('status')
+        .annotate(n=Count('pk')).order_by()
+    )
+    counts['last_hour'] = IngestionJob.objects.filter(
+        status=IngestionJob.DONE,
+        finished__gte=timezone.now() - timedelta(hours=1)
+    ).count()
+    return counts
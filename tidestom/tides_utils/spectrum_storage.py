@@ -0,0 +1,179 @@
+import zlib
+import hashlib
+from functools import cached_property
+
+import numpy as np
+from django.conf import settings
+from django.db.models.signals import post_init
+from django.dispatch import receiver
+from tom_dataproducts.models import ReducedDatum
+
+from custom_code.models import SpectrumArray
+
+BINARY_STORAGE = 'binary'
+JSON_STORAGE = 'json'
+# float32 little-endian, byte-shuffled, then zlib-compressed
+CODEC = 'f4-shuffle-zlib'
+ARRAY_FIELDS = ('wavelength', 'flux', 'error')
+
+
+def use_binary_storage() -> bool:
+    """Whether new spectroscopy datums are stored in the binary side table
+    (``SPECTRUM_STORAGE = 'binary'``) instead of as JSON lists."""
+    return getattr(settings, 'SPECTRUM_STORAGE', JSON_STORAGE) == BINARY_STORAGE
+
+
+def encode_array(values) -> bytes:
+    """Packs an array into compressed float32 bytes.
+
+    The bytes of each float are grouped together (byte shuffling) before
+    compressing, which compresses smooth spectra much better than the raw
+    interleaved floats.
+    """
+    values = np.ascontiguousarray(values, dtype='<f4')
+    shuffled = values.view(np.uint8).reshape(-1, 4).T
+    return zlib.compress(np.ascontiguousarray(shuffled).tobytes())
+
+
+def decode_array(blob) -> np.ndarray:
+    """Inverse of ``encode_array``; returns a read-only float32 array."""
+    shuffled = np.frombuffer(zlib.decompress(blob), dtype=np.uint8)
+    values = shuffled.reshape(4, -1).T.copy().view('<f4').ravel()
+    values.flags.writeable = False
+    return values
+
+
+def pack_spectrum(value: dict):
+    """Splits a serialized spectrum into a small JSON stub and its arrays.
+
+    Parameters
+    ----------
+    value: spectrum as produced by ``SpectrumSerializer.serialize``
+        (optionally with an ``error`` list), with lists or NumPy arrays.
+
+    Returns
+    -------
+    stub, spectrum_array: JSON value to keep in ``ReducedDatum.value`` and
+        an unsaved ``SpectrumArray`` holding the compressed arrays and the
+        units. The stub carries a digest of the arrays, so ReducedDatum's
+        uniqueness check on ``value`` still tells different spectra apart.
+    """
+    blobs = {
+        field: encode_array(value[field])
+        for field in ARRAY_FIELDS if value.get(field) is not None
+    }
+    digest = hashlib.sha256()
+    for field in ARRAY_FIELDS:
+        digest.update(blobs.get(field, b''))
+    stub = {
+        'storage': BINARY_STORAGE,
+        'digest': digest.hexdigest(),
+        'n_pix': len(value['flux']),
+    }
+    spectrum_array = SpectrumArray(
+        codec=CODEC, flux_units=value.get('flux_units', ''),
+        wavelength_units=value.get('wavelength_units', ''), **blobs
+    )
+    return stub, spectrum_array
+
+
+def unpack_spectrum(spectrum_array) -> dict:
+    """Rebuilds the JSON form of a spectrum from its ``SpectrumArray``."""
+    spectrum = StoredSpectrum({}, spectrum_array)
+    value = {
+        'flux': spectrum.flux.tolist(),
+        'flux_units': spectrum.flux_units,
+        'wavelength': spectrum.wavelength.tolist(),
+        'wavelength_units': spectrum.wavelength_units,
+    }
+    if spectrum.error is not None:
+        value['error'] = spectrum.error.tolist()
+    return value
+
+
+def is_packed(value) -> bool:
+    return isinstance(value, dict) and value.get('storage') == BINARY_STORAGE
+
+
+class StoredSpectrum:
+    """Read-only view of a spectroscopy datum, whatever its storage.
+
+    Arrays are only decoded (from the side table or the JSON lists) the
+    first time they are accessed.
+
+    Parameters
+    ----------
+    value: ``ReducedDatum.value`` of the datum.
+    spectrum_array: the datum's ``SpectrumArray`` if it is packed; its
+        arrays and units are then used instead of ``value``.
+    """
+
+    def __init__(self, value: dict, spectrum_array=None):
+        self.value = value
+        self.spectrum_array = spectrum_array
+        if spectrum_array is None:
+            self.flux_units = value.get('flux_units', '')
+            self.wavelength_units = value.get('wavelength_units', '')
+        else:
+            self.flux_units = spectrum_array.flux_units
+            self.wavelength_units = spectrum_array.wavelength_units
+
+    def _array(self, field):
+        if self.spectrum_array is not None:
+            blob = getattr(self.spectrum_array, field)
+            return None if blob is None else decode_array(blob)
+        values = self.value.get(field)
+        return None if values is None else np.asarray(values, dtype=float)
+
+    @cached_property
+    def wavelength(self) -> np.ndarray:
+        return self._array('wavelength')
+
+    @cached_property
+    def flux(self) -> np.ndarray:
+        return self._array('flux')
+
+    @cached_property
+    def error(self):
+        return self._array('error')
+
+
+def defer_spectrum_values(datums):
+    """Defers loading the JSON values of a spectroscopy datum queryset that
+    is read through ``load_spectrum``, when new datums are packed."""
+    if use_binary_storage():
+        return datums.defer('value')
+    return datums
+
+
+def load_spectrum(datum) -> StoredSpectrum:
+    """Returns a lazily-decoded ``StoredSpectrum`` for a spectroscopy datum.
+
+    Use ``select_related('spectrum_array')`` on the queryset to fetch the
+    packed arrays along with the datums. The JSON value is not read when the
+    datum is packed, so it can be deferred (see ``defer_spectrum_values``).
+    """
+    # a missing reverse one-to-one raises an AttributeError subclass
+    spectrum_array = getattr(datum, 'spectrum_array', None)
+    if spectrum_array is not None:
+        return StoredSpectrum({}, spectrum_array)
+    return StoredSpectrum(datum.value)
+
+
+@receiver(post_init, sender=ReducedDatum)
+def unpack_loaded_value(sender, instance, **kwargs):
+    """Rebuilds the full JSON value of a packed datum as it is loaded, so
+    sharing, the TOM API and the tom_dataproducts views still read the
+    spectrum from ``ReducedDatum.value``. Nothing is done when the value is
+    deferred, which is how the plots and template matching read packed
+    datums without this extra query.
+    """
+    value = instance.__dict__.get('value')
+    if instance.pk is None or not is_packed(value):
+        return
+    spectrum_array = SpectrumArray.objects.filter(
+        reduced_datum_id=instance.pk
+    ).first()
+    if spectrum_array is not None:
+        instance.value = unpack_spectrum(spectrum_array)
+        instance.spectrum_array = spectrum_array
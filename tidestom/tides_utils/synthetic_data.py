@@ -0,0 +1,100 @@
+import os
+
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+
+# (auto class, auto subclass) pairs drawn for the synthetic catalogue; the
+# subclasses are those created by `populate_tidesclasses`
+AUTO_CLASSES = [
+    ('SNIa', 'SNIa-norm'),
+    ('SNIa', 'SNIa-91bg-like'),
+    ('SNII', 'SNIIn'),
+    ('SNIb', 'SNIb-CaST'),
+    ('TDE', 'TDE-H'),
+]
+FIRST_TARGET_NAME = 10_000_000
+
+
+def write_synthetic_spectrum(path, rng, n_pix=5000, mjd=60000.0):
+    """Writes one synthetic 4MOST L1 joined spectrum.
+
+    The table has the WAVE, FLUX, ERR_FLUX and QUAL columns of an L1 file
+    and an MJD-OBS header keyword; the flux is a smooth continuum with a
+    few absorption lines, noise and a handful of flagged pixels.
+
+    Parameters
+    ----------
+    path: output FITS path.
+    rng: ``numpy.random.Generator`` to draw the spectrum from.
+    n_pix: number of pixels.
+    mjd: observation MJD.
+    """
+    wave = np.linspace(3700, 9500, n_pix, dtype=np.float32)
+    continuum = 1e-16 * (wave / 6000) ** rng.uniform(-2, 1)
+    lines = rng.uniform(3800, 9400, 5)
+    profile = 1 - 0.3 * np.exp(
+        -0.5 * ((wave[:, None] - lines) / rng.uniform(20, 80, 5)) ** 2
+    ).sum(axis=1)
+    error = 0.05 * continuum
+    flux = continuum * profile + rng.normal(0, 1, n_pix) * error
+    quality = (rng.random(n_pix) < 0.001).astype(np.int16)
+
+    columns = [
+        fits.Column(name='WAVE', format=f'{n_pix}E', unit='Angstrom',
+                    array=wave[None]),
+        fits.Column(name='FLUX', format=f'{n_pix}E',
+                    array=flux[None].astype(np.float32)),
+        fits.Column(name='ERR_FLUX', format=f'{n_pix}E',
+                    array=error[None].astype(np.float32)),
+        fits.Column(name='QUAL', format=f'{n_pix}I', array=quality[None]),
+    ]
+    hdu = fits.BinTableHDU.from_columns(columns)
+    hdu.header['MJD-OBS'] = mjd
+    hdu.writeto(path, overwrite=True)
+
+
+def make_synthetic_dataset(directory, n_targets, n_pix=5000, seed=0):
+    """Writes a synthetic ``mock_DB.csv`` and its simulated spectra.
+
+    The layout matches the test data used by ``add_targets`` and
+    ``add_spectra_to_db --mock``: the catalogue goes in
+    ``directory/mock_DB.csv`` and the spectra in ``directory/sims``.
+    About one in ten targets is not observed by 4MOST and has no spectrum.
+
+    Parameters
+    ----------
+    directory: output directory (used as ``TEST_DIR``).
+    n_targets: number of catalogue entries.
+    n_pix: number of pixels per spectrum.
+    seed: random seed, so runs on different commits use the same data.
+
+    Returns
+    -------
+    n_spectra: number of spectrum files written.
+    """
+    rng = np.random.default_rng(seed)
+    sims_dir = os.path.join(directory, 'sims')
+    os.makedirs(sims_dir, exist_ok=True)
+
+    names = np.arange(FIRST_TARGET_NAME, FIRST_TARGET_NAME + n_targets)
+    observed = rng.random(n_targets) < 0.9
+    mjd_det = rng.uniform(60000, 61000, n_targets)
+    auto_classes = rng.integers(len(AUTO_CLASSES), size=n_targets)
+    catalogue = pd.DataFrame({
+        'OBS_STATUS_4MOST': observed,
+        'ra': rng.uniform(0, 360, n_targets),
+        'dec': np.degrees(np.arcsin(rng.uniform(-1, 0.3, n_targets))),
+        'MJD_DET': mjd_det,
+        'AutoClass': [AUTO_CLASSES[i][0] for i in auto_classes],
+        'AutoClass_SubClass': [AUTO_CLASSES[i][1] for i in auto_classes],
+        'AutoClassProb': rng.uniform(0.5, 1, n_targets).round(3),
+    }, index=pd.Index(names, name='name'))
+    catalogue.to_csv(os.path.join(directory, 'mock_DB.csv'))
+
+    for name, mjd in zip(names[observed], mjd_det[observed]):
+        write_synthetic_spectrum(
+            os.path.join(sims_dir, f'l1_obs_joined_{name}.fits'), rng,
+            n_pix=n_pix, mjd=mjd + rng.uniform(1, 30)
+        )
+    return int(observed.sum())
@@ -1,14 +1,25 @@
 import os
+import hashlib
+import logging
+import numpy as np
 import matplotlib.pyplot as plt
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from astropy.io import fits
 from django.conf import settings
+from django.db import connections, router, transaction
 from tom_targets.models import Target
+from tom_targets.base_models import BaseTarget
 # from django.core.management.base import BaseCommand
-from tom_dataproducts.models import DataProduct
-from tom_dataproducts.data_processor import run_data_processor
+from tom_common.hooks import run_hook
+from tidestom.tides_utils.tides_data_processor import (
+    get_spectrum_table, target_rows
+)
 from datetime import datetime
 from pathlib import Path  # Import pathlib
 
+logger = logging.getLogger(__name__)
+
 
 def generate_light_curve_plot(target):
     # Generate the light curve plot for the target
@@ -27,26 +38,97 @@ def generate_light_curve_plot(target):
     plt.close()
 
 
+def get_spectrum_plot_path(target_id):
+    plot_dir = Path(settings.STATICFILES_DIRS[0]) / 'plots'
+    return plot_dir / f'spectrum_{target_id}.png'
+
+
 def generate_spectrum_plot(target, spec_fn):
     # Generate the spectrum plot for the target
-    f, ax = plt.subplots()
+    render_spectrum_plot(
+        spec_fn, get_spectrum_plot_path(target.id), target.name
+    )
+
+
+def render_spectrum_plot(spec_fn, plot_path, target_name=None):
+    # Does not touch the database, so it can run in worker processes
     try:
-        spec = fits.getdata(spec_fn)
+        spectra = read_spectrum_file(spec_fn, target_name)
+    except (OSError, ValueError):
+        spectra = []
+    render_spectra_plot(spectra, plot_path)
+
+
+def read_spectrum_file(spec_fn, target_name=None):
+    # (wave, flux) of the target's rows (all rows if target_name is None)
+    with fits.open(spec_fn, memmap=True) as hdul:
+        spec = get_spectrum_table(hdul)
+        rows = target_rows(spec, target_name, spec_fn)
+        # copy the rows out of the memory map before it is closed
+        return [
+            (np.array(spec['WAVE'][i]), np.array(spec['FLUX'][i]))
+            for i in rows
+        ]
+
+
+def render_spectra_plot(spectra, plot_path):
+    # Plots already-decoded spectra, given as (wave, flux) arrays. Uses the
+    # object-oriented Figure API on an Agg canvas rather than the global
+    # pyplot state, so it is safe in threads and needs no display
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    for wave, flux in spectra:
         # Example plot code
-        ax.step(spec['WAVE'][0], spec['FLUX'][0], where='mid')
+        ax.step(wave, flux, where='mid')
+    if spectra:
         ax.set_xlim(4000, 9300)
-    except OSError:
-        pass
 
     # Ensure the directory exists
-    plot_dir = Path(settings.STATICFILES_DIRS[0]) / 'plots'
-    plot_dir.mkdir(parents=True, exist_ok=True)
+    plot_path = Path(plot_path)
+    plot_path.parent.mkdir(parents=True, exist_ok=True)
 
-    # Save the plot
-    plot_path = plot_dir / f'spectrum_{target.id}.png'
-    plt.savefig(plot_path)
-    print("Saved spectrum plot to", plot_path)
-    plt.close()
+    # Save the plot; written next to it and renamed into place, so the web
+    # server never serves a half-written image
+    tmp_path = plot_path.with_name(f'.{plot_path.name}.{os.getpid()}.tmp')
+    fig.savefig(tmp_path, format='png')
+    os.replace(tmp_path, plot_path)
+    logger.debug(f'Saved spectrum plot to {plot_path}')
+
+
+def render_spectrum_thumbnail(spec_fns, plot_path, target_name=None):
+    """Renders the thumbnail of a target from all its spectrum files (only
+    the target's rows of joined files, if ``target_name`` is given).
+
+    Does not touch the database, so it can run in worker processes.
+
+    Returns
+    -------
+    error: None, or the error message if the thumbnail could not be made.
+    """
+    try:
+        spectra = []
+        for spec_fn in spec_fns:
+            spectra.extend(read_spectrum_file(spec_fn, target_name))
+        render_spectra_plot(spectra, plot_path)
+    except Exception as e:
+        return f'{plot_path}: {e}'
+    return None
+
+
+def thumbnail_is_stale(plot_path, spec_fns):
+    # Missing images, or images older than any of their source spectra
+    try:
+        plot_mtime = os.stat(plot_path).st_mtime
+    except OSError:
+        return True
+    for spec_fn in spec_fns:
+        try:
+            if os.stat(spec_fn).st_mtime > plot_mtime:
+                return True
+        except OSError:
+            continue
+    return False
 
 
 def create_target(
@@ -70,44 +152,208 @@ def create_target(
     return target
 
 
-def add_spectrum_to_database(target, spectrum_file_path):
-    try:
-        if os.path.exists(spectrum_file_path):
+def bulk_insert_child_rows(objs, batch_size=1000):
+    """Inserts only the child-table rows of multi-table-inherited targets.
+
+    ``bulk_create`` refuses models with concrete parents, so for targets
+    whose ``BaseTarget`` row already exists, this inserts the rows holding
+    the fields local to the child model (e.g. ``TidesTarget``) with one
+    plain ``INSERT`` run through ``executemany`` per batch. Like
+    ``bulk_create``, it does not call ``save()`` or send signals; run
+    ``run_target_save_hooks`` afterwards.
+
+    Parameters
+    ----------
+    objs: unsaved child-model instances with their parent link set.
+    batch_size: number of rows per ``executemany`` call.
+    """
+    objs = list(objs)
+    if not objs:
+        return
+    model = type(objs[0])
+    using = router.db_for_write(model)
+    connection = connections[using]
+    fields = model._meta.local_concrete_fields
+    quote_name = connection.ops.quote_name
+    sql = 'INSERT INTO {} ({}) VALUES ({})'.format(
+        quote_name(model._meta.db_table),
+        ', '.join(quote_name(field.column) for field in fields),
+        ', '.join(['%s'] * len(fields)),
+    )
+    with transaction.atomic(using=using, savepoint=False):
+        with connection.cursor() as cursor:
+            for i in range(0, len(objs), batch_size):
+                cursor.executemany(sql, [
+                    [
+                        field.get_db_prep_save(
+                            field.pre_save(obj, add=True), connection
+                        )
+                        for field in fields
+                    ]
+                    for obj in objs[i:i + batch_size]
+                ])
 
-            if os.path.basename(spectrum_file_path).startswith('l1_obs_joined_'):
-                tom_file_path = os.path.join(
-                    settings.BASE_DIR,
-                    'data/spectra/test/',
-                    os.path.basename(spectrum_file_path)
-                )
 
-            else:
-                tom_file_path = os.path.join(
-                    settings.BASE_DIR,
-                    'data/spectra/',
-                    os.path.basename(spectrum_file_path)
+def run_target_save_hooks(pks, created):
+    """Runs what ``Target.save`` does after saving, for targets written with
+    bulk queries: new targets get the default ``EXTRA_FIELDS`` values, and
+    the ``target_post_save`` hook is run for updated ones.
+
+    Object permissions and data sharing are not part of saving a target
+    (the views give access to the creating user explicitly), so nothing
+    else is skipped by writing targets in bulk.
+
+    Parameters
+    ----------
+    pks: primary keys of the targets.
+    created: whether the targets are new.
+    """
+    pks = list(pks)
+    defaults = [
+        extra_field for extra_field in settings.EXTRA_FIELDS
+        if extra_field.get('default') is not None
+    ]
+    if created and not defaults:
+        return
+    # SQLite caps the number of parameters per query; other backends do not
+    using = router.db_for_read(Target)
+    batch_size = connections[using].features.max_query_params or len(pks)
+    for i in range(0, len(pks), batch_size):
+        for target in Target.objects.filter(pk__in=pks[i:i + batch_size]):
+            if not created:
+                run_hook('target_post_save', target=target, created=False)
+                continue
+            for extra_field in defaults:
+                target.targetextra_set.get_or_create(
+                    target=target, key=extra_field['name'],
+                    value=extra_field.get('default')
                 )
 
-            if not os.path.isfile(tom_file_path):
-                os.symlink(spectrum_file_path, tom_file_path)
 
-            print('Adding', target, f'{target.name}', tom_file_path)
+def bulk_upsert_targets(target_fields):
+    """Inserts or updates targets with set-based queries.
+
+    ``BaseTarget`` rows are upserted with ``bulk_create(update_conflicts=
+    True)``; the child rows of the custom target model are then inserted for
+    the targets that do not have one yet (new targets, and ``BaseTarget``s
+    created before the custom model), and the save hooks of ``Target`` are
+    run (see ``run_target_save_hooks``).
 
-            data_product = DataProduct.objects.create(
-                target=target,
-                data_product_type='spectroscopy',
-                product_id=(
-                    f'{target.name}'+datetime.now().strftime('%Y%m%d%H%M%S')
-                ),
-                data=tom_file_path
+    Parameters
+    ----------
+    target_fields: dictionary mapping target names to their field values.
+
+    Returns
+    -------
+    inserted, updated: number of new and of updated targets.
+    """
+    names = list(target_fields)
+    # SQLite caps the number of parameters per query; other backends do not
+    using = router.db_for_read(BaseTarget)
+    batch_size = (
+        connections[using].features.max_query_params or max(len(names), 1)
+    )
+    existing = {}
+    for i in range(0, len(names), batch_size):
+        # only targets with a row in the custom target model, if any
+        existing.update(
+            Target.objects.filter(name__in=names[i:i + batch_size])
+            .values_list('name', 'pk')
+        )
+    update_fields = {
+        field for fields in target_fields.values() for field in fields
+    }
+
+    with transaction.atomic():
+        BaseTarget.objects.bulk_create(
+            [
+                BaseTarget(name=name, **fields)
+                for name, fields in target_fields.items()
+            ],
+            update_conflicts=True, unique_fields=['name'],
+            update_fields=sorted(update_fields) + ['modified']
+        )
+        new_names = [name for name in names if name not in existing]
+        new_pks = []
+        for i in range(0, len(new_names), batch_size):
+            new_pks.extend(
+                BaseTarget.objects
+                .filter(name__in=new_names[i:i + batch_size])
+                .values_list('pk', flat=True)
+            )
+        if Target is not BaseTarget:
+            parent_link = Target._meta.pk.attname
+            bulk_insert_child_rows(
+                Target(**{parent_link: pk}) for pk in new_pks
             )
+        run_target_save_hooks(new_pks, created=True)
+        run_target_save_hooks(existing.values(), created=False)
 
-            run_data_processor(data_product)
+    return len(new_names), len(names) - len(new_names)
 
-            return f'Added spectrum for {target.name} to the database'
 
-        else:
-            return f'Spectrum file for {target.name} does not exist'
+def get_tom_spectrum_path(spectrum_file_path):
+    # Path under data/spectra/ where the TOM keeps a link to the spectrum
+    if os.path.basename(spectrum_file_path).startswith('l1_obs_joined_'):
+        return os.path.join(
+            settings.BASE_DIR,
+            'data/spectra/test/',
+            os.path.basename(spectrum_file_path)
+        )
 
-    except Exception as e:
-        return f'Error adding spectrum for {target.name}: {e}'
+    return os.path.join(
+        settings.BASE_DIR,
+        'data/spectra/',
+        os.path.basename(spectrum_file_path)
+    )
+
+
+def link_spectrum_file(spectrum_file_path):
+    # Symlink the spectrum into the TOM data directory (if not there yet)
+    tom_file_path = get_tom_spectrum_path(spectrum_file_path)
+    if not os.path.isfile(tom_file_path):
+        os.makedirs(os.path.dirname(tom_file_path), exist_ok=True)
+        os.symlink(spectrum_file_path, tom_file_path)
+    return tom_file_path
+
+
+def get_content_store_path(digest, spectrum_file_path):
+    # Path in the content-addressed store, keyed by the SHA-256 of the
+    # file contents (the original extension is kept)
+    suffix = ''.join(Path(spectrum_file_path).suffixes)
+    return os.path.join(
+        settings.BASE_DIR, 'data/spectra/store', digest[:2], digest + suffix
+    )
+
+
+def store_spectrum_file(spectrum_file_path, block_size=1 << 20):
+    # Copy the spectrum into the content-addressed store (if not there
+    # yet). A copy rather than a link, so the stored contents cannot change
+    # under their hash when the source is overwritten. The hash is taken of
+    # the bytes copied, not of an earlier read of the source, which may
+    # have been rewritten since. Returns the stored path and the hash
+    store_dir = os.path.join(settings.BASE_DIR, 'data/spectra/store')
+    os.makedirs(store_dir, exist_ok=True)
+    tmp_path = os.path.join(store_dir, f'.{os.getpid()}.tmp')
+    digest = hashlib.sha256()
+    with open(spectrum_file_path, 'rb') as src, open(tmp_path, 'wb') as dst:
+        for block in iter(lambda: src.read(block_size), b''):
+            digest.update(block)
+            dst.write(block)
+    digest = digest.hexdigest()
+    store_path = get_content_store_path(digest, spectrum_file_path)
+    if os.path.isfile(store_path):
+        os.remove(tmp_path)
+    else:
+        os.makedirs(os.path.dirname(store_path), exist_ok=True)
+        os.replace(tmp_path, store_path)
+    return store_path, digest
+
+
+def make_product_id(target):
+    return f'{target.name}' + datetime.now().strftime('%Y%m%d%H%M%S')
+
+
+def make_content_product_id(target, digest):
+    # Same contents for the same target always get the same product id
+    return f'{target.name}_{digest[:16]}'
@@ -0,0 +1,146 @@
+import os
+import time
+import hashlib
+import logging
+
+from django.conf import settings
+
+from tidestom.tides_utils.target_utils import (
+    get_spectrum_plot_path, render_spectrum_thumbnail, thumbnail_is_stale
+)
+
+logger = logging.getLogger(__name__)
+
+# Seconds after which the size of the cache is read from disk again, since
+# other processes render into the same directory
+CACHE_SIZE_MAX_AGE = 300
+
+
+class _CacheSize:
+    # Running estimate of the size of the cache directory, so that a cache
+    # miss does not have to list it: counted up on every render, and only
+    # read from disk again when it is too old or over the limit
+    def __init__(self):
+        self.cache_dir = None
+        self.total = 0
+        self.checked = 0.0
+
+    def add(self, path, max_bytes):
+        now = time.monotonic()
+        if (
+            self.cache_dir != settings.THUMBNAIL_CACHE_DIR
+            or now - self.checked > CACHE_SIZE_MAX_AGE
+        ):
+            self.cache_dir = settings.THUMBNAIL_CACHE_DIR
+            self.total = sum(size for _, size, _ in _cached_files())
+            self.checked = now
+        else:
+            try:
+                self.total += os.path.getsize(path)
+            except OSError:
+                pass
+        if self.total > max_bytes:
+            self.total = evict_thumbnails(max_bytes, keep=path)
+            self.checked = now
+
+
+_cache_size = _CacheSize()
+
+
+def thumbnail_etag(target_id, spec_fns) -> str:
+    """Version tag of a target's thumbnail: changes whenever one of its
+    spectrum files is added, removed or modified."""
+    digest = hashlib.sha1(str(target_id).encode())
+    for spec_fn in sorted(spec_fns):
+        try:
+            stat = os.stat(spec_fn)
+            signature = f'{spec_fn}:{stat.st_size}:{stat.st_mtime_ns}'
+        except OSError:
+            signature = f'{spec_fn}:missing'
+        digest.update(signature.encode())
+    return digest.hexdigest()[:20]
+
+
+def get_thumbnail(target_id, spec_fns, etag=None, target_name=None) -> str:
+    """Returns the path of an up-to-date thumbnail of a target.
+
+    A thumbnail pre-rendered by ``create_thumbnails`` is used if it is not
+    older than the spectra. Otherwise the thumbnail is rendered into the
+    on-disk cache (``THUMBNAIL_CACHE_DIR``) the first time it is asked
+    for. Cache entries are keyed by their ETag, their modification time is
+    bumped on every hit, and the least recently used ones (including the
+    outdated versions of a thumbnail, which are never hit again) are
+    evicted once the cache grows past ``THUMBNAIL_CACHE_MAX_BYTES``. The
+    size of the cache is tracked as thumbnails are rendered, so the
+    directory is only listed when it is over the limit, or every
+    ``CACHE_SIZE_MAX_AGE`` seconds.
+
+    Parameters
+    ----------
+    target_id: id of the target.
+    spec_fns: paths of the target's spectrum files.
+    etag: the ``thumbnail_etag`` of these files, if already computed.
+    target_name: name of the target, to plot only its rows of joined
+        files.
+
+    Returns
+    -------
+    path: path of the PNG, or None if it could not be rendered.
+    """
+    static_path = get_spectrum_plot_path(target_id)
+    if not thumbnail_is_stale(static_path, spec_fns):
+        return str(static_path)
+
+    etag = etag or thumbnail_etag(target_id, spec_fns)
+    cache_dir = settings.THUMBNAIL_CACHE_DIR
+    path = os.path.join(cache_dir, f'{target_id}_{etag}.png')
+    try:
+        # mark as recently used
+        os.utime(path)
+        return path
+    except OSError:
+        pass
+
+    error = render_spectrum_thumbnail(spec_fns, path, target_name)
+    if error is not None:
+        logger.error(f'Could not render thumbnail: {error}')
+        return None
+    _cache_size.add(path, settings.THUMBNAIL_CACHE_MAX_BYTES)
+    return path
+
+
+def _cached_files():
+    # (mtime, size, path) of the cached thumbnails
+    try:
+        with os.scandir(settings.THUMBNAIL_CACHE_DIR) as entries:
+            files = []
+            for entry in entries:
+                if entry.name.endswith('.png'):
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+            return files
+    except OSError:
+        return []
+
+
+def evict_thumbnails(max_bytes, keep=None) -> int:
+    """Deletes the least recently used cached thumbnails, except ``keep``,
+    until the cache holds at most ``max_bytes``; returns the size left."""
+    files = _cached_files()
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        _remove(path)
+        total -= size
+    return total
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        # already evicted by another process
+        pass
@@ -1,34 +1,281 @@
-from datetime import datetime
+from datetime import timezone
 import os
+import logging
+import numpy as np
 from astropy.time import Time
 from tom_dataproducts.data_processor import DataProcessor
-from tom_dataproducts.processors.data_serializers import SpectrumSerializer
 from astropy.io import fits
 from specutils import Spectrum1D
 from astropy import units as u
+from astropy.nddata import StdDevUncertainty
+
+logger = logging.getLogger(__name__)
+
+
+def get_spectrum_hdu(hdul):
+    # First extension with data, as fits.getdata picks it
+    for hdu in hdul:
+        if hdu.data is not None:
+            return hdu
+    raise ValueError(f'No data found in {hdul.filename()}')
+
+
+def get_spectrum_table(hdul):
+    return get_spectrum_hdu(hdul).data
+
+
+# Column names used for the uncertainty and quality arrays of L1 spectra,
+# in order of preference
+ERROR_COLUMNS = ('ERR_FLUX', 'FLUX_ERR', 'ERR')
+IVAR_COLUMNS = ('IVAR_FLUX', 'IVAR')
+QUALITY_COLUMNS = ('QUAL', 'QUALITY', 'FLUX_QUAL')
+MJD_COLUMNS = ('MJD_OBS', 'MJD')
+# Columns naming the target of each row (fibre) of joined L1 files
+TARGET_COLUMNS = (
+    'OBJ_NME', 'OBJ_NAME', 'OBJECT', 'TARGET_NAME', 'TARGET_ID', 'OBJ_UID'
+)
+DEFAULT_FLUX_UNIT = u.Unit('erg cm-2 s-1 AA-1')
+
+
+def _first_column(spec, names):
+    for name in names:
+        if name in spec.columns.names:
+            return name
+    return None
+
+
+def _column_unit(spec, name, default):
+    unit = spec.columns[name].unit
+    if not unit:
+        return default
+    try:
+        return u.Unit(unit, parse_strict='raise')
+    except ValueError:
+        return default
+
+
+def target_rows(spec, target_name, spectrum_file_path=''):
+    """Returns the indices of the rows of an L1 spectrum table that belong
+    to a target.
+
+    Joined files hold the spectra of several fibres, whose rows are matched
+    on the first of ``TARGET_COLUMNS`` in the table. Tables without any of
+    these columns are taken to hold only the target's spectra (one file per
+    target), and so are all rows if no target is given.
+    """
+    column = _first_column(spec, TARGET_COLUMNS)
+    if target_name is None or column is None:
+        return np.arange(len(spec))
+    names = np.char.strip(np.asarray(spec[column]).astype(str))
+    rows = np.flatnonzero(names == str(target_name).strip())
+    if not rows.size:
+        raise ValueError(
+            f'No spectra of target {target_name} in {spectrum_file_path}'
+        )
+    return rows
+
+
+def file_target_names(spectrum_file_path) -> list:
+    """Returns the distinct target names in an L1 spectrum file, in order of
+    appearance, or an empty list if its table has none of
+    ``TARGET_COLUMNS`` (one file per target)."""
+    with fits.open(spectrum_file_path, memmap=True) as hdul:
+        spec = get_spectrum_table(hdul)
+        column = _first_column(spec, TARGET_COLUMNS)
+        if column is None:
+            return []
+        names = np.char.strip(np.asarray(spec[column]).astype(str))
+    return [name for name in dict.fromkeys(names.tolist()) if name]
+
+
+def observation_dates(hdul, hdu, spectrum_file_path):
+    """Returns the observation epoch of every row of an L1 spectrum table.
+
+    The epoch comes from a per-row MJD column if there is one, otherwise
+    from the MJD-OBS (or DATE-OBS) keyword of the table or primary header.
+    Files without any of these fall back to their modification time.
+    """
+    spec = hdu.data
+    n_rows = len(spec)
+    mjd_column = _first_column(spec, MJD_COLUMNS)
+    if mjd_column is not None:
+        times = Time(np.asarray(spec[mjd_column], dtype=float).ravel(),
+                     format='mjd', scale='utc')
+    else:
+        time = None
+        for header in (hdu.header, hdul[0].header):
+            if 'MJD-OBS' in header:
+                time = Time(header['MJD-OBS'], format='mjd', scale='utc')
+                break
+            if 'DATE-OBS' in header:
+                time = Time(header['DATE-OBS'], scale='utc')
+                break
+        if time is None:
+            logger.warning(
+                f'No observation date in {spectrum_file_path}; using its '
+                'modification time'
+            )
+            time = Time(os.path.getmtime(spectrum_file_path), format='unix')
+        times = Time(np.full(n_rows, time.mjd), format='mjd', scale='utc')
+    return list(times.to_datetime(timezone=timezone.utc))
+
+
+def serialize_spectrum(spectrum) -> dict:
+    """Same layout as ``SpectrumSerializer.serialize``, plus the ``error``
+    array when the spectrum has an uncertainty, but the arrays are kept as
+    NumPy arrays (see ``spectrum_value_to_json``)."""
+    serialized = {
+        'flux': spectrum.flux.value,
+        'flux_units': spectrum.flux.unit.to_string(),
+        'wavelength': spectrum.wavelength.value,
+        'wavelength_units': spectrum.wavelength.unit.to_string(),
+    }
+    if spectrum.uncertainty is not None:
+        serialized['error'] = spectrum.uncertainty.represent_as(
+            StdDevUncertainty
+        ).array
+    return serialized
+
+
+def spectrum_value_to_json(value: dict) -> dict:
+    """Turns the arrays of a serialized spectrum into lists for JSON."""
+    return {
+        key: item.tolist() if isinstance(item, np.ndarray) else item
+        for key, item in value.items()
+    }
 
 
 class QMOSTSpectroscopyProcessor(DataProcessor):
 
     def process_data(self, data_product, test: bool = False):
-        if os.path.basename(data_product.data.path).startswith(
-            'l1_obs_joined_'
-        ):
-            spectrum, obs_date, source_id = self._process_test_spectrum(
-                data_product=data_product
+        return [
+            (obs_date, spectrum_value_to_json(value), source_id)
+            for obs_date, value, source_id in self.process_file(
+                data_product.data.path, data_product.target.name
             )
+        ]
+
+    def process_file(self, spectrum_file_path, target_name=None):
+        # Does not touch the database, so it can run in worker processes.
+        # The values keep NumPy arrays; see spectrum_value_to_json
+        return self.process_spectra(
+            self.read_spectra(spectrum_file_path, target_name)
+        )
+
+    def read_spectra(self, spectrum_file_path, target_name=None):
+        """Decodes a spectrum file into (Spectrum1D, obs date, source)
+        tuples, so that serializing, plotting and quality metrics can share
+        a single read of the file. Only the spectra of ``target_name`` are
+        read from joined files (see ``target_rows``)."""
+        if spectrum_file_path.endswith(('.fits', '.fits.gz', '.fit')):
+            return self._process_L1_spectrum(spectrum_file_path, target_name)
+        raise ValueError(
+            f'Unrecognised spectrum file name: {spectrum_file_path}'
+        )
+
+    def process_spectra(self, spectra):
+        return [
+            (obs_date, serialize_spectrum(spectrum), source_id)
+            for spectrum, obs_date, source_id in spectra
+        ]
 
-        serialized_spectrum = SpectrumSerializer().serialize(spectrum)
+    def _process_L1_spectrum(self, spectrum_file_path, target_name=None):
+        """Reads the spectra of a 4MOST L1 file, one per table row of the
+        target.
 
-        return [(obs_date, serialized_spectrum, source_id)]
+        Pixels flagged in the quality column, with a non-finite flux or a
+        non-positive variance are dropped, and so are rows left without any
+        good pixel. The masks are computed on the whole (rows, pixels)
+        arrays at once, from a single memory-mapped read of the file.
+        """
+        with fits.open(spectrum_file_path, memmap=True) as hdul:
+            hdu = get_spectrum_hdu(hdul)
+            spec = hdu.data
+            rows = target_rows(spec, target_name, spectrum_file_path)
+            obs_dates = observation_dates(hdul, hdu, spectrum_file_path)
+            obs_dates = [obs_dates[i] for i in rows]
+            flux_unit = _column_unit(spec, 'FLUX', DEFAULT_FLUX_UNIT)
+            wave_unit = _column_unit(spec, 'WAVE', u.Angstrom)
 
-    def _process_test_spectrum(self, data_product):
-        spec = fits.getdata(data_product.data.path)
-        wave = spec['WAVE'][0] * u.Angstrom
-        flux = spec['FLUX'][0] * u.Unit('erg cm-2 s-1 AA-1')
-        spectrum = Spectrum1D(flux=flux, spectral_axis=wave)
-        # TODO change obs date!
-        return spectrum, Time(datetime.now()).to_datetime(), '4MOST'
+            # np.array copies the target's rows out of the memory map
+            wave = np.array(spec['WAVE'][rows], dtype=float, ndmin=2)
+            flux = np.array(spec['FLUX'][rows], dtype=float, ndmin=2)
+            good = np.isfinite(wave) & np.isfinite(flux)
 
-    def _process_L1_spectrum(self, data_product):
-        '''Some code to process real 4MOST L1 spectra'''
+            error = None
+            error_column = _first_column(spec, ERROR_COLUMNS)
+            ivar_column = _first_column(spec, IVAR_COLUMNS)
+            if error_column is not None:
+                error = np.array(
+                    spec[error_column][rows], dtype=float, ndmin=2
+                )
+            elif ivar_column is not None:
+                ivar = np.array(spec[ivar_column][rows], dtype=float, ndmin=2)
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    error = 1 / np.sqrt(ivar)
+            if error is not None:
+                good &= np.isfinite(error) & (error > 0)
+
+            quality_column = _first_column(spec, QUALITY_COLUMNS)
+            if quality_column is not None:
+                good &= np.array(spec[quality_column][rows], ndmin=2) == 0
+
+        spectra = []
+        for i, obs_date in enumerate(obs_dates):
+            mask = good[i]
+            if not mask.any():
+                logger.warning(
+                    f'Skipping row {rows[i]} of {spectrum_file_path}: no '
+                    'good pixels'
+                )
+                continue
+            uncertainty = None
+            if error is not None:
+                uncertainty = StdDevUncertainty(error[i, mask])
+            spectrum = Spectrum1D(
+                flux=flux[i, mask] * flux_unit,
+                spectral_axis=wave[i, mask] * wave_unit,
+                uncertainty=uncertainty
+            )
+            spectra.append((spectrum, obs_date, '4MOST'))
+        return spectra
+
+
+def spectrum_quality_metrics(spectra) -> dict:
+    """Computes simple quality metrics of already-decoded spectra.
+
+    Parameters
+    ----------
+    spectra: (Spectrum1D, obs date, source) tuples from ``read_spectra``.
+
+    Returns
+    -------
+    metrics: number of spectra and, per spectrum, pixel count, wavelength
+        coverage, fraction of finite fluxes, median flux and (if an
+        uncertainty is available) median signal-to-noise ratio.
+    """
+    metrics = []
+    for spectrum, _, _ in spectra:
+        wave = spectrum.spectral_axis.value
+        flux = spectrum.flux.value
+        finite = np.isfinite(flux)
+        spectrum_metrics = {
+            'n_pix': int(flux.size),
+            'wave_min': float(np.nanmin(wave)) if wave.size else None,
+            'wave_max': float(np.nanmax(wave)) if wave.size else None,
+            'finite_fraction': float(finite.mean()) if flux.size else 0.0,
+            'median_flux': (
+                float(np.median(flux[finite])) if finite.any() else None
+            ),
+        }
+        if spectrum.uncertainty is not None:
+            error = spectrum.uncertainty.represent_as(
+                StdDevUncertainty
+            ).array
+            good = finite & np.isfinite(error) & (error > 0)
+            spectrum_metrics['median_snr'] = (
+                float(np.median(flux[good] / error[good]))
+                if good.any() else None
+            )
+        metrics.append(spectrum_metrics)
+    return {'n_spectra': len(metrics), 'spectra': metrics}
@@ -17,7 +17,8 @@ Including another URLconf
 from django.urls import path, include
 from django.views.generic import TemplateView
 from .views import (
-    LatestView, SubmitClassificationView, get_subclasses, MyTargetDetailView
+    LatestView, SubmitClassificationView, get_subclasses, MyTargetDetailView,
+    spectrum_thumbnail
 )
 urlpatterns = [
     path(
@@ -41,9 +42,17 @@ urlpatterns = [
         SubmitClassificationView.as_view(), name='submit_classification'
     ),
 
+    path(
+        'targets/<int:target_id>/thumbnail.png', spectrum_thumbnail,
+        name='spectrum_thumbnail'
+    ),
+
     path(
         'api/get_subclasses/', get_subclasses, name='get_subclasses'
     ),
+    path(
+        '', include('myplots.urls')
+    ),
     path(
         '', include('tom_common.urls')
     ),
@@ -17,8 +17,18 @@ from custom_code.models import TidesTarget, HumanTidesClassSubmission
 from custom_code.forms import TidesTargetForm
 # from datetime import timedelta
 from django.utils.timezone import now
-from django.http import JsonResponse
-from custom_code.models import TidesClass, TidesClassSubClass
+import os
+from django.conf import settings
+from django.http import (
+    JsonResponse, FileResponse, Http404, HttpResponseNotModified
+)
+from django.utils.http import parse_etags, quote_etag
+from guardian.shortcuts import get_objects_for_user
+from tom_dataproducts.models import DataProduct
+from tidestom.tides_utils.thumbnail_cache import (
+    get_thumbnail, thumbnail_etag
+)
+from custom_code.taxonomy import get_taxonomy
 # from tom_common.mixins import Raise403PermissionRequiredMixin
 # from django.views.generic import TemplateView
 
@@ -137,12 +147,57 @@ class SubmitClassificationView(FormView):
 
 def get_subclasses(request):
     main_class_name = request.GET.get('main_class')
-    try:
-        main_class = TidesClass.objects.get(name=main_class_name)
-        subclasses = (
-            TidesClassSubClass.objects.filter(main_class=main_class)
-            .values('id', 'sub_class')
-        )
-        return JsonResponse(list(subclasses), safe=False)
-    except TidesClass.DoesNotExist:
-        return JsonResponse([], safe=False)
+    # served from the cached taxonomy: no queries
+    subclasses = [
+        {'id': subclass.id, 'sub_class': subclass.sub_class}
+        for subclass in get_taxonomy().subclasses_of(main_class_name)
+    ]
+    return JsonResponse(subclasses, safe=False)
+
+
+def spectrum_thumbnail(request, target_id):
+    """Serves the spectrum thumbnail of a target, rendering it on first
+    request (see ``get_thumbnail``)."""
+    targets = get_objects_for_user(
+        request.user, f'{Target._meta.app_label}.view_target', klass=Target
+    )
+    target_name = targets.filter(pk=target_id).values_list(
+        'name', flat=True
+    ).first()
+    if target_name is None:
+        raise Http404('Target not found')
+    spec_fns = [
+        # paths are stored absolute; relative ones are under MEDIA_ROOT
+        os.path.join(settings.MEDIA_ROOT, data)
+        for data in DataProduct.objects.filter(
+            target_id=target_id, data_product_type='spectroscopy'
+        ).exclude(data='').order_by('pk').values_list('data', flat=True)
+    ]
+    if not spec_fns:
+        raise Http404('No spectra for this target')
+
+    etag = quote_etag(thumbnail_etag(target_id, spec_fns))
+    cache_control = f'private, max-age={settings.THUMBNAIL_MAX_AGE}'
+    if etag in parse_etags(request.headers.get('If-None-Match', '')):
+        response = HttpResponseNotModified()
+    else:
+        thumbnail = None
+        # another process can evict the thumbnail between rendering (or
+        # finding) it and opening it: render it again, once
+        for _ in range(2):
+            path = get_thumbnail(
+                target_id, spec_fns, etag.strip('"'), target_name
+            )
+            if path is None:
+                break
+            try:
+                thumbnail = open(path, 'rb')
+                break
+            except OSError:
+                continue
+        if thumbnail is None:
+            raise Http404('Thumbnail could not be rendered')
+        response = FileResponse(thumbnail, content_type='image/png')
+    response['ETag'] = etag
+    response['Cache-Control'] = cache_control
+    return response